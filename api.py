@@ -0,0 +1,542 @@
+"""JSON API over the task tracker data.
+
+Runs next to (or instead of) the Streamlit app, on the same stores:
+
+    python api.py --port 8000 --processes 4
+
+Authenticate with POST /api/login {"username", "password"} (plus
+"tenant" to log in to a department's shard, see utils/tenants.py) and
+send the returned token as "Authorization: Bearer <token>". The token
+keeps every request on that tenant's data; POST /api/logout revokes it,
+with every other session of that user. Endpoints:
+
+    GET    /api/<table>?status=Pending&order_by=deadline&offset=0&limit=50
+    GET    /api/<table>/<key>
+    POST   /api/<table>                 a row
+    PATCH  /api/<table>/<key>           {"changes": {...}, "expected": {...}}
+    DELETE /api/<table>/<key>
+    POST   /api/<table>/batch           {"operations": [...]} (see Store.write_batch)
+    GET    /api/leaves/calendar?from=2025-06-02&to=2025-06-08
+                                        who is out, and headcount per day
+    GET    /api/leaves/balances?year=2025&employee=john_doe
+    GET    /api/leaves/conflicts        requests overlapping the same
+                                        employee's other requests (admins)
+    GET    /metrics                     timings, counters and cache stats in
+                                        the Prometheus text format (admins,
+                                        or TASKTRACKER_METRICS_TOKEN)
+
+GET responses carry an ETag derived from the table version, so
+If-None-Match revalidation costs one version check. Admins see every
+row of their tenant; employees only rows they own, and may only write
+what the pages let them (EMPLOYEE_WRITABLE): no approving, reassigning
+or setting a leave's status, and the only rows they may delete are their
+own leave requests still Pending. Users are created, and passwords
+changed (batches included), through the same hashing as the pages.
+Password hashes are never returned.
+
+Timings are only recorded with TASKTRACKER_METRICS=1 (see
+utils/metrics.py), and each worker process reports its own.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
+import tornado.web
+from tornado.httpserver import HTTPServer
+
+from utils.auth import (
+    authenticate, create_user, hash_password, issue_token, revoke_sessions, verify_token,
+)
+from utils.database import (
+    DATE, ROLES, TABLES, StaleWriteError, _clean_value, get_store, initialize_database,
+    list_tenants, plain_records,
+)
+from utils.leaves import get_calendar, holidays_version, team_size
+from utils import metrics
+from utils.ratelimit import RateLimitError, client_address
+from utils.scheduler import start_scheduler
+from utils.tenants import DEFAULT_TENANT, check_tenant, use_tenant
+
+API_PORT = int(os.environ.get("TASKTRACKER_API_PORT", 8000))
+# Static bearer token for metrics scrapers, which cannot log in
+METRICS_TOKEN = os.environ.get("TASKTRACKER_METRICS_TOKEN")
+MAX_LIMIT = 500
+DEFAULT_LIMIT = 50
+
+# Column that names the employee a row belongs to
+OWNERS = {
+    "tasks": ("assigned_to", "created_by"),
+    "leaves": ("employee",),
+    "timesheets": ("employee",),
+    "alerts": ("employee",),
+}
+HIDDEN = {"users": ("password",)}
+# Columns employees may write, per table: no more than the pages let
+# them. Inserts get INSERT_DEFAULTS for the columns they may not set;
+# approving and reassigning stay with admins. "delete" holds the values
+# a row must still have for its owner to delete it (None: admins only).
+EMPLOYEE_WRITABLE = {
+    "tasks": {
+        "insert": ("task_id", "title", "description", "assigned_to", "deadline", "severity",
+                   "created_by"),
+        "update": ("status",),
+        "delete": None,
+    },
+    "leaves": {
+        "insert": ("leave_id", "employee", "start_date", "end_date", "leave_type", "reason"),
+        "update": (),
+        "delete": {"status": "Pending"},
+    },
+    "timesheets": {
+        "insert": ("timesheet_id", "employee", "date", "login_time", "logout_time", "tasks",
+                   "task_notes", "hours_worked", "task_id", "description"),
+        "update": ("login_time", "logout_time", "tasks", "task_notes", "hours_worked",
+                   "task_id", "description"),
+        "delete": None,
+    },
+    "alerts": {"insert": (), "update": (), "delete": None},
+}
+INSERT_DEFAULTS = {
+    "tasks": {"status": "Not Started", "approved": False},
+    "leaves": {"status": "Pending"},
+}
+
+RESPONSE_CACHE_SIZE = 1024
+
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("TASKTRACKER_API_THREADS", 8)))
+
+
+class ResponseCache:
+    """Serialized GET bodies by ETag, least recently used evicted.
+
+    The ETag already covers the table version, so entries never need
+    invalidating; stale ones just stop being asked for.
+    """
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE):
+        self.size = size
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tag):
+        with self._lock:
+            body = self._bodies.get(tag)
+            if body is not None:
+                self._bodies.move_to_end(tag)
+            return body
+
+    def put(self, tag, body):
+        with self._lock:
+            self._bodies[tag] = body
+            while len(self._bodies) > self.size:
+                self._bodies.popitem(last=False)
+
+
+_responses = ResponseCache()
+
+
+def _row_json(table, row):
+    return {
+        c: _clean_value(v) for c, v in row.items() if c not in HIDDEN.get(table, ())
+    }
+
+
+def _parse(table, column, value):
+    """A query-string value in the column's type"""
+    dtype = TABLES[table]["dtypes"].get(column)
+    if dtype == DATE:
+        return pd.Timestamp(value)
+    if dtype == "bool":
+        return value.lower() in ("true", "1")
+    if dtype == "float64":
+        return float(value)
+    return value
+
+
+class ApiHandler(tornado.web.RequestHandler):
+    # Tenant whose shard the request works on; set from the token
+    tenant = DEFAULT_TENANT
+
+    def set_default_headers(self):
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+
+    def write_error(self, status_code, **kwargs):
+        self.finish({"error": self._reason})
+
+    def fail(self, status, message):
+        raise tornado.web.HTTPError(status, reason=message)
+
+    def on_finish(self):
+        if metrics.ENABLED:
+            metrics.get_metrics().observe(
+                f"api.{type(self).__name__}.{self.request.method.lower()}",
+                self.request.request_time(), error=self.get_status() >= 500,
+            )
+
+    def body(self):
+        try:
+            return json.loads(self.request.body or b"{}")
+        except ValueError:
+            self.fail(400, "Request body is not valid JSON")
+
+    def run(self, fn, *args, **kwargs):
+        """Run blocking data-layer work off the event loop, on the
+        request's tenant"""
+        tenant = self.tenant
+
+        def work():
+            with use_tenant(tenant):
+                return fn(*args, **kwargs)
+        return tornado.ioloop.IOLoop.current().run_in_executor(_executor, work)
+
+
+class LoginHandler(ApiHandler):
+    async def post(self):
+        body = self.body()
+        try:
+            self.tenant = check_tenant(body.get("tenant"))
+        except ValueError as e:
+            self.fail(400, str(e))
+        if self.tenant != DEFAULT_TENANT and self.tenant not in list_tenants():
+            self.fail(404, f"Unknown tenant {self.tenant!r}")
+        try:
+            role = await self.run(
+                authenticate, body.get("username"), body.get("password", ""),
+                client_address(
+                    self.request.remote_ip, self.request.headers.get("X-Forwarded-For")
+                ),
+            )
+        except RateLimitError as e:
+            self.set_header("Retry-After", str(int(e.retry_after) + 1))
+            self.fail(429, str(e))
+        if role is None:
+            self.fail(401, "Invalid username or password")
+        token = await self.run(issue_token, body["username"])
+        self.write({"token": token, "role": role, "tenant": self.tenant})
+
+
+class LogoutHandler(ApiHandler):
+    async def post(self):
+        header = self.request.headers.get("Authorization", "")
+        session = verify_token(header[7:]) if header.startswith("Bearer ") else None
+        if session is None:
+            self.fail(401, "Missing or invalid token")
+        username, _, self.tenant = session
+        await self.run(revoke_sessions, username)
+        self.set_status(204)
+
+
+class TableHandler(ApiHandler):
+    def prepare(self):
+        table = self.path_args[0]
+        if table not in TABLES:
+            self.fail(404, f"Unknown table {table!r}")
+        header = self.request.headers.get("Authorization", "")
+        session = verify_token(header[7:]) if header.startswith("Bearer ") else None
+        if session is None:
+            self.fail(401, "Missing or invalid token")
+        self.username, self.role, self.tenant = session
+        if self.role != "admin" and table not in OWNERS:
+            self.fail(403, "Admin privileges required")
+        self.table = table
+        self.store = get_store(table, self.tenant)
+
+    def owns(self, row):
+        if self.role == "admin":
+            return True
+        return any(row.get(c) == self.username for c in OWNERS[self.table])
+
+    def check_writable(self, op, columns):
+        """403 unless the caller may write these columns (see EMPLOYEE_WRITABLE)"""
+        if self.role == "admin":
+            return
+        denied = set(columns) - set(EMPLOYEE_WRITABLE[self.table][op])
+        if denied:
+            self.fail(403, f"Only admins can set {sorted(denied)}")
+
+    def check_etag_for(self, *parts):
+        """Set the ETag for this response; True if the client's copy is current"""
+        version = self.store.backend.version(self.table)
+        key = (self.tenant, version, self.username) + parts
+        self.tag = hashlib.sha1(repr(key).encode()).hexdigest()
+        self.set_header("ETag", f'"{self.tag}"')
+        return self.check_etag_header()
+
+    async def cached_get(self, build, *parts):
+        """Answer a GET with 304, a cached body, or a freshly built one"""
+        if self.check_etag_for(*parts):
+            self.set_status(304)
+            return
+        body = _responses.get(self.tag)
+        if body is None:
+            tag = self.tag
+            body = json.dumps(await build()).encode()
+            _responses.put(tag, body)
+        self.write(body)
+
+
+class CollectionHandler(TableHandler):
+    def query(self):
+        args = {k: [v.decode() for v in vs] for k, vs in self.request.query_arguments.items()}
+        columns = TABLES[self.table]["columns"]
+        query = {"ranges": {}}
+        try:
+            query["offset"] = max(0, int(args.pop("offset", ["0"])[0]))
+            query["limit"] = min(MAX_LIMIT, int(args.pop("limit", [DEFAULT_LIMIT])[0]))
+            order_by = args.pop("order_by", [None])[0]
+            if order_by is not None and order_by not in columns:
+                self.fail(400, f"Unknown column {order_by!r}")
+            query["order_by"] = order_by
+            query["descending"] = args.pop("descending", ["false"])[0].lower() in ("true", "1")
+            for name, values in args.items():
+                column, _, bound = name.rpartition("_")
+                if bound in ("from", "to") and column in columns:
+                    low, high = query["ranges"].get(column, (None, None))
+                    value = _parse(self.table, column, values[0])
+                    query["ranges"][column] = (value, high) if bound == "from" else (low, value)
+                elif name in columns:
+                    parsed = [_parse(self.table, name, v) for v in values]
+                    query[name] = parsed[0] if len(parsed) == 1 else parsed
+                else:
+                    self.fail(400, f"Unknown parameter {name!r}")
+        except ValueError as e:
+            self.fail(400, str(e))
+        if self.role != "admin":
+            query["any_of"] = {c: self.username for c in OWNERS[self.table]}
+        return query
+
+    async def get(self, table):
+        await self.cached_get(self.page, self.request.uri)
+
+    async def page(self):
+        query = self.query()
+        rows, total = await self.run(self.store.query, **query)
+        return {
+            "items": [_row_json(self.table, r) for r in rows.to_dict("records")],
+            "total": total,
+            "offset": query["offset"],
+            "limit": query["limit"],
+        }
+
+    async def post(self, table):
+        row = self.body()
+        if self.table == "users":
+            return await self.post_user(row)
+        if self.role != "admin":
+            defaults = INSERT_DEFAULTS.get(self.table, {})
+            self.check_writable("insert", set(row) - set(defaults))
+            if any(row.get(c) not in (None, self.username) for c in OWNERS[self.table]):
+                self.fail(403, "Rows can only be created for yourself")
+            row = {**row, **defaults, **{c: self.username for c in OWNERS[self.table]}}
+        key = TABLES[self.table]["key"]
+        if row.get(key) is None:
+            self.fail(400, f"Missing {key!r}")
+        if TABLES[self.table]["unique"] and await self.run(self.store.get, row[key]) is not None:
+            self.fail(409, f"{row[key]!r} already exists")
+        try:
+            await self.run(self.store.insert, row)
+        except StaleWriteError as e:
+            self.fail(409, str(e))  # inserted by someone else meanwhile
+        self.set_status(201)
+        self.write(_row_json(self.table, row))
+
+    async def post_user(self, row):
+        """Users are created with a hashed password, as on the admin page"""
+        if not row.get("username") or not row.get("password"):
+            self.fail(400, "Expected {\"username\", \"password\", \"role\"}")
+        role = row.get("role", "employee")
+        if role not in ROLES:
+            self.fail(400, f"role must be one of {ROLES}")
+        created, message = await self.run(create_user, row["username"], row["password"], role)
+        if not created:
+            self.fail(409 if message == "Username already exists" else 500, message)
+        self.set_status(201)
+        self.write({"username": row["username"], "role": role})
+
+
+class RowHandler(TableHandler):
+    async def row(self, key):
+        row = await self.run(self.store.get, key)
+        if row is None or not self.owns(row):
+            self.fail(404, f"No {self.table} row {key!r}")
+        return row
+
+    async def get(self, table, key):
+        async def build():
+            return _row_json(self.table, await self.row(key))
+        await self.cached_get(build, key)
+
+    async def patch(self, table, key):
+        body = self.body()
+        changes = body.get("changes") or {}
+        unknown = set(changes) - set(TABLES[self.table]["columns"])
+        if unknown:
+            self.fail(400, f"Unknown columns {sorted(unknown)}")
+        self.check_writable("update", changes)
+        row = await self.row(key)
+        if not self.owns({**row, **changes}):
+            self.fail(403, "Rows can only be assigned to yourself")
+        if "password" in changes and self.table == "users":
+            changes["password"] = await self.run(hash_password, str(changes["password"]))
+        try:
+            await self.run(self.store.update, key, body.get("expected"), **changes)
+        except StaleWriteError as e:
+            self.fail(409, str(e))
+        self.write(_row_json(self.table, {**row, **changes}))
+
+    async def delete(self, table, key):
+        expected = self.body().get("expected")
+        row = await self.row(key)
+        if self.role != "admin":
+            required = EMPLOYEE_WRITABLE[self.table]["delete"]
+            if required is None:
+                self.fail(403, f"Only admins can delete {self.table}")
+            if any(row.get(c) != v for c, v in required.items()):
+                self.fail(403, f"Only rows with {required} can be deleted")
+            # Checked again under the write lock, in case an admin acts first
+            expected = {**(expected or {}), **required}
+        try:
+            await self.run(self.store.delete, key, expected)
+        except StaleWriteError as e:
+            self.fail(409, str(e))
+        self.set_status(204)
+
+
+class BatchHandler(TableHandler):
+    async def post(self, table):
+        if self.role != "admin":
+            self.fail(403, "Admin privileges required")
+        operations = self.body().get("operations")
+        if not isinstance(operations, list):
+            self.fail(400, "Expected {\"operations\": [...]}")
+        columns = set(TABLES[self.table]["columns"])
+        checked = []
+        for operation in operations:
+            if not isinstance(operation, dict):
+                self.fail(400, "Each operation must be an object")
+            op = operation.get("op")
+            if op not in ("insert", "update", "delete"):
+                self.fail(400, f"Unknown op {op!r}")
+            values = operation.get("row" if op == "insert" else "changes") or {}
+            if op != "delete" and not isinstance(values, dict):
+                self.fail(400, f"{op} needs an object of column values")
+            unknown = set(values) - columns if op != "delete" else set()
+            if unknown:
+                self.fail(400, f"Unknown columns {sorted(unknown)}")
+            if self.table == "users" and values.get("password") is not None:
+                # Stored hashed, as create_user and PATCH do
+                password = await self.run(hash_password, str(values["password"]))
+                values = {**values, "password": password}
+                operation = {**operation, ("row" if op == "insert" else "changes"): values}
+            checked.append(operation)
+        try:
+            count = await self.run(self.store.write_batch, checked)
+        except StaleWriteError as e:
+            self.fail(409, str(e))
+        except KeyError as e:
+            self.fail(400, f"Operation is missing {e}")
+        except ValueError as e:
+            self.fail(400, str(e))
+        self.write({"affected": count})
+
+
+class LeaveCalendarHandler(TableHandler):
+    async def get(self, table, view):
+        if view == "conflicts" and self.role != "admin":
+            self.fail(403, "Admin privileges required")
+        # Headcounts also depend on the users table and the holiday list
+        users = self.store.backend.version("users")
+        await self.cached_get(lambda: self.run(self.build, view), self.request.uri,
+                              users, holidays_version())
+
+    def build(self, view):
+        calendar = get_calendar()
+        if view == "calendar":
+            try:
+                start = pd.Timestamp(self.get_argument("from"))
+                end = pd.Timestamp(self.get_argument("to", str(start.date())))
+            except ValueError as e:
+                self.fail(400, str(e))
+            if (end - start).days > 366:
+                self.fail(400, "Ask for at most a year at a time")
+            headcount = calendar.headcount(start, end)
+            return {
+                "out": plain_records(calendar.out(start, end).drop(columns="status")),
+                "days": [
+                    {"date": str(day.date()), "on_leave": int(n), "available": team_size() - int(n)}
+                    for day, n in headcount.items()
+                ],
+            }
+        if view == "balances":
+            employee = self.get_argument("employee", None)
+            if self.role != "admin":
+                employee = self.username
+            try:
+                year = int(self.get_argument("year", str(pd.Timestamp.today().year)))
+            except ValueError:
+                self.fail(400, "year must be a number")
+            balances = calendar.balances(year, None if employee is None else [employee])
+            return {"year": year, "items": plain_records(balances)}
+        return {"items": plain_records(calendar.overlaps())}
+
+
+class MetricsHandler(ApiHandler):
+    def get(self):
+        header = self.request.headers.get("Authorization", "")
+        token = header[7:] if header.startswith("Bearer ") else ""
+        if not (METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())):
+            session = verify_token(token) if token else None
+            if session is None:
+                self.fail(401, "Missing or invalid token")
+            if session[1] != "admin":
+                self.fail(403, "Admin privileges required")
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.prometheus_text())
+
+
+def make_app():
+    return tornado.web.Application(
+        [
+            (r"/api/login", LoginHandler),
+            (r"/api/logout", LogoutHandler),
+            (r"/api/(\w+)", CollectionHandler),
+            (r"/api/(\w+)/batch", BatchHandler),
+            (r"/api/(leaves)/(calendar|balances|conflicts)", LeaveCalendarHandler),
+            (r"/api/(\w+)/([^/]+)", RowHandler),
+            (r"/metrics", MetricsHandler),
+        ],
+        compress_response=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Task tracker JSON API")
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port (0 = one per CPU)")
+    args = parser.parse_args()
+
+    sockets = tornado.netutil.bind_sockets(args.port, args.address)
+    if args.processes != 1:
+        tornado.process.fork_processes(args.processes)
+    # Open the data layer after forking so no worker inherits a connection
+    initialize_database()
+    # Every worker starts one; the leader lock lets a single one run the jobs
+    start_scheduler()
+    server = HTTPServer(make_app())
+    server.add_sockets(sockets)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+"""Synthetic data generator and benchmarks of the app's code paths.
+
+    export TASKTRACKER_DATA_DIR=/tmp/bench
+    python benchmark.py generate --scale 1000000
+    python benchmark.py run --json before.json
+    python benchmark.py compare before.json after.json
+
+Both commands work on TASKTRACKER_DATA_DIR with the configured backend,
+so point it at a scratch directory: `generate` refuses a directory that
+already holds tables (unless --force, which replaces them), and `run`
+only runs where `generate` left its marker file, as it writes.
+
+`generate` writes --scale timesheet rows plus users, tasks and leaves in
+proportion (override with --users/--tasks/--leaves), in chunks, as the
+CSV files initialize_database() creates; every user's password is
+"bench". It then starts the app's storage once as the server would - the
+SQLite import included - archives the closed months as `bulk.py archive`
+would, and reports how long that took.
+
+`run` times the functions the pages call - check_password, create_user,
+a task status update, a leave approval, timesheet clock-in and clock-out,
+the admin and employee dashboards and a payroll report - and prints
+latency percentiles, throughput and the process's peak RSS after each.
+The first call of each benchmark is reported apart from the rest, as it
+pays for loading caches. --json writes the results for `compare`, which
+exits 1 when a benchmark's median got slower by more than --threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS
+    resource = None
+
+from utils.auth import check_password, create_user, hash_password
+from utils.charts import (
+    employee_hours_bar, my_daily_hours, my_daily_hours_line, my_task_status_pie,
+    task_severity_bar, task_status_pie,
+)
+from utils.aggregates import get_views
+from utils.database import (
+    DATA_DIR, FORMAT_EXTENSIONS, LEAVE_STATUSES, LEAVE_TYPES, SEVERITIES, SQLITE_FILE,
+    STORAGE_BACKEND, TABLES, TASK_STATUSES, archive_closed_months, get_store,
+    initialize_database, table_columns,
+)
+from utils.reports import build_report
+
+PASSWORD = "bench"
+MARKER = ".benchmark"
+CHUNK_SIZE = 200000
+PERCENTILES = (50, 90, 99)
+
+
+def _scaled(args):
+    """Row counts per table for a --scale"""
+    return {
+        "users": args.users or max(10, args.scale // 250),
+        "tasks": args.tasks or max(10, args.scale // 20),
+        "leaves": args.leaves or max(10, args.scale // 50),
+        "timesheets": args.scale,
+    }
+
+
+def _pick(rng, values, size, p=None):
+    return np.asarray(values, dtype=object)[rng.choice(len(values), size, p=p)]
+
+
+def _dates(rng, start, days, size):
+    names = pd.date_range(start, periods=days, freq="D").strftime("%Y-%m-%d").to_numpy(dtype=object)
+    return names[rng.integers(0, days, size)]
+
+
+def _ids(prefix, first, size, width):
+    return np.char.add(prefix, np.char.zfill(np.arange(first, first + size).astype(str), width)).astype(object)
+
+
+# "HH:MM:SS" of every second of a day, to index with seconds
+_CLOCK = pd.to_datetime(np.arange(86400), unit="s").strftime("%H:%M:%S").to_numpy(dtype=object)
+
+
+def user_rows(count):
+    """One admin plus `count` employees, all sharing one password hash:
+    hashing each would take longer than the rest of the generation"""
+    password = hash_password(PASSWORD)
+    names = ["admin"] + list(_ids("emp", 0, count, 6))
+    yield pd.DataFrame({
+        "username": names,
+        "password": password,
+        "role": ["admin"] + ["employee"] * count,
+    })
+
+
+def task_rows(rng, count, employees, start, days):
+    for first in range(0, count, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, count - first)
+        yield pd.DataFrame({
+            "task_id": _ids("task", first, size, 8),
+            "title": _ids("Task ", first, size, 1),
+            "description": "Synthetic task",
+            "assigned_to": _pick(rng, employees, size),
+            "deadline": _dates(rng, start, days + 60, size),
+            "severity": _pick(rng, SEVERITIES, size),
+            "status": _pick(rng, TASK_STATUSES, size, [0.3, 0.3, 0.4]),
+            "created_by": "admin",
+            "approved": rng.random(size) < 0.8,
+        })
+
+
+def leave_rows(rng, count, employees, start, days):
+    for first in range(0, count, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, count - first)
+        starts = rng.integers(0, days + 60, size)
+        names = pd.date_range(start, periods=days + 70, freq="D").strftime("%Y-%m-%d").to_numpy(dtype=object)
+        yield pd.DataFrame({
+            "leave_id": _ids("leave", first, size, 8),
+            "employee": _pick(rng, employees, size),
+            "start_date": names[starts],
+            "end_date": names[starts + rng.integers(0, 10, size)],
+            "leave_type": _pick(rng, LEAVE_TYPES, size, [0.6, 0.25, 0.15]),
+            "status": _pick(rng, LEAVE_STATUSES, size, [0.3, 0.6, 0.1]),
+            "reason": "Synthetic leave",
+        })
+
+
+def timesheet_rows(rng, count, employees, tasks, start, days):
+    for first in range(0, count, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, count - first)
+        login = rng.integers(8 * 3600, 10 * 3600, size)
+        worked = rng.integers(4 * 3600, 10 * 3600, size)
+        task_ids = _pick(rng, tasks, size)
+        yield pd.DataFrame({
+            "timesheet_id": _ids("ts", first, size, 9),
+            "employee": _pick(rng, employees, size),
+            "date": _dates(rng, start, days, size),
+            "login_time": _CLOCK[login],
+            "logout_time": _CLOCK[login + worked],
+            "tasks": "",
+            "task_notes": "",
+            "hours_worked": np.round(worked / 3600, 2),
+            "task_id": task_ids,
+            "description": "Synthetic entry",
+        })
+
+
+def _table_files():
+    names = [SQLITE_FILE, SQLITE_FILE + "-wal", SQLITE_FILE + "-shm", MARKER]
+    for table in TABLES:
+        names += [table + ext for ext in FORMAT_EXTENSIONS.values()]
+        names += [table + ".log", table + ".audit.log"]
+    return [os.path.join(DATA_DIR, n) for n in names if os.path.exists(os.path.join(DATA_DIR, n))]
+
+
+def cmd_generate(args):
+    existing = _table_files()
+    if existing and not args.force:
+        raise SystemExit(f"{DATA_DIR} already holds tables; use another "
+                         f"TASKTRACKER_DATA_DIR or --force to replace them")
+    for path in existing:
+        os.remove(path)
+    shutil.rmtree(os.path.join(DATA_DIR, "archive"), ignore_errors=True)
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    rng = np.random.default_rng(args.seed)
+    counts = _scaled(args)
+    # History ends yesterday, so today is free for the clock-in benchmarks
+    start = pd.Timestamp.today().normalize() - pd.Timedelta(days=args.days)
+    employees = _ids("emp", 0, counts["users"], 6)
+    tasks = _ids("task", 0, counts["tasks"], 8)
+    tables = {
+        "users": user_rows(counts["users"]),
+        "tasks": task_rows(rng, counts["tasks"], employees, start, args.days),
+        "leaves": leave_rows(rng, counts["leaves"], employees, start, args.days),
+        "timesheets": timesheet_rows(rng, counts["timesheets"], employees, tasks, start, args.days),
+    }
+    for table, chunks in tables.items():
+        began = time.perf_counter()
+        rows = 0
+        with open(os.path.join(DATA_DIR, table + ".csv"), "w", newline="") as f:
+            for i, chunk in enumerate(chunks):
+                chunk[table_columns(table)].to_csv(f, index=False, header=i == 0)
+                rows += len(chunk)
+        print(f"{table}: {rows} rows in {time.perf_counter() - began:.1f}s", file=sys.stderr)
+
+    began = time.perf_counter()
+    initialize_database()
+    for table, spec in TABLES.items():
+        if "partition" in spec:
+            archive_closed_months(table)
+    print(f"Storage started ({STORAGE_BACKEND}) in {time.perf_counter() - began:.1f}s",
+          file=sys.stderr)
+    with open(os.path.join(DATA_DIR, MARKER), "w") as f:
+        json.dump({"scale": args.scale, "days": args.days, "seed": args.seed, **counts}, f)
+    return 0
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, None where unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def measure(name, call, repeat, max_seconds):
+    """Run call(i) up to `repeat` times (fewer once max_seconds are used,
+    at least twice, or when call raises StopIteration because it ran out
+    of rows to work on) and summarize the latencies in milliseconds"""
+    latencies = []
+    errors = 0
+    began = time.perf_counter()
+    for i in range(repeat):
+        t = time.perf_counter()
+        try:
+            if call(i) is False:
+                errors += 1
+        except StopIteration:
+            break
+        latencies.append((time.perf_counter() - t) * 1000)
+        if i >= 1 and time.perf_counter() - began > max_seconds:
+            break
+    if not latencies:
+        print(f"{name:22} skipped: nothing to work on")
+        return None
+    first, rest = latencies[0], np.array(latencies[1:] or latencies)
+    result = {
+        "calls": len(latencies),
+        "errors": errors,
+        "first_ms": round(first, 3),
+        "mean_ms": round(float(rest.mean()), 3),
+        **{f"p{p}_ms": round(float(np.percentile(rest, p)), 3) for p in PERCENTILES},
+        "max_ms": round(float(rest.max()), 3),
+        "ops_per_s": round(len(rest) / (rest.sum() / 1000), 1) if rest.sum() else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(f"{name:22} {result['calls']:6d} calls  first {first:9.2f} ms  "
+          f"p50 {result['p50_ms']:9.2f}  p90 {result['p90_ms']:9.2f}  p99 {result['p99_ms']:9.2f} ms  "
+          f"{result['ops_per_s'] or 0:9.1f}/s  rss {result['peak_rss_mb']} MB"
+          + (f"  {errors} errors" if errors else ""))
+    return result
+
+
+def benchmarks(rng):
+    """name -> (setup, call): setup() runs untimed and returns what call(i) needs"""
+    users, tasks, leaves = get_store("users"), get_store("tasks"), get_store("leaves")
+    timesheets = get_store("timesheets")
+
+    def employees():
+        return list(rng.permutation(users.usernames("employee")))
+
+    def login(names):
+        return lambda i: check_password(names[i % len(names)], PASSWORD)
+
+    def new_user():
+        return lambda i: create_user(f"bench_{uuid.uuid4().hex[:12]}", PASSWORD, "employee")[0]
+
+    def task_status():
+        ids = list(rng.permutation(tasks.all()["task_id"].to_numpy()))
+
+        def call(i):
+            task = tasks.get(ids[i % len(ids)])
+            status = TASK_STATUSES[(TASK_STATUSES.index(task["status"]) + 1) % len(TASK_STATUSES)]
+            return tasks.update(task["task_id"], expected={"status": task["status"]}, status=status)
+        return call
+
+    def approve_leave():
+        pending = list(leaves.find(status="Pending")["leave_id"])
+
+        def call(i):
+            if i >= len(pending):
+                raise StopIteration
+            return leaves.update(pending[i], expected={"status": "Pending"}, status="Approved")
+        return call
+
+    today = pd.Timestamp.today().strftime("%Y-%m-%d")
+    clocked = []
+
+    def clock_in():
+        # Employees an earlier run already clocked in today are left out
+        done = set(timesheets.find(date=pd.Timestamp(today))["employee"])
+        names = [n for n in employees() if n not in done]
+
+        def call(i):
+            if i >= len(names):
+                raise StopIteration
+            timesheets.insert({
+                "timesheet_id": str(uuid.uuid4()), "employee": names[i], "date": today,
+                "login_time": "09:00:00", "logout_time": None, "tasks": "", "task_notes": "",
+                "hours_worked": None,
+            })
+            clocked.append(names[i])
+        return call
+
+    def clock_out():
+        def call(i):
+            if i >= len(clocked):
+                raise StopIteration
+            return timesheets.update_entry(clocked[i], today, expected={"logout_time": None},
+                                           logout_time="17:30:00", hours_worked=8.5)
+        return call
+
+    def admin_dashboard():
+        def call(i):
+            views = get_views()
+            views.count("tasks_total")
+            views.count("tasks_by_status", ["Completed"])
+            views.count("leaves_by_status", ["Pending"])
+            views.total("hours_total")
+            task_status_pie(), task_severity_bar(), employee_hours_bar()
+        return call
+
+    def employee_dashboard():
+        names = employees()
+
+        def call(i):
+            name = names[i % len(names)]
+            tasks.find(assigned_to=name)
+            leaves.find(employee=name)
+            my_daily_hours(name)
+            my_task_status_pie(name), my_daily_hours_line(name)
+        return call
+
+    def payroll_report():
+        end = pd.Timestamp.today().normalize()
+
+        def call(i):
+            build_report(end - pd.Timedelta(days=30), end)
+        return call
+
+    return {
+        "check_password": lambda: login(employees()),
+        "create_user": new_user,
+        "task_status_update": task_status,
+        "leave_approval": approve_leave,
+        "clock_in": clock_in,
+        "clock_out": clock_out,
+        "admin_dashboard": admin_dashboard,
+        "employee_dashboard": employee_dashboard,
+        "payroll_report": payroll_report,
+    }
+
+
+def cmd_run(args):
+    marker = os.path.join(DATA_DIR, MARKER)
+    if not os.path.exists(marker):
+        raise SystemExit(f"{DATA_DIR} holds no generated data; run `benchmark.py generate` "
+                         f"with the same TASKTRACKER_DATA_DIR first")
+    with open(marker) as f:
+        generated = json.load(f)
+    began = time.perf_counter()
+    initialize_database()
+    for table in TABLES:
+        get_store(table).all()
+    startup = round((time.perf_counter() - began) * 1000, 3)
+    print(f"{'startup':22} {startup:9.2f} ms  rss {peak_rss_mb()} MB")
+
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    for name, setup in benchmarks(rng).items():
+        if args.only and name not in args.only:
+            continue
+        result = measure(name, setup(), args.repeat, args.max_seconds)
+        if result is not None:
+            results[name] = result
+    report = {
+        "generated": generated,
+        "backend": STORAGE_BACKEND,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "when": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "startup_ms": startup,
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.json}")
+    return 0
+
+
+def cmd_compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    for field in ("generated", "backend"):
+        if before.get(field) != after.get(field):
+            print(f"Note: {field} differs: {before.get(field)} vs {after.get(field)}")
+    slower = 0
+    for name, new in after["results"].items():
+        old = before["results"].get(name)
+        if old is None:
+            continue
+        change = new["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+        flag = change > args.threshold
+        slower += flag
+        print(f"{name:22} p50 {old['p50_ms']:9.2f} -> {new['p50_ms']:9.2f} ms  "
+              f"{change:+7.1%}{'  SLOWER' if flag else ''}")
+    return 1 if slower else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the task tracker on synthetic data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="write synthetic tables to TASKTRACKER_DATA_DIR")
+    gen.add_argument("--scale", type=int, default=100000, help="timesheet rows")
+    gen.add_argument("--users", type=int, help="employees (default: scale / 250)")
+    gen.add_argument("--tasks", type=int, help="tasks (default: scale / 20)")
+    gen.add_argument("--leaves", type=int, help="leave requests (default: scale / 50)")
+    gen.add_argument("--days", type=int, default=365, help="days of history, up to yesterday")
+    gen.add_argument("--force", action="store_true", help="replace tables already there")
+    gen.set_defaults(func=cmd_generate)
+
+    run = commands.add_parser("run", help="time the app's code paths on the generated data")
+    run.add_argument("--repeat", type=int, default=200, help="calls per benchmark")
+    run.add_argument("--max-seconds", type=float, default=10.0,
+                     help="stop a benchmark after this long, whatever --repeat says")
+    run.add_argument("--only", action="append", help="run only this benchmark (repeatable)")
+    run.add_argument("--json", help="write the results here")
+    run.set_defaults(func=cmd_run)
+
+    for command in (gen, run):
+        command.add_argument("--seed", type=int, default=0)
+
+    cmp = commands.add_parser("compare", help="compare two --json results")
+    cmp.add_argument("before")
+    cmp.add_argument("after")
+    cmp.add_argument("--threshold", type=float, default=0.2,
+                     help="median slowdown that counts as a regression (0.2 = 20%%)")
+    cmp.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""Bulk import and export of the task tracker tables.
+
+    python bulk.py import users new_hires.csv
+    python bulk.py import timesheets march.parquet --chunk-size 100000
+    python bulk.py export timesheets out.jsonl --employee john_doe --from 2025-01-01
+    python bulk.py report 2025-01-01 2025-01-31 payroll.xlsx
+    python bulk.py archive --open-months 2
+    python bulk.py tenant sales
+    python bulk.py --tenant sales import users sales_staff.csv
+
+Input and output formats are picked from the file extension: .csv,
+.jsonl, .parquet or .arrow (the last two need pyarrow). Files are read
+and written in chunks, so memory stays bounded by --chunk-size rather
+than the file size.
+
+Imports validate every row (required columns, enum values, dates,
+numbers) and skip rows whose primary key is already in the table or
+earlier in the file; rejected rows are listed on stderr or written to
+--rejects. Plain-text passwords in a users file are hashed in a process
+pool. All accepted rows go in as one commit.
+
+`archive` moves timesheet months older than --open-months (default
+TASKTRACKER_OPEN_MONTHS) to the compressed monthly archive.
+
+`tenant` creates a department's shard (data/tenants/<name>, with its own
+admin/admin account); --tenant makes any command work on that shard
+instead of the main data directory.
+
+Reports (see utils/reports.py) are written as .xlsx with one sheet per
+section, or as one <name>_<section>.csv per section.
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from utils.auth import hash_password
+from utils.database import (
+    DATE, OPEN_MONTHS, TABLES, _require_pyarrow, archive_closed_months, coerce_types,
+    get_store, initialize_database, list_tenants, plain_records, table_columns,
+)
+from utils.reports import SECTIONS, build_report, excel_engine
+from utils.tenants import DEFAULT_TENANT, check_tenant, set_tenant
+
+CHUNK_SIZE = 50000
+# Columns an imported row must have besides the key
+REQUIRED = {
+    "users": ("password", "role"),
+    "tasks": ("title",),
+    "leaves": ("employee", "start_date", "end_date"),
+    "timesheets": ("employee", "date"),
+    "alerts": ("kind", "ref"),
+}
+# Date column the --from/--to export filters apply to
+DATE_COLUMNS = {"tasks": "deadline", "leaves": "start_date", "timesheets": "date",
+                "alerts": "created"}
+EMPLOYEE_COLUMNS = {"tasks": "assigned_to", "leaves": "employee", "timesheets": "employee",
+                    "alerts": "employee"}
+
+
+def _file_format(path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".")
+    if fmt not in ("csv", "jsonl", "parquet", "arrow"):
+        raise SystemExit(f"Unknown file format {fmt!r}; use csv, jsonl, parquet or arrow")
+    return fmt
+
+
+def read_chunks(path, fmt, chunk_size):
+    """Yield the file as DataFrames of at most chunk_size rows"""
+    if fmt == "csv":
+        yield from pd.read_csv(path, dtype=str, keep_default_na=False,
+                               na_values=[""], chunksize=chunk_size)
+    elif fmt == "jsonl":
+        yield from pd.read_json(path, lines=True, dtype=False, chunksize=chunk_size)
+    elif fmt == "parquet":
+        pa = _require_pyarrow()
+        for batch in pa.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        pa = _require_pyarrow()
+        with pa.ipc.open_file(path) as reader:
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
+
+
+def validate(table, chunk):
+    """Split a raw chunk into typed valid rows and (row, reason) rejects"""
+    columns = table_columns(table)
+    raw = chunk.reindex(columns=columns)
+    df = coerce_types(table, raw.copy())
+    problems = pd.Series("", index=raw.index)
+
+    def flag(mask, reason):
+        problems[mask & (problems == "")] = reason
+
+    for column in (TABLES[table]["key"],) + REQUIRED[table]:
+        flag(raw[column].isna() | (raw[column].astype(str).str.strip() == ""), f"missing {column}")
+    for column, dtype in TABLES[table]["dtypes"].items():
+        given = raw[column].notna()
+        if isinstance(dtype, pd.CategoricalDtype):
+            flag(given & ~raw[column].isin(dtype.categories), f"invalid {column}")
+        elif dtype == DATE or dtype == "float64":
+            flag(given & df[column].isna(), f"invalid {column}")
+        elif dtype == "bool":
+            text = raw[column].astype(str).str.lower()
+            flag(given & ~text.isin(["true", "false", "1", "0", "1.0", "0.0"]), f"invalid {column}")
+    bad = problems != ""
+    rejects = list(zip(chunk.index[bad], problems[bad]))
+    return df[~bad], rejects
+
+
+def import_rows(table, path, fmt, chunk_size, hashed, pool, report):
+    """Generator of validated, de-duplicated row-dict chunks for Store.bulk_insert"""
+    key = TABLES[table]["key"]
+    seen = set(get_store(table).all()[key].dropna())
+    start = 0
+    for chunk in read_chunks(path, fmt, chunk_size):
+        # Number rows from the start of the file, whatever the reader did
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        rows, rejects = validate(table, chunk)
+        keys = rows[key].tolist()
+        # Set lookups per key: Series.isin() would re-scan `seen` every chunk
+        duplicate = pd.Series([k in seen for k in keys], index=rows.index, dtype=bool)
+        duplicate |= rows[key].duplicated()
+        rejects += [(i, f"duplicate {key}") for i in rows.index[duplicate]]
+        rows = rows[~duplicate]
+        seen.update(k for k, dup in zip(keys, duplicate) if not dup)
+        report(rejects, len(rows))
+        if rows.empty:
+            continue
+        records = plain_records(rows)
+        if table == "users" and not hashed:
+            hashes = pool.map(hash_password, [r["password"] for r in records], chunksize=64)
+            for record, password in zip(records, hashes):
+                record["password"] = password
+        yield records
+
+
+def cmd_import(args):
+    fmt = _file_format(args.path, args.format)
+    rejects_file = open(args.rejects, "w") if args.rejects else sys.stderr
+    counts = {"accepted": 0, "rejected": 0}
+
+    def report(rejects, accepted):
+        counts["accepted"] += accepted
+        counts["rejected"] += len(rejects)
+        for row, reason in rejects:
+            # +2: header line and 1-based numbering, for CSV input
+            rejects_file.write(f"row {row + 2 if fmt == 'csv' else row + 1}: {reason}\n")
+        print(f"\r{counts['accepted']} rows accepted, {counts['rejected']} rejected",
+              end="", file=sys.stderr, flush=True)
+
+    with ProcessPoolExecutor() as pool:
+        chunks = import_rows(args.table, args.path, fmt, args.chunk_size,
+                             args.hashed, pool, report)
+        inserted = get_store(args.table).bulk_insert(chunks)
+    print(file=sys.stderr)
+    print(f"Imported {inserted} {args.table} rows ({counts['rejected']} rejected)")
+    if args.rejects:
+        rejects_file.close()
+    return 1 if counts["rejected"] and args.strict else 0
+
+
+def export_chunks(table, args):
+    """The rows matching the export filters as an iterator of chunks,
+    archived months included"""
+    store = get_store(table)
+    query = {}
+    if args.employee:
+        if table not in EMPLOYEE_COLUMNS:
+            raise SystemExit(f"--employee does not apply to {table}")
+        query[EMPLOYEE_COLUMNS[table]] = args.employee
+    if args.date_from or args.date_to:
+        if table not in DATE_COLUMNS:
+            raise SystemExit(f"--from/--to do not apply to {table}")
+        bounds = [pd.Timestamp(d) if d else None for d in (args.date_from, args.date_to)]
+        query["ranges"] = {DATE_COLUMNS[table]: tuple(bounds)}
+    return store.scan(chunk_size=args.chunk_size, **query)
+
+
+def _arrow_schema(table):
+    pa = _require_pyarrow()
+    types = {DATE: pa.timestamp("ns"), "float64": pa.float64(), "bool": pa.bool_()}
+    return pa.schema([
+        (c, types.get(TABLES[table]["dtypes"].get(c), pa.string()))
+        for c in table_columns(table)
+    ])
+
+
+def cmd_export(args):
+    fmt = _file_format(args.path, args.format)
+    count = 0
+    writer = None
+    with open(args.path, "w" if fmt in ("csv", "jsonl") else "wb") as f:
+        for rows in export_chunks(args.table, args):
+            if fmt == "csv":
+                rows.to_csv(f, index=False, header=count == 0, date_format="%Y-%m-%d")
+            elif fmt == "jsonl":
+                for record in plain_records(rows):
+                    f.write(json.dumps(record) + "\n")
+            else:
+                pa = _require_pyarrow()
+                schema = _arrow_schema(args.table)
+                if writer is None:
+                    writer = (pa.parquet.ParquetWriter(f, schema) if fmt == "parquet"
+                              else pa.ipc.new_file(f, schema))
+                # Enum columns go out as plain strings, like in CSV
+                plain = rows.astype({c: object for c, t in rows.dtypes.items()
+                                     if isinstance(t, pd.CategoricalDtype)})
+                writer.write_table(pa.Table.from_pandas(plain, schema=schema, preserve_index=False))
+            count += len(rows)
+        if writer is None and fmt in ("parquet", "arrow"):
+            # No rows: still leave a readable file with the table's columns
+            pa = _require_pyarrow()
+            schema = _arrow_schema(args.table)
+            writer = (pa.parquet.ParquetWriter(f, schema) if fmt == "parquet"
+                      else pa.ipc.new_file(f, schema))
+        if writer is not None:
+            writer.close()
+    print(f"Exported {count} {args.table} rows to {args.path}")
+    return 0
+
+
+def cmd_report(args):
+    report = build_report(args.start, args.end, args.employee)
+    stem, ext = os.path.splitext(args.path)
+    if ext == ".xlsx":
+        if excel_engine() is None:
+            raise SystemExit("Excel reports need openpyxl (pip install openpyxl)")
+        with open(args.path, "wb") as f:
+            f.write(report.to_excel())
+        print(f"Wrote {args.path}")
+        return 0
+    if ext != ".csv":
+        raise SystemExit("Report path must end in .xlsx or .csv")
+    for section in [args.section] if args.section else SECTIONS:
+        path = args.path if args.section else f"{stem}_{section}.csv"
+        with open(path, "w", newline="") as f:
+            f.write(report.to_csv(section))
+        print(f"Wrote {path}")
+    return 0
+
+
+def cmd_archive(args):
+    for table, spec in TABLES.items():
+        if "partition" in spec:
+            moved = archive_closed_months(table, args.open_months)
+            print(f"Archived {moved} {table} rows")
+    return 0
+
+
+def cmd_tenant(args):
+    initialize_database(args.name)
+    print(f"Tenant {args.name} is ready; log in as admin/admin and change the password")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import/export of task tracker tables")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT,
+                        help="work on this tenant's shard (default: the main data directory)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    imp = commands.add_parser("import", help="load rows from a file into a table")
+    imp.add_argument("table", choices=list(TABLES))
+    imp.add_argument("path")
+    imp.add_argument("--hashed", action="store_true",
+                     help="users file already holds password hashes")
+    imp.add_argument("--rejects", help="write rejected rows here instead of stderr")
+    imp.add_argument("--strict", action="store_true", help="exit 1 if any row was rejected")
+    imp.set_defaults(func=cmd_import)
+
+    exp = commands.add_parser("export", help="write a table (or part of it) to a file")
+    exp.add_argument("table", choices=list(TABLES))
+    exp.add_argument("path")
+    exp.add_argument("--employee", help="only rows for this employee")
+    exp.add_argument("--from", dest="date_from", help="first date, YYYY-MM-DD")
+    exp.add_argument("--to", dest="date_to", help="last date, YYYY-MM-DD")
+    exp.set_defaults(func=cmd_export)
+
+    rep = commands.add_parser("report", help="write a payroll report for a period")
+    rep.add_argument("start", help="first day, YYYY-MM-DD")
+    rep.add_argument("end", help="last day, YYYY-MM-DD")
+    rep.add_argument("path", help=".xlsx, or .csv for one file per section")
+    rep.add_argument("--employee", action="append", help="only this employee (repeatable)")
+    rep.add_argument("--section", choices=list(SECTIONS), help="write only this section (CSV)")
+    rep.set_defaults(func=cmd_report)
+
+    arc = commands.add_parser("archive", help="move closed months to the archive")
+    arc.add_argument("--open-months", type=int, default=OPEN_MONTHS,
+                     help="months to keep live, the current one included")
+    arc.set_defaults(func=cmd_archive)
+
+    ten = commands.add_parser("tenant", help="create a tenant's data shard")
+    ten.add_argument("name", type=check_tenant)
+    ten.set_defaults(func=cmd_tenant)
+
+    for command in (imp, exp):
+        command.add_argument("--format", choices=["csv", "jsonl", "parquet", "arrow"],
+                             help="file format (default: from the extension)")
+        command.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+
+    args = parser.parse_args(argv)
+    try:
+        set_tenant(args.tenant)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.tenant != DEFAULT_TENANT and args.tenant not in list_tenants():
+        parser.error(f"Unknown tenant {args.tenant!r}; create it with: bulk.py tenant {args.tenant}")
+    initialize_database()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,18 @@
+import json
 import streamlit as st
-import pandas as pd
-from utils.auth import check_password, create_user, reset_password
-from utils.database import initialize_database
+import streamlit.components.v1 as components
+from utils.auth import (
+    SESSION_HOURS, TENANT_KEY, activate_session_tenant, authenticate, check_password,
+    create_user, reset_password, issue_token, revoke_sessions, verify_token,
+)
+from utils.database import initialize_database, list_tenants
+from utils.metrics import page
+from utils.ratelimit import RateLimitError, client_id
+from utils.scheduler import start_scheduler
+from utils.tenants import DEFAULT_TENANT, current_tenant, set_tenant
+
+# Cookie holding the signed session token (see utils/auth.py)
+SESSION_COOKIE = "tasktracker_session"
 
 # Page configuration
 st.set_page_config(
@@ -87,9 +98,14 @@ if 'show_reset' not in st.session_state:
     st.session_state.show_reset = False
 if 'active_tab' not in st.session_state:
     st.session_state.active_tab = "Login"
+if TENANT_KEY not in st.session_state:
+    st.session_state[TENANT_KEY] = DEFAULT_TENANT
 
-# Initialize database
+# Initialize database (the shard of the session's tenant)
+activate_session_tenant()
 initialize_database()
+# Overdue tasks, pending leaves and forgotten logouts, checked in the background
+start_scheduler()
 
 def reset_password_form():
     st.subheader("Reset Admin Password")
@@ -103,7 +119,7 @@ def reset_password_form():
             if new_password != confirm_password:
                 st.error("New passwords don't match!")
                 return
-            if check_password("admin", current_password):
+            if check_password("admin", current_password, client_id()):
                 success = reset_password("admin", new_password)
                 if success:
                     st.success("Password reset successful! Please login with new password.")
@@ -114,6 +130,16 @@ def reset_password_form():
             else:
                 st.error("Current password is incorrect!")
 
+def choose_tenant():
+    """Department picker above the login forms, once there are tenants
+    besides the default one; the forms then work on its shard"""
+    tenants = list_tenants()
+    if tenants:
+        tenant = st.selectbox("Department", [DEFAULT_TENANT] + tenants,
+                              format_func=lambda t: t or "Main", key="login_tenant")
+        set_tenant(tenant)
+        initialize_database()
+
 def login_form():
     with st.form("login_form", clear_on_submit=True):
         st.subheader("Login")
@@ -129,15 +155,19 @@ def login_form():
 
         if submitted:
             try:
-                if check_password(username, password):
-                    user_data = pd.read_csv("data/users.csv")
-                    user = user_data[user_data['username'] == username].iloc[0]
+                role = authenticate(username, password, client_id())
+                if role is not None:
                     st.session_state.authenticated = True
-                    st.session_state.user_role = user['role']
+                    st.session_state.user_role = role
                     st.session_state.username = username
+                    st.session_state[TENANT_KEY] = current_tenant()
+                    # Lets a reconnecting browser resume without logging in again
+                    st.session_state.session_cookie = issue_token(username)
                     st.rerun()
                 else:
                     st.error("Invalid username or password")
+            except RateLimitError as e:
+                st.error(str(e))
             except Exception as e:
                 st.error(f"An error occurred during login. Please try again.")
 
@@ -168,9 +198,43 @@ def register_form():
             else:
                 st.error(message)
 
+def write_session_cookie(token):
+    """Keep the session token in a cookie rather than the URL, where it
+    would end up in history and shared links; None clears it. Streamlit
+    cannot set cookies, so a hidden component does it."""
+    max_age = int(SESSION_HOURS * 3600) if token else 0
+    cookie = f"{SESSION_COOKIE}={token or ''}; Max-Age={max_age}; Path=/; SameSite=Strict"
+    script = (
+        f"<script>document.cookie = {json.dumps(cookie)}"
+        " + (window.parent.location.protocol === 'https:' ? '; Secure' : '');</script>"
+    )
+    if hasattr(st, "iframe"):
+        st.iframe(script, height=1)  # streamlit versions that retire components.html
+    else:
+        components.html(script, height=0)
+
+def restore_session():
+    """Log in from a signed session token in the cookie, if there is a valid one"""
+    if "session_cookie" in st.session_state:
+        write_session_cookie(st.session_state.pop("session_cookie"))
+    if "session" in st.query_params:
+        # Left by earlier versions, which kept the token in the URL
+        del st.query_params["session"]
+    token = st.context.cookies.get(SESSION_COOKIE)
+    if token and not st.session_state.authenticated:
+        session = verify_token(token)
+        if session is not None:
+            st.session_state.authenticated = True
+            st.session_state.username, st.session_state.user_role, tenant = session
+            st.session_state[TENANT_KEY] = tenant
+            activate_session_tenant()
+
+@page
 def main():
+    restore_session()
     if not st.session_state.authenticated:
         st.title("Employee Management System")
+        choose_tenant()
 
         if st.session_state.show_reset:
             reset_password_form()
@@ -192,10 +256,16 @@ def main():
                     register_form()
     else:
         st.sidebar.title(f"Welcome, {st.session_state.username}")
+        if st.session_state[TENANT_KEY]:
+            st.sidebar.caption(f"Department: {st.session_state[TENANT_KEY]}")
         if st.sidebar.button("Logout", key="logout"):
+            # Also ends the session in other tabs and for any copy of the token
+            revoke_sessions(st.session_state.username)
             st.session_state.authenticated = False
             st.session_state.user_role = None
             st.session_state.username = None
+            st.session_state[TENANT_KEY] = DEFAULT_TENANT
+            st.session_state.session_cookie = None
             st.rerun()
 
         if st.session_state.user_role == "admin":
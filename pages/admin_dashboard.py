@@ -3,45 +3,60 @@ import pandas as pd
 import plotly.express as px
 from datetime import datetime
 import uuid
-from utils.auth import create_user
+from utils.auth import activate_session_tenant, create_user
+from utils.database import get_store, StaleWriteError, date_str
+from utils.models import Leave, Task, User
+from utils.aggregates import get_views
+from utils.pagination import paginate, task_filters, bulk_select
+from utils.reports import SECTIONS, excel_engine, get_report
+from utils.leaves import get_calendar, team_size
+from utils.charts import employee_hours_bar, task_severity_bar, task_status_pie
+from utils.metrics import page, timed
+from utils.search import search
+from utils.live import live, notify_changes, refresh
 
+@page
 def load_admin_dashboard():
-    # Load data
-    tasks_df = pd.read_csv("data/tasks.csv")
-    leaves_df = pd.read_csv("data/leaves.csv")
-    timesheets_df = pd.read_csv("data/timesheets.csv")
-    users_df = pd.read_csv("data/users.csv")
-
     # Sidebar navigation
     st.sidebar.header("Admin Controls")
     page = st.sidebar.selectbox(
         "Select Page",
-        ["Dashboard Overview", "Employee Management", "Task Approvals", "Leave Management"]
+        ["Dashboard Overview", "Employee Management", "Task Approvals", "Leave Management",
+         "Payroll Reports", "Search"]
     )
 
     if page == "Dashboard Overview":
-        display_dashboard_overview(tasks_df, leaves_df, timesheets_df)
+        display_dashboard_overview()
     elif page == "Employee Management":
-        manage_employees(users_df)
+        manage_employees()
     elif page == "Task Approvals":
-        manage_task_approvals(tasks_df)
+        manage_task_approvals()
     elif page == "Leave Management":
-        manage_leave_requests(leaves_df)
+        manage_leave_requests()
+    elif page == "Payroll Reports":
+        display_payroll_reports()
+    elif page == "Search":
+        display_search()
 
-def display_dashboard_overview(tasks_df, leaves_df, timesheets_df):
+@live
+@timed
+def display_dashboard_overview():
+    notify_changes(["tasks", "leaves", "timesheets", "alerts"])
     st.header("Dashboard Overview")
+    views = get_views()
 
     # Create metrics row
     col1, col2, col3, col4 = st.columns(4)
 
     with col1:
-        st.metric("Total Tasks", len(tasks_df))
+        st.metric("Total Tasks", views.count("tasks_total"))
     with col2:
-        st.metric("Pending Tasks", len(tasks_df[tasks_df['status'] != 'Completed']))
+        pending = views.count("tasks_total") - views.count("tasks_by_status", ["Completed"])
+        st.metric("Pending Tasks", pending)
     with col3:
-        st.metric("Pending Leaves", len(leaves_df[leaves_df['status'] == 'Pending']))
+        st.metric("Pending Leaves", views.count("leaves_by_status", ["Pending"]))
     with col4:
-        total_hours = timesheets_df['hours_worked'].sum()
+        total_hours = views.total("hours_total")
         st.metric("Total Hours Logged", f"{total_hours:.1f}")
 
     # Task Status Distribution
@@ -49,34 +64,43 @@ def display_dashboard_overview(tasks_df, leaves_df, timesheets_df):
 
     with col1:
         st.subheader("Task Status Distribution")
-        if not tasks_df.empty:
-            status_counts = tasks_df['status'].value_counts()
-            fig = px.pie(values=status_counts.values, 
-                        names=status_counts.index, 
-                        title="Task Status Distribution",
-                        color_discrete_sequence=px.colors.sequential.Blues)
+        fig = task_status_pie()
+        if fig is not None:
             st.plotly_chart(fig)
 
         # Severity Distribution
-        severity_counts = tasks_df['severity'].value_counts()
-        fig = px.bar(x=severity_counts.index, 
-                     y=severity_counts.values,
-                     title="Task Severity Distribution",
-                     color_discrete_sequence=['#2596be'])
-        st.plotly_chart(fig)
+        st.plotly_chart(task_severity_bar())
 
     with col2:
         st.subheader("Employee Performance")
-        if not timesheets_df.empty:
-            employee_hours = timesheets_df.groupby('employee')['hours_worked'].sum().reset_index()
-            fig = px.bar(employee_hours, 
-                         x='employee', 
-                         y='hours_worked',
-                         title="Total Hours Worked by Employee",
-                         color_discrete_sequence=['#2596be'])
+        fig = employee_hours_bar()
+        if fig is not None:
             st.plotly_chart(fig)
 
-def manage_employees(users_df):
+    display_alerts()
+
+# Headings of the alert kinds raised by the scheduled jobs
+ALERT_TITLES = {
+    "overdue_task": "Overdue tasks",
+    "pending_leave": "Leave requests waiting too long",
+    "closed_session": "Sessions closed without a logout",
+}
+
+def display_alerts():
+    alerts = get_store("alerts").all()
+    if alerts.empty:
+        return
+    st.subheader("Needs Attention")
+    for kind, title in ALERT_TITLES.items():
+        rows = alerts[alerts["kind"] == kind]
+        if not rows.empty:
+            with st.expander(f"{title} ({len(rows)})", expanded=False):
+                st.dataframe(rows.sort_values("created", ascending=False)[["employee", "message", "created"]],
+                             hide_index=True,
+                             column_config={"created": st.column_config.DateColumn("created")})
+
+@timed
+def manage_employees():
     st.header("Employee Management")
 
     # Employee Creation Form
@@ -91,7 +115,7 @@ def manage_employees(users_df):
                     success, message = create_user(new_username, new_password, "employee")
                     if success:
                         st.success(f"Employee {new_username} created successfully!")
-                        st.rerun()
+                        refresh()
                     else:
                         st.error(message)
                 else:
@@ -99,81 +123,242 @@ def manage_employees(users_df):
 
     # Employee List
     st.subheader("Employee List")
-    employees = users_df[users_df['role'] == 'employee']
+    employees = paginate(get_store("users"), "employees", role='employee', order_by='username')
     if not employees.empty:
-        for _, employee in employees.iterrows():
-            with st.expander(f"Employee: {employee['username']}"):
+        for employee in User.from_frame(employees):
+            with st.expander(f"Employee: {employee.username}"):
                 col1, col2, col3 = st.columns(3)
                 with col1:
-                    st.write("Role:", employee['role'])
+                    st.write("Role:", employee.role)
                 with col2:
                     st.write("Status: Active")
                 with col3:
-                    if st.button(f"Reset Password ({employee['username']})", key=f"reset_{employee['username']}"):
+                    if st.button(f"Reset Password ({employee.username})", key=f"reset_{employee.username}"):
                         # Implement password reset logic
                         st.info("Password reset functionality to be implemented")
 
-def manage_task_approvals(tasks_df):
+@live
+@timed
+def manage_task_approvals():
+    notify_changes(["tasks"])
     st.header("Task Approvals")
 
-    pending_tasks = tasks_df[
-        (tasks_df['approved'] == False) & 
-        (tasks_df['created_by'] != 'admin')
-    ]
+    query = task_filters("approvals", assignees=get_store("users").usernames('employee'))
+    pending_tasks = Task.from_frame(paginate(get_store("tasks"), "approvals", approved=False,
+                                             exclude={'created_by': 'admin'}, **query))
 
-    if not pending_tasks.empty:
-        for _, task in pending_tasks.iterrows():
-            with st.expander(f"Task: {task['title']}"):
-                st.write(f"Created by: {task['created_by']}")
-                st.write(f"Description: {task['description']}")
-                st.write(f"Severity: {task['severity']}")
-                st.write(f"Deadline: {task['deadline']}")
+    if pending_tasks:
+        with st.expander("Bulk actions", expanded=False):
+            selected = bulk_select(pending_tasks, lambda t: f"{t.title} ({t.created_by})",
+                                   "approvals")
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("Approve selected", disabled=not selected):
+                    try:
+                        count = get_store("tasks").update_many(selected, expected={'approved': False}, approved=True)
+                        st.success(f"{count} tasks approved!")
+                        refresh()
+                    except StaleWriteError as e:
+                        st.warning(str(e))
+            with col2:
+                if st.button("Reject selected", disabled=not selected):
+                    try:
+                        count = get_store("tasks").delete_many(selected, expected={'approved': False})
+                        st.error(f"{count} tasks rejected!")
+                        refresh()
+                    except StaleWriteError as e:
+                        st.warning(str(e))
+
+        for task in pending_tasks:
+            with st.expander(f"Task: {task.title}"):
+                st.write(f"Created by: {task.created_by}")
+                st.write(f"Description: {task.description}")
+                st.write(f"Severity: {task.severity}")
+                st.write(f"Deadline: {date_str(task.deadline)}")
 
                 col1, col2 = st.columns(2)
                 with col1:
-                    if st.button(f"Approve Task #{task['task_id']}", key=f"approve_{task['task_id']}"):
-                        tasks_df.loc[tasks_df['task_id'] == task['task_id'], 'approved'] = True
-                        tasks_df.to_csv("data/tasks.csv", index=False)
-                        st.success("Task approved!")
-                        st.rerun()
+                    if st.button(f"Approve Task #{task.task_id}", key=f"approve_{task.task_id}"):
+                        try:
+                            get_store("tasks").update(task.task_id, expected={'approved': False}, approved=True)
+                            st.success("Task approved!")
+                            refresh()
+                        except StaleWriteError as e:
+                            st.warning(str(e))
                 with col2:
-                    if st.button(f"Reject Task #{task['task_id']}", key=f"reject_{task['task_id']}"):
+                    if st.button(f"Reject Task #{task.task_id}", key=f"reject_{task.task_id}"):
                         # Remove the task instead of keeping it as rejected
-                        tasks_df = tasks_df[tasks_df['task_id'] != task['task_id']]
-                        tasks_df.to_csv("data/tasks.csv", index=False)
-                        st.error("Task rejected!")
-                        st.rerun()
+                        try:
+                            get_store("tasks").delete(task.task_id, expected={'approved': False})
+                            st.error("Task rejected!")
+                            refresh()
+                        except StaleWriteError as e:
+                            st.warning(str(e))
     else:
         st.info("No pending task approvals")
 
-def manage_leave_requests(leaves_df):
+def display_leave_calendar(calendar):
+    today = datetime.today().date()
+    next_monday = today + pd.Timedelta(days=7 - today.weekday())
+    period = st.date_input("Period", value=[next_monday, next_monday + pd.Timedelta(days=6)],
+                           key="calendar_period")
+    if len(period) != 2:
+        return
+    out = calendar.out(period[0], period[1])
+    if out.empty:
+        st.info("Nobody is on approved leave in this period")
+    else:
+        st.dataframe(out.drop(columns=['leave_id', 'status']), hide_index=True,
+                     column_config={"start_date": st.column_config.DateColumn("start_date"),
+                                    "end_date": st.column_config.DateColumn("end_date")})
+        headcount = calendar.headcount(period[0], period[1]).reset_index()
+        fig = px.bar(headcount, x='date', y='on_leave', title="Employees on Leave per Day",
+                     color_discrete_sequence=['#2596be'])
+        st.plotly_chart(fig)
+    overlaps = calendar.overlaps()
+    if not overlaps.empty:
+        st.warning(f"{len(overlaps)} requests overlap another request of the same employee")
+        st.dataframe(overlaps, hide_index=True,
+                     column_config={"start_date": st.column_config.DateColumn("start_date"),
+                                    "end_date": st.column_config.DateColumn("end_date")})
+
+@live
+@timed
+def manage_leave_requests():
+    notify_changes(["leaves"])
     st.header("Leave Management")
+    calendar = get_calendar()
+    employees = team_size()
+
+    with st.expander("Leave calendar", expanded=False):
+        display_leave_calendar(calendar)
 
-    pending_leaves = leaves_df[leaves_df['status'] == 'Pending']
-    if not pending_leaves.empty:
-        for _, leave in pending_leaves.iterrows():
-            with st.expander(f"Leave Request: {leave['employee']}"):
-                st.write(f"Type: {leave['leave_type']}")
-                st.write(f"Duration: {leave['start_date']} to {leave['end_date']}")
-                st.write(f"Reason: {leave['reason']}")
+    query = {}
+    with st.expander("Filter and sort", expanded=False):
+        employee = st.selectbox("Employee", ["All"] + get_store("users").usernames('employee'))
+        if employee != "All":
+            query['employee'] = employee
+        dates = st.date_input("Starting between", value=[], key="leaves_start")
+        if len(dates) == 2:
+            query['ranges'] = {'start_date': (dates[0], dates[1])}
+    pending_leaves = Leave.from_frame(paginate(get_store("leaves"), "pending_leaves",
+                                               status='Pending', order_by='start_date', **query))
+    if pending_leaves:
+        with st.expander("Bulk actions", expanded=False):
+            selected = bulk_select(
+                pending_leaves,
+                lambda l: f"{l.employee}: {date_str(l.start_date)} to {date_str(l.end_date)}",
+                "pending_leaves")
+            col1, col2 = st.columns(2)
+            for col, action, status in ((col1, "Approve", 'Approved'), (col2, "Reject", 'Rejected')):
+                with col:
+                    if st.button(f"{action} selected", disabled=not selected):
+                        try:
+                            count = get_store("leaves").update_many(selected, expected={'status': 'Pending'}, status=status)
+                            st.success(f"{count} leave requests {status.lower()}!")
+                            refresh()
+                        except StaleWriteError as e:
+                            st.warning(str(e))
+
+        for leave in pending_leaves:
+            with st.expander(f"Leave Request: {leave.employee}"):
+                st.write(f"Type: {leave.leave_type}")
+                st.write(f"Duration: {date_str(leave.start_date)} to {date_str(leave.end_date)}")
+                st.write(f"Reason: {leave.reason}")
+                review = calendar.review(leave.leave_id, employees)
+                if review is not None:
+                    st.write(f"Working days: {review['working_days']}")
+                    if review['remaining'] is not None:
+                        st.write(f"{leave.leave_type} days left if approved: {review['remaining']}")
+                    if review['overlaps']:
+                        st.warning(f"Overlaps the employee's requests {', '.join(review['overlaps'])}")
+                    if review['short_staffed']:
+                        st.warning(f"{review['peak_out']} of {employees} employees would be out on the busiest day")
 
                 col1, col2 = st.columns(2)
                 with col1:
-                    if st.button(f"Approve #{leave['leave_id']}", key=f"approve_leave_{leave['leave_id']}"):
-                        leaves_df.loc[leaves_df['leave_id'] == leave['leave_id'], 'status'] = 'Approved'
-                        leaves_df.to_csv("data/leaves.csv", index=False)
-                        st.success("Leave approved!")
-                        st.rerun()
+                    if st.button(f"Approve #{leave.leave_id}", key=f"approve_leave_{leave.leave_id}"):
+                        try:
+                            get_store("leaves").update(leave.leave_id, expected={'status': 'Pending'}, status='Approved')
+                            st.success("Leave approved!")
+                            refresh()
+                        except StaleWriteError as e:
+                            st.warning(str(e))
                 with col2:
-                    if st.button(f"Reject #{leave['leave_id']}", key=f"reject_leave_{leave['leave_id']}"):
-                        leaves_df.loc[leaves_df['leave_id'] == leave['leave_id'], 'status'] = 'Rejected'
-                        leaves_df.to_csv("data/leaves.csv", index=False)
-                        st.error("Leave rejected!")
-                        st.rerun()
+                    if st.button(f"Reject #{leave.leave_id}", key=f"reject_leave_{leave.leave_id}"):
+                        try:
+                            get_store("leaves").update(leave.leave_id, expected={'status': 'Pending'}, status='Rejected')
+                            st.error("Leave rejected!")
+                            refresh()
+                        except StaleWriteError as e:
+                            st.warning(str(e))
     else:
         st.info("No pending leave requests")
 
+@timed
+def display_payroll_reports():
+    st.header("Payroll Reports")
+
+    today = datetime.today().date()
+    col1, col2 = st.columns(2)
+    with col1:
+        period = st.date_input("Period", value=[today.replace(day=1), today], key="payroll_period")
+    with col2:
+        employees = st.multiselect("Employees (all if empty)", get_store("users").usernames('employee'))
+    if len(period) != 2:
+        st.info("Pick the first and last day of the period")
+        return
+
+    report = get_report(period[0], period[1], employees)
+    tabs = st.tabs(list(SECTIONS.values()))
+    for tab, (section, title) in zip(tabs, SECTIONS.items()):
+        with tab:
+            df = report[section]
+            if df.empty:
+                st.info(f"No rows for {title.lower()} in this period")
+            else:
+                st.dataframe(df, hide_index=True)
+            st.download_button(f"Download {title.lower()} (CSV)", report.to_csv(section),
+                               file_name=f"{section}_{period[0]}_{period[1]}.csv",
+                               mime="text/csv", key=f"payroll_csv_{section}")
+    if excel_engine():
+        st.download_button("Download full report (Excel)", report.to_excel(),
+                           file_name=f"payroll_{period[0]}_{period[1]}.xlsx",
+                           mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    else:
+        st.caption("Install openpyxl for Excel downloads.")
+
+# Searchable tables and the columns shown with their matches
+SEARCHES = {
+    "Tasks": ("tasks", ["title", "description", "assigned_to", "status", "deadline"]),
+    "Leave requests": ("leaves", ["employee", "start_date", "end_date", "leave_type", "status", "reason"]),
+    "Timesheets": ("timesheets", ["employee", "date", "hours_worked", "description", "task_notes"]),
+}
+
+@timed
+def display_search():
+    st.header("Search")
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        text = st.text_input("Search", key="admin_search",
+                             placeholder="Task titles and descriptions, leave reasons, timesheet notes")
+    with col2:
+        kind = st.selectbox("In", list(SEARCHES), key="admin_search_in")
+    if not text.strip():
+        return
+    table, columns = SEARCHES[kind]
+    results = search(table, text)
+    if results.empty:
+        st.info("No matches")
+        return
+    dates = {c: st.column_config.DateColumn(c) for c in ("deadline", "start_date", "end_date", "date")
+             if c in columns}
+    st.dataframe(results[columns], hide_index=True, column_config=dates)
+    if table == "timesheets":
+        st.caption("Only the open months (TASKTRACKER_OPEN_MONTHS) are searched.")
+
 if __name__ == "__main__":
+    activate_session_tenant()
     if st.session_state.get('user_role') == 'admin':
         load_admin_dashboard()
     else:
@@ -0,0 +1,91 @@
+import streamlit as st
+import pandas as pd
+from utils.metrics import (
+    ENABLED, PROFILE_RESULT, get_metrics, profile_next_run, prometheus_text, stats,
+)
+from utils.scheduler import get_scheduler
+from utils.auth import activate_session_tenant
+
+def display_timings():
+    metrics = get_metrics()
+    st.subheader("Timings")
+    if not ENABLED:
+        st.info("Timing is off. Start the app with TASKTRACKER_METRICS=1 to record "
+                "where each rerun's time goes.")
+        return
+    timings = metrics.timings()
+    if timings.empty:
+        st.caption("Nothing recorded yet.")
+    else:
+        st.dataframe(timings.round({"total_ms": 1, "mean_ms": 2, "max_ms": 2}), hide_index=True)
+    counters = metrics.counters()
+    if counters:
+        st.subheader("Counters")
+        st.dataframe(pd.DataFrame([
+            {"counter": name, **dict(labels), "value": value}
+            for (name, labels), value in sorted(counters.items())
+        ]), hide_index=True)
+    if st.button("Reset timings"):
+        metrics.reset()
+        st.rerun()
+
+def display_stats():
+    st.subheader("Caches and limiters")
+    for source, values in stats().items():
+        st.write(source.replace("_", " ").capitalize())
+        if values and all(isinstance(v, dict) for v in values.values()):
+            df = pd.DataFrame.from_dict(values, orient="index")
+        else:
+            df = pd.DataFrame([{k: v if isinstance(v, (int, float)) else str(v)
+                                for k, v in values.items()}])
+        st.dataframe(df)
+
+def display_profile():
+    st.subheader("Profile")
+    st.write("Profile your next page load: press the button, then open the page.")
+    if st.button("Profile next page load"):
+        profile_next_run()
+        st.success("The next page you open in this session will be profiled.")
+    result = st.session_state.get(PROFILE_RESULT)
+    if result:
+        st.caption(f"{result['page']} at {result['when']}")
+        st.code(result['report'])
+        st.download_button("Download profile", result['report'], file_name="profile.txt",
+                           mime="text/plain")
+
+def display_jobs():
+    st.subheader("Scheduled jobs")
+    scheduler = get_scheduler()
+    if scheduler.leader:
+        st.caption("This process runs the scheduled jobs.")
+    elif scheduler.running:
+        st.caption("Another process runs the scheduled jobs; the counts below are this process's.")
+    else:
+        st.caption("The scheduler is not running in this process (TASKTRACKER_SCHEDULER=0?).")
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        name = st.selectbox("Job", list(scheduler.jobs), key="job_name")
+    with col2:
+        if st.button("Run now"):
+            result = scheduler.run_job(scheduler.jobs[name])
+            error = scheduler.jobs[name].last_error
+            if error:
+                st.error(error)
+            else:
+                st.success(f"{name}: {result}")
+
+def load_diagnostics():
+    st.title("Diagnostics")
+    display_timings()
+    display_stats()
+    display_jobs()
+    display_profile()
+    with st.expander("Prometheus text", expanded=False):
+        st.code(prometheus_text())
+
+if __name__ == "__main__":
+    activate_session_tenant()
+    if st.session_state.get('user_role') == 'admin':
+        load_diagnostics()
+    else:
+        st.error("Access denied. Admin privileges required.")
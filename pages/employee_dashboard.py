@@ -1,78 +1,103 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
 from datetime import datetime
+from utils.database import get_store, StaleWriteError, date_str
+from utils.models import Leave, Task
+from utils.pagination import paginate, task_filters
+from utils.charts import my_daily_hours, my_daily_hours_line, my_task_status_pie
+from utils.metrics import page
+from utils.live import live, notify_changes, seen
+from utils.auth import activate_session_tenant
 
+def update_status(task_id, shown, key):
+    """on_change of a task's status box: save the pick, unless the task
+    has moved on from the status the box was showing"""
+    # Callbacks cannot draw into a fragment; my_tasks shows the outcome
+    try:
+        get_store("tasks").update(task_id, expected={'status': shown}, status=st.session_state[key])
+        st.session_state.status_message = (st.success, "Status updated!")
+        # The rerun this callback precedes should not toast our own write
+        seen(["tasks"])
+    except StaleWriteError as e:
+        st.session_state.status_message = (st.warning, str(e))
+
+@live
+def my_tasks(username):
+    task_store = get_store("tasks")
+    notify_changes(["tasks"], keys=set(task_store.find(assigned_to=username)["task_id"]))
+    st.subheader("My Tasks")
+    if "status_message" in st.session_state:
+        show, message = st.session_state.pop("status_message")
+        show(message)
+    # Task status distribution
+    fig = my_task_status_pie(username)
+    if fig is not None:
+        st.plotly_chart(fig)
+
+    # Task list with status update
+    query = task_filters("my_tasks")
+    for task in Task.from_frame(paginate(task_store, "my_tasks", assigned_to=username, **query)):
+        with st.expander(f"Task: {task.title}", expanded=False):
+            st.write(f"Description: {task.description}")
+            st.write(f"Deadline: {date_str(task.deadline)}")
+            st.write(f"Severity: {task.severity}")
+            # Writes only on the employee's own pick, never on a rerun; the
+            # key follows the stored status so a change made elsewhere
+            # gets a fresh box showing it rather than the old selection
+            key = f"status_{task.task_id}_{task.status}"
+            st.selectbox(
+                "Status",
+                ["Not Started", "In Progress", "Completed"],
+                index=["Not Started", "In Progress", "Completed"].index(task.status),
+                key=key,
+                on_change=update_status,
+                args=(task.task_id, task.status, key),
+            )
+
+@live
+def my_leave_requests(username):
+    user_leaves = get_store("leaves").find(employee=username)
+    notify_changes(["leaves"], keys=set(user_leaves["leave_id"]))
+    st.subheader("My Leave Requests")
+    if not user_leaves.empty:
+        my_leaves = paginate(get_store("leaves"), "my_leaves", employee=username,
+                             order_by='start_date', descending=True)
+        for leave in Leave.from_frame(my_leaves):
+            with st.expander(f"Leave Request ({date_str(leave.start_date)} to {date_str(leave.end_date)})", expanded=False):
+                st.write(f"Type: {leave.leave_type}")
+                st.write(f"Status: {leave.status}")
+                st.write(f"Reason: {leave.reason}")
+
+@page
 def load_employee_dashboard():
     username = st.session_state.username
 
     # Load data
-    tasks_df = pd.read_csv("data/tasks.csv")
-    leaves_df = pd.read_csv("data/leaves.csv")
-    timesheets_df = pd.read_csv("data/timesheets.csv")
+    user_hours = my_daily_hours(username)
 
-    # Filter data for current user
-    user_tasks = tasks_df[tasks_df['assigned_to'] == username]
-    user_leaves = leaves_df[leaves_df['employee'] == username]
-    user_timesheets = timesheets_df[timesheets_df['employee'] == username]
+    # Raised by the scheduled jobs: overdue tasks, pending leaves, forgotten logouts
+    for message in get_store("alerts").find(employee=username)["message"]:
+        st.warning(message)
 
     # Dashboard layout
     col1, col2 = st.columns(2)
 
     with col1:
-        st.subheader("My Tasks")
-        if not user_tasks.empty:
-            # Task status distribution
-            status_counts = user_tasks['status'].value_counts()
-            fig = px.pie(values=status_counts.values, 
-                        names=status_counts.index, 
-                        title="My Task Status",
-                        color_discrete_sequence=px.colors.sequential.Blues)
-            st.plotly_chart(fig)
-
-        # Task list with status update
-        for _, task in user_tasks.iterrows():
-            with st.expander(f"Task: {task['title']}", expanded=False):
-                st.write(f"Description: {task['description']}")
-                st.write(f"Deadline: {task['deadline']}")
-                st.write(f"Severity: {task['severity']}")
-                new_status = st.selectbox(
-                    "Status",
-                    ["Not Started", "In Progress", "Completed"],
-                    index=["Not Started", "In Progress", "Completed"].index(task['status']),
-                    key=f"status_{task['task_id']}"
-                )
-                if new_status != task['status']:
-                    tasks_df.loc[tasks_df['task_id'] == task['task_id'], 'status'] = new_status
-                    tasks_df.to_csv("data/tasks.csv", index=False)
-                    st.success("Status updated!")
-                    st.rerun()
+        my_tasks(username)
 
     with col2:
-        st.subheader("My Leave Requests")
-        if not user_leaves.empty:
-            for _, leave in user_leaves.iterrows():
-                with st.expander(f"Leave Request ({leave['start_date']} to {leave['end_date']})", expanded=False):
-                    st.write(f"Type: {leave['leave_type']}")
-                    st.write(f"Status: {leave['status']}")
-                    st.write(f"Reason: {leave['reason']}")
+        my_leave_requests(username)
 
         st.subheader("My Time Report")
-        if not user_timesheets.empty:
-            daily_hours = user_timesheets.groupby('date')['hours_worked'].sum().reset_index()
-            fig = px.line(daily_hours, 
-                         x='date', 
-                         y='hours_worked',
-                         title="Daily Hours Worked",
-                         color_discrete_sequence=['#2596be'])
-            st.plotly_chart(fig)
+        if not user_hours.empty:
+            st.plotly_chart(my_daily_hours_line(username))
 
             # Weekly summary
             st.subheader("Weekly Summary")
-            total_hours = user_timesheets['hours_worked'].sum()
+            total_hours = user_hours['hours_worked'].sum()
             st.metric("Total Hours Logged", f"{total_hours:.1f}")
 
 if __name__ == "__main__":
+    activate_session_tenant()
     if st.session_state.get('authenticated'):
         load_employee_dashboard()
     else:
@@ -1,13 +1,55 @@
 import streamlit as st
-import pandas as pd
 from datetime import datetime
 import uuid
+from utils.database import get_store, StaleWriteError, date_str
+from utils.models import Leave
+from utils.pagination import paginate
+from utils.leaves import get_calendar
+from utils.metrics import page
+from utils.live import live, notify_changes, refresh
+from utils.auth import activate_session_tenant
 
+@live
+def my_leave_requests(username):
+    leave_store = get_store("leaves")
+    notify_changes(["leaves"], keys=set(leave_store.find(employee=username)["leave_id"]))
+    st.subheader("My Leave Requests")
+    user_leaves = paginate(leave_store, "leaves", employee=username,
+                           order_by='start_date', descending=True)
+
+    if not user_leaves.empty:
+        for leave in Leave.from_frame(user_leaves):
+            with st.expander(f"Leave Request ({date_str(leave.start_date)} to {date_str(leave.end_date)})"):
+                st.write(f"Type: {leave.leave_type}")
+                st.write(f"Status: {leave.status}")
+                st.write(f"Reason: {leave.reason}")
+
+                if leave.status == 'Pending':
+                    if st.button(f"Cancel Request #{leave.leave_id}"):
+                        try:
+                            leave_store.delete(leave.leave_id, expected={'status': 'Pending'})
+                            st.success("Leave request cancelled!")
+                            refresh()
+                        except StaleWriteError as e:
+                            st.warning(str(e))
+
+@page
 def load_leave_management():
     st.title("Leave Management")
     
     # Load data
-    leaves_df = pd.read_csv("data/leaves.csv")
+    leave_store = get_store("leaves")
+
+    # Balances for this year
+    balances = get_calendar().balances(datetime.today().year, [st.session_state.username])
+    balances = balances.dropna(subset=['allowance'])
+    if not balances.empty:
+        st.subheader(f"My Leave Balance ({datetime.today().year})")
+        cols = st.columns(len(balances))
+        for col, balance in zip(cols, balances.itertuples(index=False)):
+            with col:
+                st.metric(balance.leave_type, f"{balance.remaining:.0f} days left",
+                          f"{balance.pending} pending", delta_color="off")
 
     # Leave request form
     with st.form("leave_form"):
@@ -21,42 +63,25 @@ def load_leave_management():
         
         if submitted:
             if start_date <= end_date:
-                new_leave = pd.DataFrame({
-                    'leave_id': [str(uuid.uuid4())],
-                    'employee': [st.session_state.username],
-                    'start_date': [start_date.strftime("%Y-%m-%d")],
-                    'end_date': [end_date.strftime("%Y-%m-%d")],
-                    'leave_type': [leave_type],
-                    'status': ['Pending'],
-                    'reason': [reason]
+                leave_store.insert({
+                    'leave_id': str(uuid.uuid4()),
+                    'employee': st.session_state.username,
+                    'start_date': start_date.strftime("%Y-%m-%d"),
+                    'end_date': end_date.strftime("%Y-%m-%d"),
+                    'leave_type': leave_type,
+                    'status': 'Pending',
+                    'reason': reason
                 })
-                
-                leaves_df = pd.concat([leaves_df, new_leave], ignore_index=True)
-                leaves_df.to_csv("data/leaves.csv", index=False)
                 st.success("Leave request submitted successfully!")
-                st.experimental_rerun()
+                refresh()
             else:
                 st.error("End date must be after start date")
 
     # Leave request list
-    st.subheader("My Leave Requests")
-    user_leaves = leaves_df[leaves_df['employee'] == st.session_state.username]
-    
-    if not user_leaves.empty:
-        for _, leave in user_leaves.iterrows():
-            with st.expander(f"Leave Request ({leave['start_date']} to {leave['end_date']})"):
-                st.write(f"Type: {leave['leave_type']}")
-                st.write(f"Status: {leave['status']}")
-                st.write(f"Reason: {leave['reason']}")
-                
-                if leave['status'] == 'Pending':
-                    if st.button(f"Cancel Request #{leave['leave_id']}"):
-                        leaves_df = leaves_df[leaves_df['leave_id'] != leave['leave_id']]
-                        leaves_df.to_csv("data/leaves.csv", index=False)
-                        st.success("Leave request cancelled!")
-                        st.experimental_rerun()
+    my_leave_requests(st.session_state.username)
 
 if __name__ == "__main__":
+    activate_session_tenant()
     if st.session_state.get('authenticated'):
         load_leave_management()
     else:
@@ -1,56 +1,102 @@
 import streamlit as st
-import pandas as pd
 from datetime import datetime
 import uuid
+from utils.database import get_store, StaleWriteError, date_str
+from utils.models import Task
+from utils.pagination import paginate, task_filters, bulk_select
+from utils.search import search
+from utils.metrics import page
+from utils.live import live, notify_changes, refresh
+from utils.auth import activate_session_tenant
 
-def load_task_management():
-    st.title("Task Management")
-
-    # Load data
-    tasks_df = pd.read_csv("data/tasks.csv")
-    users_df = pd.read_csv("data/users.csv")
-    employees = users_df[users_df['role'] == 'employee']['username'].tolist()
-    admins = users_df[users_df['role'] == 'admin']['username'].tolist()
+@live
+def display_task_list(employees):
+    task_store = get_store("tasks")
+    if st.session_state.user_role == 'admin':
+        notify_changes(["tasks"])
+    else:
+        username = st.session_state.username
+        mine, _ = task_store.query(any_of={"assigned_to": username, "created_by": username})
+        notify_changes(["tasks"], keys=set(mine["task_id"]))
 
-    # Task list
     st.subheader("Task List")
     if st.session_state.user_role == 'admin':
-        tasks_view = tasks_df
+        query = task_filters("tasks", assignees=employees)
+    else:
+        username = st.session_state.username
+        query = task_filters("tasks")
+        query["any_of"] = {"assigned_to": username, "created_by": username}
+    text = st.text_input("Search tasks", key="tasks_search",
+                         placeholder="Words from the title or description")
+    if text.strip():
+        filters = {k: v for k, v in query.items() if k not in ("order_by", "descending")}
+        tasks_view = search("tasks", text, **filters)
+        if tasks_view.empty:
+            st.info("No matching tasks")
+        else:
+            st.caption("Best matches first")
     else:
-        tasks_view = tasks_df[
-            (tasks_df['assigned_to'] == st.session_state.username) |
-            (tasks_df['created_by'] == st.session_state.username)
-        ]
-
-    if not tasks_view.empty:
-        for _, task in tasks_view.iterrows():
-            with st.expander(f"Task: {task['title']}"):
-                st.write(f"*Task Title:* {task['title']}")
-                st.write(f"*Description:* {task['description']}")
-                st.write(f"*Assigned to:* {task['assigned_to']}")
-                st.write(f"*Deadline:* {task['deadline']}")
-                st.write(f"*Severity:* {task['severity']}")
-
-                # Status selection
-                status_options = ["Not Started", "In Progress", "Completed"]
-                current_status = task['status']
-                selected_status = st.selectbox(f"Status of Task #{task['task_id']}", options=status_options, index=status_options.index(current_status))
-
-                if st.button(f"Update Status of Task #{task['task_id']}"):
-                    tasks_df.loc[tasks_df['task_id'] == task['task_id'], 'status'] = selected_status
-                    tasks_df.to_csv("data/tasks.csv", index=False)
+        tasks_view = paginate(task_store, "tasks", **query)
+    tasks = Task.from_frame(tasks_view)
+
+    if tasks and st.session_state.user_role == 'admin':
+        with st.expander("Bulk actions", expanded=False):
+            selected = bulk_select(tasks, lambda t: t.title, "tasks")
+            col1, col2 = st.columns(2)
+            with col1:
+                bulk_status = st.selectbox("New status", ["Not Started", "In Progress", "Completed"])
+                if st.button("Set status of selected", disabled=not selected):
+                    count = task_store.update_many(selected, status=bulk_status)
+                    st.success(f"{count} tasks updated!")
+                    refresh()
+            with col2:
+                assignee = st.selectbox("Reassign to", employees)
+                if st.button("Reassign selected", disabled=not selected):
+                    count = task_store.update_many(selected, assigned_to=assignee)
+                    st.success(f"{count} tasks reassigned!")
+                    refresh()
+
+    for task in tasks:
+        with st.expander(f"Task: {task.title}"):
+            st.write(f"*Task Title:* {task.title}")
+            st.write(f"*Description:* {task.description}")
+            st.write(f"*Assigned to:* {task.assigned_to}")
+            st.write(f"*Deadline:* {date_str(task.deadline)}")
+            st.write(f"*Severity:* {task.severity}")
+
+            # Status selection
+            status_options = ["Not Started", "In Progress", "Completed"]
+            current_status = task.status
+            selected_status = st.selectbox(f"Status of Task #{task.task_id}", options=status_options, index=status_options.index(current_status))
+
+            if st.button(f"Update Status of Task #{task.task_id}"):
+                try:
+                    task_store.update(task.task_id, expected={'status': current_status}, status=selected_status)
                     st.success("Task status updated!")
-                    st.rerun()
+                    refresh()
+                except StaleWriteError as e:
+                    st.warning(str(e))
+
+            st.write(f"*Current Status:* {selected_status}")
+            st.write(f"*Created by:* {task.created_by}")
+
+            if st.session_state.user_role == 'admin':
+                if st.button(f"Delete Task #{task.task_id}"):
+                    task_store.delete(task.task_id)
+                    st.success("Task deleted!")
+                    refresh()
+
+@page
+def load_task_management():
+    st.title("Task Management")
 
-                st.write(f"*Current Status:* {selected_status}")
-                st.write(f"*Created by:* {task['created_by']}")
+    # Load data
+    task_store = get_store("tasks")
+    user_store = get_store("users")
+    employees = user_store.usernames('employee')
 
-                if st.session_state.user_role == 'admin':
-                    if st.button(f"Delete Task #{task['task_id']}"):
-                        tasks_df = tasks_df[tasks_df['task_id'] != task['task_id']]
-                        tasks_df.to_csv("data/tasks.csv", index=False)
-                        st.success("Task deleted!")
-                        st.rerun()
+    # Task list
+    display_task_list(employees)
 
     # Task creation form
     st.subheader("Create New Task")
@@ -71,26 +117,24 @@ def load_task_management():
 
         if submitted:
             if title and description and assigned_to:
-                new_task = pd.DataFrame({
-                    'task_id': [str(uuid.uuid4())],
-                    'title': [title],
-                    'description': [description],
-                    'assigned_to': [assigned_to],
-                    'deadline': [deadline.strftime("%Y-%m-%d")],
-                    'severity': [severity],
-                    'status': ["Not Started"],
-                    'created_by': [st.session_state.username],
-                    'approved': [True if st.session_state.user_role == 'admin' else False]
+                task_store.insert({
+                    'task_id': str(uuid.uuid4()),
+                    'title': title,
+                    'description': description,
+                    'assigned_to': assigned_to,
+                    'deadline': deadline.strftime("%Y-%m-%d"),
+                    'severity': severity,
+                    'status': "Not Started",
+                    'created_by': st.session_state.username,
+                    'approved': True if st.session_state.user_role == 'admin' else False
                 })
-
-                tasks_df = pd.concat([tasks_df, new_task], ignore_index=True)
-                tasks_df.to_csv("data/tasks.csv", index=False)
                 st.success("Task created successfully!")
-                st.rerun()
+                refresh()
             else:
                 st.error("Please fill all required fields")
 
-if _name_ == "_main_":
+if __name__ == "__main__":
+    activate_session_tenant()
     if st.session_state.get('authenticated'):
         load_task_management()
     else:
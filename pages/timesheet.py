@@ -1,32 +1,18 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
-import os
-
-# File path
-TIMESHEET_FILE = "data/timesheets.csv"
-TASKS_FILE = "data/tasks.csv"
-
-# Ensure the directory exists
-os.makedirs("data", exist_ok=True)
-
-# Load or create timesheet file
-def load_timesheet_data():
-    if not os.path.exists(TIMESHEET_FILE):
-        return pd.DataFrame(columns=["timesheet_id", "employee", "date", "login_time", "logout_time", "tasks", "task_notes", "hours_worked"])
-    return pd.read_csv(TIMESHEET_FILE)
-
-# Save timesheet data
-def save_timesheet_data(df):
-    df.to_csv(TIMESHEET_FILE, index=False)
+import uuid
+from utils.database import closed_months, get_store, read_month, StaleWriteError
+from utils.pagination import paginate
+from utils.metrics import page
+from utils.auth import activate_session_tenant
 
 # Load tasks
-def load_tasks():
-    if not os.path.exists(TASKS_FILE):
-        return pd.DataFrame(columns=["task_id", "title", "assigned_to"])
-    return pd.read_csv(TASKS_FILE)
+def load_tasks(username):
+    return get_store("tasks").find(assigned_to=username)
 
 # Main function
+@page
 def timesheet_app():
     st.title("Employee Timesheet Tracker")
     
@@ -36,41 +22,35 @@ def timesheet_app():
     
     username = st.session_state.username
     today_date = datetime.today().strftime("%Y-%m-%d")
-    timesheet_df = load_timesheet_data()
-    tasks_df = load_tasks()
-    
-    # Generate timesheet ID
-    timesheet_id = f"{username}_Proitbridge"
+    timesheet_store = get_store("timesheets")
     
     # Filter tasks assigned to the user
-    user_tasks = tasks_df[tasks_df["assigned_to"] == username]
+    user_tasks = load_tasks(username)
     task_list = user_tasks["title"].tolist()
     
     # Find existing record for today
-    user_entry = timesheet_df[(timesheet_df["employee"] == username) & (timesheet_df["date"] == today_date)]
-    login_time = user_entry["login_time"].values[0] if not user_entry.empty else None
-    logout_time = user_entry["logout_time"].values[0] if not user_entry.empty else None
-    hours_worked = user_entry["hours_worked"].values[0] if not user_entry.empty else None
+    user_entry = timesheet_store.get_entry(username, today_date)
+    login_time = user_entry["login_time"] if user_entry is not None else None
+    logout_time = user_entry["logout_time"] if user_entry is not None else None
+    hours_worked = user_entry["hours_worked"] if user_entry is not None else None
     
     st.subheader(f"Timesheet for {today_date}")
     
     # Login button
-    if login_time is None:
+    if pd.isna(login_time):
         if st.button("Login"):
             login_time = datetime.now().strftime("%H:%M:%S")
-            new_entry = pd.DataFrame({
-                "timesheet_id": [timesheet_id],
-                "employee": [username],
-                "date": [today_date],
-                "login_time": [login_time],
-                "logout_time": [None],
-                "tasks": [""],
-                "task_notes": [""],
-                "hours_worked": [None]
+            timesheet_store.insert({
+                "timesheet_id": str(uuid.uuid4()),
+                "employee": username,
+                "date": today_date,
+                "login_time": login_time,
+                "logout_time": None,
+                "tasks": "",
+                "task_notes": "",
+                "hours_worked": None
             })
-            timesheet_df = pd.concat([timesheet_df, new_entry], ignore_index=True)
-            save_timesheet_data(timesheet_df)
-            st.experimental_rerun()
+            st.rerun()
     elif pd.isna(logout_time):
         st.success(f"Logged in at: {login_time}")
         
@@ -79,32 +59,47 @@ def timesheet_app():
         task_notes = st.text_area("Add Notes for Selected Tasks")
         
         if st.button("Update Progress"):
-            timesheet_df.loc[(timesheet_df["employee"] == username) & (timesheet_df["date"] == today_date), "tasks"] = ", ".join(selected_tasks)
-            timesheet_df.loc[(timesheet_df["employee"] == username) & (timesheet_df["date"] == today_date), "task_notes"] = task_notes
-            save_timesheet_data(timesheet_df)
+            timesheet_store.update_entry(username, today_date, tasks=", ".join(selected_tasks), task_notes=task_notes)
             st.success("Progress updated successfully!")
-            st.experimental_rerun()
+            st.rerun()
         
         if st.button("Logout"):
             logout_time = datetime.now().strftime("%H:%M:%S")
             login_dt = datetime.strptime(login_time, "%H:%M:%S")
             logout_dt = datetime.strptime(logout_time, "%H:%M:%S")
             hours_worked = round((logout_dt - login_dt).total_seconds() / 3600, 2)
-            timesheet_df.loc[(timesheet_df["employee"] == username) & (timesheet_df["date"] == today_date), "logout_time"] = logout_time
-            timesheet_df.loc[(timesheet_df["employee"] == username) & (timesheet_df["date"] == today_date), "hours_worked"] = hours_worked
-            save_timesheet_data(timesheet_df)
-            st.experimental_rerun()
+            try:
+                timesheet_store.update_entry(username, today_date, expected={"logout_time": None}, logout_time=logout_time, hours_worked=hours_worked)
+                st.rerun()
+            except StaleWriteError:
+                st.warning("You have already logged out today from another session.")
     else:
         st.success(f"Logged out at: {logout_time}. Total hours worked: {hours_worked}. You cannot log in or log out again today.")
     
     # Display timesheet history
     st.subheader("My Timesheet History")
-    user_timesheets = timesheet_df[timesheet_df["employee"] == username]
+    user_timesheets = paginate(timesheet_store, "my_timesheets", employee=username,
+                               order_by="date", descending=True)
     if not user_timesheets.empty:
-        st.dataframe(user_timesheets.sort_values("date", ascending=False))
+        st.dataframe(
+            user_timesheets,
+            column_config={"date": st.column_config.DateColumn("date")}
+        )
+
+    # The history above covers the open months; older ones are read a
+    # month at a time, from the archive or the live table
+    months = closed_months("timesheets", groups=[username])
+    if months:
+        with st.expander("Earlier months", expanded=False):
+            month = st.selectbox("Month", months[::-1], key="archived_month")
+            st.dataframe(
+                read_month("timesheets", month, {"employee": username}).sort_values("date", ascending=False),
+                column_config={"date": st.column_config.DateColumn("date")}
+            )
 
 # Run the app
 if __name__ == "__main__":
+    activate_session_tenant()
     if st.session_state.get("authenticated"):
         timesheet_app()
     else:
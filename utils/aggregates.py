@@ -0,0 +1,200 @@
+import threading
+from collections import defaultdict
+
+import pandas as pd
+
+from utils import metrics
+from utils.database import (
+    TABLES, closed_totals, filter_mask, get_cache, get_store, open_ranges, plain_column, _clean_value,
+)
+from utils.tenants import current_tenant
+
+# name -> (table, group-by columns, summed column or None to count rows).
+# Views of a partitioned table also count its closed months (archived or
+# not) when they are grouped by nothing or by the partition's group
+# column, counting rows or summing the partition's sum column.
+VIEWS = {
+    "tasks_total": ("tasks", (), None),
+    "tasks_by_status": ("tasks", ("status",), None),
+    "tasks_by_severity": ("tasks", ("severity",), None),
+    "leaves_by_status": ("leaves", ("status",), None),
+    "hours_total": ("timesheets", (), "hours_worked"),
+    "hours_by_employee": ("timesheets", ("employee",), "hours_worked"),
+    "hours_by_employee_day": ("timesheets", ("employee", "date"), "hours_worked"),
+}
+
+
+def _number(value):
+    return 0.0 if value is None or pd.isna(value) else float(value)
+
+
+class MaterializedViews:
+    """Counts and sums over the cached tables, maintained as deltas.
+
+    Each view is rebuilt once when its table is loaded into the table
+    cache; after that every insert/update/delete the cache folds in only
+    adjusts the groups the changed rows belong to. To undo a row's old
+    contribution on update/delete, the views keep the few columns they
+    group on per row key.
+    """
+
+    def __init__(self, views):
+        self.views = views
+        self.tables = sorted({table for table, _, _ in views.values()})
+        self._lock = threading.Lock()
+        self._columns = {}
+        for table in self.tables:
+            columns = []
+            for view_table, group_by, value in views.values():
+                if view_table == table:
+                    columns += [c for c in group_by + ((value,) if value else ()) if c not in columns]
+            self._columns[table] = columns
+        # table -> {row key: [tuple of self._columns[table] values, ...]}
+        self._rows = {}
+        # view name -> {group tuple: [row count, summed value]}
+        self._totals = {name: {} for name in views}
+        # table -> open months at the last reset (see open_ranges)
+        self._ranges = {}
+
+    def _views_of(self, table):
+        for name, (view_table, group_by, value) in self.views.items():
+            if view_table == table:
+                yield name, group_by, value
+
+    def _add_closed(self, table, totals):
+        spec = TABLES[table].get("partition")
+        if spec is None:
+            return
+        closed = closed_totals(table)
+        for name, group_by, value in self._views_of(table):
+            if group_by not in ((), (spec["group"],)) or value not in (None, spec["sum"]):
+                continue
+            for group, (rows, total) in closed.items():
+                counts = totals[name].setdefault((group,) if group_by else (), [0, 0.0])
+                counts[0] += rows
+                counts[1] += total
+
+    def _is_open(self, table, row):
+        for column, (cutoff, _) in (self._ranges.get(table) or {}).items():
+            value = pd.to_datetime(row.get(column), errors="coerce")
+            if pd.isna(value) or value < cutoff:
+                return False
+        return True
+
+    @metrics.timed
+    def reset(self, table, df):
+        # Rows the cache picked up from before the open months are counted
+        # with the closed ones
+        ranges = open_ranges(table)
+        if ranges:
+            df = df[filter_mask(table, df, {}, ranges=ranges)]
+        columns = self._columns[table]
+        plain = pd.DataFrame({c: plain_column(df[c]) for c in columns}, index=df.index)
+        rows = defaultdict(list)
+        for key, values in zip(df[TABLES[table]["key"]], zip(*(plain[c] for c in columns))):
+            rows[key].append(values)
+        totals = {}
+        for name, group_by, value in self._views_of(table):
+            weights = pd.to_numeric(plain[value], errors="coerce").fillna(0.0) if value else None
+            if not group_by:
+                total = float(weights.sum()) if value else 0.0
+                totals[name] = {(): [len(plain), total]}
+                continue
+            grouped = plain.dropna(subset=list(group_by)).assign(_weight=weights if value else 0.0)
+            stats = grouped.groupby(list(group_by), sort=False)["_weight"].agg(["size", "sum"])
+            groups = stats.index if len(group_by) > 1 else [(g,) for g in stats.index]
+            totals[name] = {
+                tuple(group): [int(size), float(total)]
+                for group, size, total in zip(groups, stats["size"], stats["sum"])
+            }
+        self._add_closed(table, totals)
+        with self._lock:
+            self._rows[table] = dict(rows)
+            self._ranges[table] = ranges
+            self._totals.update(totals)
+
+    def _add(self, table, values, sign):
+        columns = self._columns[table]
+        row = dict(zip(columns, values))
+        for name, group_by, value in self._views_of(table):
+            group = tuple(row[c] for c in group_by)
+            if any(g is None for g in group):
+                continue
+            counts = self._totals[name].setdefault(group, [0, 0.0])
+            counts[0] += sign
+            counts[1] += sign * _number(row[value]) if value else 0.0
+            if counts[0] == 0:
+                del self._totals[name][group]
+
+    def apply(self, table, records):
+        columns = self._columns[table]
+        with self._lock:
+            rows = self._rows.get(table)
+            if rows is None:
+                return
+            for record in records:
+                op = record["op"]
+                if op == "insert":
+                    if not self._is_open(table, record["row"]):
+                        continue
+                    values = tuple(_clean_value(record["row"].get(c)) for c in columns)
+                    key = record["row"].get(TABLES[table]["key"])
+                    rows.setdefault(key, []).append(values)
+                    self._add(table, values, 1)
+                    continue
+                old = rows.get(record["key"])
+                if not old:
+                    continue
+                for values in old:
+                    self._add(table, values, -1)
+                if op == "delete":
+                    del rows[record["key"]]
+                    continue
+                changes = {c: _clean_value(v) for c, v in record["changes"].items()}
+                new = [
+                    tuple(changes.get(c, v) for c, v in zip(columns, values))
+                    for values in old
+                ]
+                rows[record["key"]] = new
+                for values in new:
+                    self._add(table, values, 1)
+
+    def count(self, name, group=()):
+        with self._lock:
+            return self._totals[name].get(tuple(group), [0, 0.0])[0]
+
+    def total(self, name, group=()):
+        with self._lock:
+            return self._totals[name].get(tuple(group), [0, 0.0])[1]
+
+    def frame(self, name, value_name):
+        """A view as a DataFrame of its group columns plus value_name
+        (the row count for counted views, the sum for summed ones)"""
+        _, group_by, value = self.views[name]
+        with self._lock:
+            items = list(self._totals[name].items())
+        return pd.DataFrame(
+            [group + (counts[1] if value else counts[0],) for group, counts in items],
+            columns=list(group_by) + [value_name],
+        )
+
+
+# tenant -> its views, subscribed to that tenant's cache
+_views = {}
+_lock = threading.Lock()
+
+
+def get_views():
+    """Return the current tenant's dashboard views, brought up to date
+    with its tables"""
+    tenant = current_tenant()
+    cache = get_cache()
+    with _lock:
+        views = _views.get(tenant)
+        if views is None:
+            views = _views[tenant] = MaterializedViews(VIEWS)
+            cache.subscribe(views)
+    for table in views.tables:
+        # A no-op on a cache hit; otherwise catches the views up as well
+        get_store(table).all()
+    return views
@@ -1,49 +1,324 @@
+import base64
 import hashlib
-import pandas as pd
+import hmac
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
 import streamlit as st
+from utils import metrics
+from utils.database import DATA_DIR, FileLock, StaleWriteError, get_cache, get_store, tenant_dir
+from utils.ratelimit import RateLimitError, get_limiter
+from utils.tenants import DEFAULT_TENANT, check_tenant, current_tenant, set_tenant, use_tenant
 
+# scrypt cost parameters for new hashes (about 16 MiB and 50 ms per hash)
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SESSION_HOURS = float(os.environ.get("TASKTRACKER_SESSION_HOURS", 12))
+SECRET_FILE = ".session_secret"
+# Per shard: username -> session generation, bumped by logout
+SESSIONS_FILE = ".sessions.json"
+# Session state key of the tenant a Streamlit session logged in to
+TENANT_KEY = "tenant"
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20, dklen=32
+    )
+
+
+@metrics.timed
 def hash_password(password):
-    """Hash a password using SHA-256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash a password with salted scrypt"""
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def _verify_hash(stored, password):
+    """Check a password against a stored hash; also True for the unsalted
+    SHA-256 hashes written by earlier versions"""
+    if not isinstance(stored, str):
+        return False
+    if stored.startswith("scrypt$"):
+        _, n, r, p, salt, digest = stored.split("$")
+        candidate = _scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(candidate.hex(), digest)
+    legacy = hashlib.sha256(password.encode()).hexdigest()
+    return hmac.compare_digest(legacy, stored)
+
+
+def _needs_upgrade(stored):
+    return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+
+class UserDirectory:
+    """username -> (password hash, role) of one tenant, kept in memory.
+
+    Subscribed to the table cache, so it is rebuilt when the users table
+    is loaded and patched on every user insert/update/delete, including
+    those made by other processes.
+    """
+
+    tables = ["users"]
+
+    def __init__(self):
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def reset(self, table, df):
+        users = dict(zip(df["username"], zip(df["password"], df["role"].astype(object))))
+        with self._lock:
+            self._users = users
+
+    def apply(self, table, records):
+        with self._lock:
+            for record in records:
+                if record["op"] == "insert":
+                    row = record["row"]
+                    self._users[row["username"]] = (row["password"], row["role"])
+                elif record["op"] == "delete":
+                    self._users.pop(record["key"], None)
+                elif record["key"] in self._users:
+                    password, role = self._users[record["key"]]
+                    changes = record["changes"]
+                    self._users[record["key"]] = (
+                        changes.get("password", password),
+                        changes.get("role", role),
+                    )
+
+    def lookup(self, username):
+        with self._lock:
+            return self._users.get(username)
+
+
+class SessionGenerations:
+    """username -> session generation of one tenant's users.
+
+    Tokens carry the generation they were issued at; revoke() bumps it,
+    so every token the user holds stops verifying. Kept in the shard's
+    SESSIONS_FILE so all workers see a logout, and re-read only when
+    that file changes.
+    """
+
+    def __init__(self, data_dir):
+        self.path = os.path.join(data_dir, SESSIONS_FILE)
+        self._file_lock = FileLock(os.path.join(data_dir, ".sessions.lock"))
+        self._lock = threading.Lock()
+        self._stat = None
+        self._generations = {}
+
+    def _load(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+        token = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if token != self._stat:
+                with open(self.path) as f:
+                    self._generations = json.load(f)
+                self._stat = token
+            return self._generations
+
+    def get(self, username):
+        return self._load().get(username, 0)
+
+    def revoke(self, username):
+        with self._file_lock:
+            generations = dict(self._load())
+            generations[username] = generations.get(username, 0) + 1
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".sessions.", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(generations, f)
+            os.replace(tmp, self.path)
+
+
+# tenant -> its user directory; the same username in two tenants is two users
+_directories = {}
+# tenant -> its session generations
+_generations = {}
+_secret = None
+_lock = threading.Lock()
 
-def check_password(username, password):
+
+def get_directory():
+    """Return the current tenant's user directory, up to date with its
+    users table"""
+    tenant = current_tenant()
+    cache = get_cache()
+    with _lock:
+        directory = _directories.get(tenant)
+        if directory is None:
+            directory = _directories[tenant] = UserDirectory()
+            cache.subscribe(directory)
+    cache.get("users")
+    return directory
+
+
+def get_generations(tenant=None):
+    """Return a tenant's session generations (by default the current tenant's)"""
+    tenant = current_tenant() if tenant is None else tenant
+    with _lock:
+        if tenant not in _generations:
+            _generations[tenant] = SessionGenerations(tenant_dir(tenant))
+        return _generations[tenant]
+
+
+def activate_session_tenant():
+    """Serve this Streamlit run (or fragment rerun) from the shard of the
+    tenant the session logged in to; returns the tenant"""
+    tenant = st.session_state.get(TENANT_KEY, DEFAULT_TENANT)
+    set_tenant(tenant)
+    return tenant
+
+
+@metrics.timed
+def authenticate(username, password, client=None):
+    """Verify a login against the current tenant's users; returns the
+    user's role, or None if it fails.
+
+    Attempts are rate limited per username (within the tenant) and per
+    client address; RateLimitError is raised, before any hashing, when
+    either has to back off. Hashes from older versions are re-hashed with scrypt on
+    success.
+    """
+    tenant = current_tenant()
+    limiters = [(get_limiter("login_user"), f"{tenant}/{username}" if tenant else username)]
+    if client:
+        limiters.append((get_limiter("login_client"), client))
+    for limiter, key in limiters:
+        limiter.acquire(key)
+    user = get_directory().lookup(username)
+    if user is None or not _verify_hash(user[0], password):
+        for limiter, key in limiters:
+            limiter.failure(key)
+        return None
+    for limiter, key in limiters:
+        limiter.success(key)
+    if _needs_upgrade(user[0]):
+        try:
+            get_store("users").update(username, expected={"password": user[0]},
+                                      password=hash_password(password))
+        except StaleWriteError:
+            pass  # another session upgraded or changed it first
+    return user[1]
+
+
+def check_password(username, password, client=None):
     """Verify username and password"""
     try:
-        users_df = pd.read_csv("data/users.csv")
-        user = users_df[users_df['username'] == username]
-        if not user.empty:
-            stored_password = user.iloc[0]['password']
-            return stored_password == hash_password(password)
+        return authenticate(username, password, client) is not None
+    except RateLimitError as e:
+        st.error(str(e))
     except Exception as e:
         st.error(f"Error checking password: {str(e)}")
     return False
 
+
+def _session_secret():
+    """Signing key for session tokens: TASKTRACKER_SECRET, or a random key
+    kept in the data directory so every worker shares it"""
+    global _secret
+    with _lock:
+        if _secret is None:
+            secret = os.environ.get("TASKTRACKER_SECRET")
+            if secret:
+                _secret = secret.encode()
+            else:
+                path = os.path.join(DATA_DIR, SECRET_FILE)
+                try:
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                    with os.fdopen(fd, "w") as f:
+                        f.write(secrets.token_hex(32))
+                except FileExistsError:
+                    pass
+                with open(path) as f:
+                    _secret = f.read().strip().encode()
+        return _secret
+
+
+def _fingerprint(password_hash, generation):
+    # Changing the password or logging out changes this and so revokes
+    # older tokens
+    return hashlib.sha256(f"{generation}|{password_hash}".encode()).hexdigest()[:16]
+
+
+def _sign(payload):
+    mac = hmac.new(_session_secret(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).decode().rstrip("=")
+
+
+def issue_token(username):
+    """A signed session token for a user of the current tenant, valid for
+    SESSION_HOURS"""
+    user = get_directory().lookup(username)
+    if user is None:
+        return None
+    expires = int(time.time() + SESSION_HOURS * 3600)
+    fingerprint = _fingerprint(user[0], get_generations().get(username))
+    payload = f"{current_tenant()}|{username}|{expires}|{fingerprint}"
+    encoded = base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+    return f"{encoded}.{_sign(payload)}"
+
+
+@metrics.timed
+def verify_token(token):
+    """Return (username, role, tenant) for a valid, unexpired token, else None"""
+    try:
+        encoded, signature = token.split(".")
+        payload = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)).decode()
+        tenant, rest = payload.split("|", 1)
+        username, expires, fingerprint = rest.rsplit("|", 2)
+        tenant = check_tenant(tenant)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not hmac.compare_digest(signature.encode(), _sign(payload).encode()) or int(expires) < time.time():
+        return None
+    if not os.path.isdir(tenant_dir(tenant)):
+        return None  # the tenant's shard is gone
+    with use_tenant(tenant):
+        user = get_directory().lookup(username)
+    if user is None:
+        return None
+    current = _fingerprint(user[0], get_generations(tenant).get(username))
+    if not hmac.compare_digest(fingerprint, current):
+        return None
+    return username, user[1], tenant
+
+
+def revoke_sessions(username):
+    """Log a user of the current tenant out everywhere: every session
+    token issued so far stops verifying"""
+    get_generations().revoke(username)
+
+
 def reset_password(username, new_password):
     """Reset user password"""
     try:
-        users_df = pd.read_csv("data/users.csv")
-        if username in users_df['username'].values:
-            users_df.loc[users_df['username'] == username, 'password'] = hash_password(new_password)
-            users_df.to_csv("data/users.csv", index=False)
-            return True
+        return get_store("users").update(username, password=hash_password(new_password))
     except Exception as e:
         st.error(f"Error resetting password: {str(e)}")
     return False
 
+
+@metrics.timed
 def create_user(username, password, role):
     """Create a new user"""
     try:
-        users_df = pd.read_csv("data/users.csv")
-        if username in users_df['username'].values:
+        users = get_store("users")
+        if get_directory().lookup(username) is not None:
             return False, "Username already exists"
 
-        new_user = pd.DataFrame({
-            'username': [username],
-            'password': [hash_password(password)],
-            'role': [role]
+        users.insert({
+            'username': username,
+            'password': hash_password(password),
+            'role': role
         })
-        users_df = pd.concat([users_df, new_user], ignore_index=True)
-        users_df.to_csv("data/users.csv", index=False)
         return True, "User created successfully"
     except Exception as e:
-        return False, f"Error creating user: {str(e)}"
\ No newline at end of file
+        return False, f"Error creating user: {str(e)}"
@@ -0,0 +1,86 @@
+import itertools
+import threading
+from collections import deque, namedtuple
+
+from utils.tenants import current_tenant
+
+# Change events kept for readers catching up; one that falls further
+# behind is told to treat every table as changed
+FEED_SIZE = 10000
+
+# op is "insert", "update" or "delete" for a row, or "reload" when a
+# whole table was rewritten (bulk import, purge) and key is None.
+# version is the table's backend version after the write.
+Change = namedtuple("Change", "seq table key op version")
+
+
+class ChangeFeed:
+    """Row-level change events of every write made through the stores of
+    one tenant in this process, numbered in order.
+
+    Readers either subscribe() a callback, called with each batch of
+    events right after the write, or remember the last seq they saw
+    and ask for what came after it with since(). Writes by other
+    processes do not appear here; they show as a moved backend version.
+    """
+
+    def __init__(self, size=FEED_SIZE):
+        self._events = deque(maxlen=size)
+        self._seq = itertools.count(1)
+        self._last = 0
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def publish(self, table, changes, version):
+        """Record (key, op) changes just written to table"""
+        with self._lock:
+            events = []
+            for key, op in changes:
+                self._last = next(self._seq)
+                events.append(Change(self._last, table, key, op, version))
+            self._events.extend(events)
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber(events)
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def latest(self):
+        """seq of the newest event, 0 before the first"""
+        with self._lock:
+            return self._last
+
+    def since(self, seq, tables=None):
+        """Events after seq, oldest first, optionally only those of
+        `tables`; None when some of them are no longer kept"""
+        with self._lock:
+            if seq >= self._last:
+                return []
+            if not self._events or self._events[0].seq > seq + 1:
+                return None
+            # Events are numbered without gaps, so the first wanted one
+            # sits at a known offset from the oldest kept
+            start = seq + 1 - self._events[0].seq
+            events = list(itertools.islice(self._events, start, None))
+        if tables is not None:
+            events = [e for e in events if e.table in tables]
+        return events
+
+
+_feeds = {}
+_lock = threading.Lock()
+
+
+def get_feed(tenant=None):
+    """Return the change feed of a tenant (by default the current one)"""
+    tenant = current_tenant() if tenant is None else tenant
+    with _lock:
+        if tenant not in _feeds:
+            _feeds[tenant] = ChangeFeed()
+        return _feeds[tenant]
@@ -0,0 +1,165 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+from utils import metrics
+from utils.aggregates import get_views
+from utils.database import get_backend, get_store
+from utils.reports import daily_hours
+from utils.tenants import current_tenant
+
+CHART_CACHE_SIZE = 256
+# Points a line chart is downsampled to when its series is longer
+MAX_POINTS = int(os.environ.get("TASKTRACKER_CHART_POINTS", 500))
+BAR_COLOR = '#2596be'
+
+
+class ChartCache:
+    """Chart data and built figures by tenant, name, parameters and table
+    versions, least recently used evicted.
+
+    A figure is built once per change of the tables it is drawn from and
+    then shared by every session; st.plotly_chart() only serializes it.
+    Cached values are shared and must not be modified.
+    """
+
+    def __init__(self, size=CHART_CACHE_SIZE):
+        self.size = size
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, tables, build, *params):
+        backend = get_backend()
+        key = (current_tenant(), name, params, tuple(backend.version(t) for t in tables))
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                self.hits += 1
+                return self._values[key]
+            self.misses += 1
+        with metrics.span(f"utils.charts.build.{name}"):
+            value = build()
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._values)}
+
+
+_charts = ChartCache()
+
+
+def cached(name, tables, build, *params):
+    """build() for this name and params, reused until one of `tables` changes"""
+    return _charts.get(name, tables, build, *params)
+
+
+def chart_stats():
+    return _charts.stats()
+
+
+metrics.register_stats("chart_cache", chart_stats)
+
+
+def lttb(x, y, points):
+    """Indices of the `points` samples Largest-Triangle-Three-Buckets keeps
+    from the series (x ascending): first, last and, per bucket, the point
+    forming the largest triangle with its neighbours' picks"""
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    keep = np.empty(points, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket stands in for the not-yet-chosen point
+        nlo, nhi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+
+def downsample(df, x, y, points=MAX_POINTS):
+    """df reduced to `points` rows with LTTB when it is longer"""
+    if len(df) <= points:
+        return df
+    xs = df[x]
+    if pd.api.types.is_datetime64_any_dtype(xs):
+        xs = xs.astype("int64")
+    return df.iloc[lttb(xs.to_numpy(), df[y].fillna(0).to_numpy(), points)]
+
+
+def task_status_pie():
+    def build():
+        counts = get_views().frame("tasks_by_status", "count").sort_values('count', ascending=False)
+        if counts.empty:
+            return None
+        return px.pie(counts, values='count', names='status', title="Task Status Distribution",
+                      color_discrete_sequence=px.colors.sequential.Blues)
+    return cached("task_status_pie", ["tasks"], build)
+
+
+def task_severity_bar():
+    def build():
+        counts = get_views().frame("tasks_by_severity", "count").sort_values('count', ascending=False)
+        return px.bar(counts, x='severity', y='count', title="Task Severity Distribution",
+                      color_discrete_sequence=[BAR_COLOR])
+    return cached("task_severity_bar", ["tasks"], build)
+
+
+def employee_hours_bar():
+    def build():
+        hours = get_views().frame("hours_by_employee", "hours_worked")
+        if hours.empty:
+            return None
+        return px.bar(hours, x='employee', y='hours_worked', title="Total Hours Worked by Employee",
+                      color_discrete_sequence=[BAR_COLOR])
+    return cached("employee_hours_bar", ["timesheets"], build)
+
+
+def my_task_status_pie(username):
+    def build():
+        user_tasks = get_store("tasks").find(assigned_to=username)
+        if user_tasks.empty:
+            return None
+        status_counts = user_tasks['status'].value_counts()
+        return px.pie(values=status_counts.values, names=status_counts.index, title="My Task Status",
+                      color_discrete_sequence=px.colors.sequential.Blues)
+    return cached("my_task_status_pie", ["tasks"], build, username)
+
+
+def my_daily_hours(username):
+    """An employee's hours per day, archived months included"""
+    def build():
+        hours = daily_hours(employees=[username])
+        return hours.groupby('date')['hours'].sum().reset_index(name='hours_worked')
+    return cached("my_daily_hours", ["timesheets"], build, username)
+
+
+def my_daily_hours_line(username):
+    def build():
+        hours = my_daily_hours(username)
+        if hours.empty:
+            return None
+        title = "Daily Hours Worked"
+        if len(hours) > MAX_POINTS:
+            title += f" ({MAX_POINTS} of {len(hours)} days shown)"
+        return px.line(downsample(hours, 'date', 'hours_worked'), x='date', y='hours_worked',
+                       title=title, color_discrete_sequence=[BAR_COLOR])
+    return cached("my_daily_hours_line", ["timesheets"], build, username)
@@ -1,22 +1,2206 @@
 import pandas as pd
+import datetime
+import csv
+import itertools
+import json
+import numpy as np
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from utils import metrics
+from utils.changes import get_feed
+from utils.tenants import DEFAULT_TENANT, current_tenant, use_tenant, valid_tenant
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only coordinate threads of one process
+    fcntl = None
+
+DATA_DIR = os.environ.get("TASKTRACKER_DATA_DIR", "data")
+# Each tenant but the default one keeps its tables, archive and log files
+# in a shard of its own, data/tenants/<name>
+TENANTS_DIR = "tenants"
+STORAGE_BACKEND = os.environ.get("TASKTRACKER_STORAGE", "sqlite")
+SQLITE_FILE = "tasktracker.db"
+# Versions per table whose row changes SQLite keeps, for other processes'
+# caches to catch up from rather than reload (see SqliteBackend.changes)
+SQLITE_CHANGE_VERSIONS = int(os.environ.get("TASKTRACKER_SQLITE_CHANGE_VERSIONS", 1000))
+# "always" fsyncs every write, "normal" leaves flushing to the OS (SQLite
+# synchronous=NORMAL), "never" also disables SQLite's own syncs.
+FSYNC_POLICY = os.environ.get("TASKTRACKER_FSYNC", "normal")
+# Size at which a CSV table's operation log is compacted into the CSV
+COMPACT_BYTES = int(os.environ.get("TASKTRACKER_COMPACT_BYTES", 1024 * 1024))
+# Per-table file format for the file backend, e.g. "timesheets=parquet".
+# Parquet and Arrow (uncompressed IPC, memory-mapped on read) need pyarrow.
+TABLE_FORMATS = dict(
+    item.split("=", 1)
+    for item in os.environ.get("TASKTRACKER_FORMATS", "").split(",")
+    if "=" in item
+)
+FORMAT_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "arrow": ".arrow"}
+# Rows per frame when a table is streamed with Store.scan()
+SCAN_ROWS = int(os.environ.get("TASKTRACKER_SCAN_ROWS", 100000))
+# Months of a partitioned table that are open (the current one included):
+# only these are loaded into the cache and paged; older ones are read from
+# storage on demand until `bulk.py archive` moves them to data/archive.
+# 0 keeps every month open.
+OPEN_MONTHS = int(os.environ.get("TASKTRACKER_OPEN_MONTHS", 3))
+# Set to 1 to have startup archive the closed months as well
+ARCHIVE_ON_START = os.environ.get("TASKTRACKER_ARCHIVE_ON_START", "") not in ("", "0")
+# File format of archived months: "csv.gz", or "parquet" (needs pyarrow)
+ARCHIVE_FORMAT = os.environ.get("TASKTRACKER_ARCHIVE_FORMAT", "csv.gz")
+ARCHIVE_EXTENSIONS = {"csv.gz": ".csv.gz", "parquet": ".parquet"}
+# Archived months kept parsed in memory per table
+ARCHIVE_CACHE_MONTHS = 24
+
+ROLES = ["admin", "employee"]
+SEVERITIES = ["Low", "Medium", "High"]
+TASK_STATUSES = ["Not Started", "In Progress", "Completed"]
+LEAVE_TYPES = ["Vacation", "Sick Leave", "Work from Home"]
+LEAVE_STATUSES = ["Pending", "Approved", "Rejected"]
+# Things the scheduled jobs (utils/scheduler.py) find for someone to act on
+ALERT_KINDS = ["overdue_task", "pending_leave", "closed_session"]
+DATE = "datetime64[ns]"
+
+# Table layout shared by every backend. Column types are SQLite declared
+# types; "dtypes" is the typed in-memory schema every backend loads into
+# (columns not listed stay plain strings).
+TABLES = {
+    "users": {
+        "columns": {"username": "TEXT", "password": "TEXT", "role": "TEXT"},
+        "dtypes": {"role": pd.CategoricalDtype(ROLES)},
+        "key": "username",
+        "unique": True,
+        "indexes": [("role",)],
+    },
+    "tasks": {
+        "columns": {
+            "task_id": "TEXT",
+            "title": "TEXT",
+            "description": "TEXT",
+            "assigned_to": "TEXT",
+            "deadline": "TEXT",
+            "severity": "TEXT",
+            "status": "TEXT",
+            "created_by": "TEXT",
+            "approved": "BOOLEAN",
+        },
+        "dtypes": {
+            "deadline": DATE,
+            "severity": pd.CategoricalDtype(SEVERITIES, ordered=True),
+            "status": pd.CategoricalDtype(TASK_STATUSES),
+            "approved": "bool",
+        },
+        "key": "task_id",
+        "unique": True,
+        "indexes": [("assigned_to",), ("created_by",), ("status",)],
+    },
+    "leaves": {
+        "columns": {
+            "leave_id": "TEXT",
+            "employee": "TEXT",
+            "start_date": "TEXT",
+            "end_date": "TEXT",
+            "leave_type": "TEXT",
+            "status": "TEXT",
+            "reason": "TEXT",
+        },
+        "dtypes": {
+            "start_date": DATE,
+            "end_date": DATE,
+            "leave_type": pd.CategoricalDtype(LEAVE_TYPES),
+            "status": pd.CategoricalDtype(LEAVE_STATUSES),
+        },
+        "key": "leave_id",
+        "unique": True,
+        "indexes": [("employee",), ("status",)],
+    },
+    "timesheets": {
+        "columns": {
+            "timesheet_id": "TEXT",
+            "employee": "TEXT",
+            "date": "TEXT",
+            "login_time": "TEXT",
+            "logout_time": "TEXT",
+            "tasks": "TEXT",
+            "task_notes": "TEXT",
+            "hours_worked": "REAL",
+            "task_id": "TEXT",
+            "description": "TEXT",
+        },
+        "dtypes": {"date": DATE, "hours_worked": "float64"},
+        "key": "timesheet_id",
+        # Older timesheet pages generated one id per employee, so legacy
+        # data may repeat timesheet_id.
+        "unique": False,
+        "indexes": [("employee",), ("employee", "date"), ("date",)],
+        # Closed months move to monthly archive files; the manifest keeps
+        # row counts and hours per employee for each archived month
+        "partition": {"by": "date", "group": "employee", "sum": "hours_worked"},
+    },
+    "alerts": {
+        "columns": {
+            "alert_id": "TEXT",
+            "kind": "TEXT",
+            "ref": "TEXT",
+            "employee": "TEXT",
+            "message": "TEXT",
+            "created": "TEXT",
+        },
+        "dtypes": {"kind": pd.CategoricalDtype(ALERT_KINDS), "created": DATE},
+        # "<kind>:<ref>", so a job raising the same alert twice is a no-op
+        "key": "alert_id",
+        "unique": True,
+        "indexes": [("kind",), ("employee",)],
+    },
+}
+
+
+def table_columns(table):
+    """Return the column names of a table"""
+    return list(TABLES[table]["columns"])
+
+
+def _clean_value(value):
+    """Convert pandas/numpy scalars to plain Python values for storage.
+
+    Dates become "YYYY-MM-DD" strings, the format every table stores.
+    """
+    if value is None or type(value) is str:
+        return value
+    if isinstance(value, np.datetime64):
+        value = pd.Timestamp(value)
+    try:
+        if pd.isna(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if isinstance(value, datetime.date):
+        if isinstance(value, datetime.datetime) and value.time() != datetime.time():
+            return value.isoformat(sep=" ")
+        return value.strftime("%Y-%m-%d")
+    if hasattr(value, "item"):
+        value = value.item()
+    return value
+
+
+def plain_column(series):
+    """A column as the plain Python values _clean_value() would give,
+    converted in one vectorized pass"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.dt.strftime("%Y-%m-%d").astype(object).where(series.notna(), None)
+    return series.astype(object).where(series.notna(), None)
+
+
+def plain_records(df):
+    """Rows of a frame as dicts of plain Python values"""
+    if df.empty:
+        return []
+    names = list(df.columns)
+    columns = [plain_column(df[c]).tolist() for c in names]
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def date_str(value):
+    """Format a date cell for display, "" when missing"""
+    value = _clean_value(value)
+    return "" if value is None else str(value)
+
+
+def _coerce_column(series, dtype):
+    if isinstance(dtype, pd.CategoricalDtype):
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return series
+        # Keep values outside the known set rather than turning them into NaN
+        extra = sorted(set(series.dropna().astype(str)) - set(dtype.categories))
+        if extra:
+            dtype = pd.CategoricalDtype(
+                list(dtype.categories) + extra, ordered=dtype.ordered
+            )
+        return series.astype(object).where(series.notna(), None).astype(dtype)
+    if dtype == DATE:
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return series
+        return pd.to_datetime(series, errors="coerce")
+    if dtype == "bool":
+        if series.dtype == bool:
+            return series
+        return series.map(lambda v: str(v).lower() in ("true", "1", "1.0"))
+    if dtype == "float64":
+        return pd.to_numeric(series, errors="coerce").astype("float64")
+    return series.astype(dtype)
+
+
+def _text_columns(table):
+    dtypes = TABLES[table]["dtypes"]
+    return [c for c in TABLES[table]["columns"] if c not in dtypes]
+
+
+def coerce_types(table, df):
+    """Cast a freshly read frame to the table's typed schema, in place"""
+    for column, dtype in TABLES[table]["dtypes"].items():
+        if column in df:
+            df[column] = _coerce_column(df[column], dtype)
+    for column in _text_columns(table):
+        # All-empty text columns otherwise come back as float NaN
+        if column in df and not pd.api.types.is_string_dtype(df[column]):
+            df[column] = df[column].astype(object)
+    return df
+
+
+def _assign(df, mask, column, value):
+    """df.loc[mask, column] = value without breaking the column's dtype"""
+    series = df[column]
+    value = _clean_value(value)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        if value is not None and value not in series.cat.categories:
+            df[column] = series.cat.add_categories([value])
+    elif pd.api.types.is_datetime64_any_dtype(series):
+        value = pd.NaT if value is None else pd.Timestamp(value)
+    elif series.dtype == bool:
+        value = str(value).lower() in ("true", "1")
+    elif pd.api.types.is_float_dtype(series):
+        value = np.nan if value is None else float(value)
+    elif not (pd.api.types.is_string_dtype(series) and (value is None or isinstance(value, str))):
+        df[column] = series.astype(object)
+    df.loc[mask, column] = value
+
+
+class StaleWriteError(Exception):
+    """Raised when a row changed since the caller read it"""
+
+
+class DuplicateKeyError(StaleWriteError):
+    """Raised when an insert repeats the key of a row already in a table
+    with unique keys"""
+
+    def __init__(self, table, key=None):
+        if key is None:
+            super().__init__(f"A {table} row with one of these keys already exists")
+        else:
+            super().__init__(f"{table} row {key!r} already exists")
+
+
+def _check_expected(table, key, rows, expected):
+    """Reject an update whose expected column values no longer match"""
+    for column, value in (expected or {}).items():
+        for current in rows[column]:
+            if _clean_value(current) != _clean_value(value):
+                raise StaleWriteError(
+                    f"{table} row {key!r} was changed by someone else "
+                    f"({column} is now {_clean_value(current)!r})"
+                )
+
+
+class FileLock:
+    """Re-entrant exclusive lock shared by threads and worker processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+        self._owner = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            self._fd = fd
+            self._owner = threading.get_ident()
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            self._owner = None
+        self._thread_lock.release()
+
+    @contextmanager
+    def shared(self):
+        """Shared (reader) hold; a no-op if this thread already writes"""
+        if self._owner == threading.get_ident() or fcntl is None:
+            yield self
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            yield self
+        finally:
+            os.close(fd)
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def _csv_header(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return next(csv.reader(f), [])
+
+
+def _stat_token(stat):
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def index_specs(table):
+    """Column tuples the cache keeps hash indexes on: the key plus TABLES indexes"""
+    spec = TABLES[table]
+    return [(spec["key"],)] + [tuple(i) for i in spec["indexes"]]
+
+
+def _index_key(values):
+    return tuple(_clean_value(v) for v in values)
+
+
+def _is_list(value):
+    return isinstance(value, (list, tuple, set))
+
+
+def _bound(table, column, value):
+    """A range bound in the column's in-memory type"""
+    if TABLES[table]["dtypes"].get(column) == DATE:
+        return pd.Timestamp(value)
+    return value
+
+
+def filter_mask(table, df, criteria, exclude=None, ranges=None, any_of=None):
+    """Boolean mask of the rows of df matching TableCache.find() filters"""
+    mask = pd.Series(True, index=df.index)
+    for column, value in criteria.items():
+        mask &= df[column].isin(value) if _is_list(value) else df[column] == value
+    for column, value in (exclude or {}).items():
+        mask &= df[column] != value
+    for column, (low, high) in (ranges or {}).items():
+        if low is not None:
+            mask &= df[column] >= _bound(table, column, low)
+        if high is not None:
+            mask &= df[column] <= _bound(table, column, high)
+    if any_of:
+        either = pd.Series(False, index=df.index)
+        for column, value in any_of.items():
+            either |= df[column] == value
+        mask &= either
+    return mask
+
+
+def _where(criteria, exclude=None, ranges=None, any_of=None):
+    """SQL WHERE clause and parameters for TableCache.find() filters"""
+    clauses, params = [], []
+    for column, value in criteria.items():
+        if _is_list(value):
+            marks = ", ".join("?" for _ in value)
+            clauses.append(f'"{column}" IN ({marks})')
+            params += [_clean_value(v) for v in value]
+        else:
+            clauses.append(f'"{column}" IS ?')
+            params.append(_clean_value(value))
+    for column, value in (exclude or {}).items():
+        clauses.append(f'"{column}" IS NOT ?')
+        params.append(_clean_value(value))
+    for column, (low, high) in (ranges or {}).items():
+        if low is not None:
+            clauses.append(f'"{column}" >= ?')
+            params.append(_clean_value(low))
+        if high is not None:
+            clauses.append(f'"{column}" <= ?')
+            params.append(_clean_value(high))
+    if any_of:
+        clauses.append(
+            "(" + " OR ".join(f'"{c}" IS ?' for c in any_of) + ")"
+        )
+        params += [_clean_value(v) for v in any_of.values()]
+    return " AND ".join(clauses) or "1", params
+
+
+def build_index(df, columns):
+    """Map each distinct value tuple of `columns` to the set of row labels"""
+    if df.empty:
+        return {}
+    # Rows sorted by group code, split at each change of code: one array
+    # of labels per group, without a per-group pandas lookup
+    codes = df.groupby(list(columns), observed=True, dropna=False, sort=False).ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+    bounds = np.flatnonzero(np.diff(codes[order])) + 1
+    labels = np.split(df.index.to_numpy()[order], bounds)
+    firsts = order[np.r_[0, bounds]]
+    keys = zip(*(plain_column(df[c]).to_numpy()[firsts] for c in columns))
+    return {key: set(group.tolist()) for key, group in zip(keys, labels)}
+
+
+def _ensure_index(df, indexes, columns):
+    if columns not in indexes:
+        indexes[columns] = build_index(df, columns)
+    return indexes[columns]
+
+
+def _index_rows(df, indexes, labels, add, only=None):
+    """Add or remove rows from the indexes, optionally only those covering `only` columns"""
+    labels = list(labels)
+    for columns, index in indexes.items():
+        if only is not None and not set(columns) & set(only):
+            continue
+        rows = df.loc[labels, list(columns)]
+        values = zip(*(plain_column(rows[c]) for c in columns))
+        for label, value in zip(labels, values):
+            if add:
+                index.setdefault(value, set()).add(label)
+            else:
+                bucket = index.get(value)
+                if bucket is not None:
+                    bucket.discard(label)
+                    if not bucket:
+                        del index[value]
+
+
+def apply_records(table, df, records, indexes=None):
+    """Return df with insert/update/delete records applied in order.
+
+    Rows are located through the hash index on the table key, and any
+    indexes passed in are kept in step with the returned frame. The
+    input frame is never modified, so cached frames handed out to
+    readers stay stable.
+    """
+    if not records:
+        return df
+    if indexes is None:
+        indexes = {}
+    key = (TABLES[table]["key"],)
+    inserts = []
+    copied = False
+
+    for record in records:
+        op = record["op"]
+        if op == "insert":
+            inserts.append(record["row"])
+            continue
+        if inserts:
+            df = _concat_rows(table, df, inserts, indexes)
+            inserts = []
+            copied = True
+        key_index = _ensure_index(df, indexes, key)
+        labels = sorted(key_index.get(_index_key([record["key"]]), ()))
+        if not labels:
+            continue
+        if op == "update":
+            if not copied:
+                df = df.copy()
+                copied = True
+            changes = record["changes"]
+            _index_rows(df, indexes, labels, add=False, only=changes)
+            for column, value in changes.items():
+                _assign(df, labels, column, value)
+            _index_rows(df, indexes, labels, add=True, only=changes)
+        elif op == "delete":
+            _index_rows(df, indexes, labels, add=False)
+            df = df.drop(index=labels)
+            copied = True
+    if inserts:
+        df = _concat_rows(table, df, inserts, indexes)
+    return df
+
+
+def _project_record(record, columns):
+    """A log record limited to `columns`, for frames holding only those"""
+    if record["op"] != "update":
+        return record
+    changes = {c: v for c, v in record["changes"].items() if c in columns}
+    return {**record, "changes": changes}
+
+
+def _concat_rows(table, df, rows, indexes):
+    new = coerce_types(table, pd.DataFrame(rows, columns=df.columns))
+    # Continue the label sequence so index entries for existing rows stay valid
+    start = int(df.index[-1]) + 1 if len(df) else 0
+    new.index = pd.RangeIndex(start, start + len(new))
+    for column in df.columns:
+        old_dtype, new_dtype = df[column].dtype, new[column].dtype
+        if isinstance(old_dtype, pd.CategoricalDtype) and isinstance(
+            new_dtype, pd.CategoricalDtype
+        ):
+            # Same categories on both sides keeps the column categorical
+            categories = list(old_dtype.categories) + [
+                c for c in new_dtype.categories if c not in old_dtype.categories
+            ]
+            if categories != list(old_dtype.categories):
+                df = df.assign(**{column: df[column].cat.set_categories(categories)})
+            new[column] = new[column].cat.set_categories(categories)
+    _index_rows(new, indexes, new.index, add=True)
+    return pd.concat([df, new])
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError(
+            "Parquet/Arrow table formats need pyarrow (pip install pyarrow)"
+        ) from e
+    return pyarrow
+
+
+def read_table_file(table, path):
+    """Load a CSV, Parquet or Arrow file into the table's typed schema"""
+    ext = os.path.splitext(path)[1]
+    metrics.count("bytes_read", os.path.getsize(path), table=table)
+    if ext in (".csv", ".gz"):
+        # pandas decompresses .csv.gz by itself
+        df = pd.read_csv(path, dtype={c: str for c in _text_columns(table)})
+    elif ext == ".parquet":
+        pa = _require_pyarrow()
+        df = pa.parquet.read_table(path, memory_map=True).to_pandas()
+    elif ext == ".arrow":
+        pa = _require_pyarrow()
+        df = pa.feather.read_table(path, memory_map=True).to_pandas()
+    else:
+        raise ValueError(f"Unknown table file type: {path}")
+    return coerce_types(table, df.reindex(columns=table_columns(table)))
+
+
+def iter_table_file(table, path, f, columns, chunk_size):
+    """Read an open table file in typed frames of at most chunk_size rows,
+    loading only `columns` (missing ones come back empty)"""
+    ext = os.path.splitext(path)[1]
+    if ext == ".csv":
+        text = {c: str for c in _text_columns(table) if c in columns}
+        chunks = pd.read_csv(
+            f, dtype=text, usecols=lambda c: c in columns, chunksize=chunk_size
+        )
+    elif ext == ".parquet":
+        pa = _require_pyarrow()
+        parquet = pa.parquet.ParquetFile(f)
+        present = [c for c in columns if c in parquet.schema_arrow.names]
+        chunks = (
+            batch.to_pandas()
+            for batch in parquet.iter_batches(batch_size=chunk_size, columns=present)
+        )
+    elif ext == ".arrow":
+        pa = _require_pyarrow()
+        reader = pa.ipc.open_file(f)
+        present = [c for c in columns if c in reader.schema.names]
+        chunks = (
+            pa.Table.from_batches([reader.get_batch(i)]).select(present).to_pandas()
+            for i in range(reader.num_record_batches)
+        )
+    else:
+        raise ValueError(f"Unknown table file type: {path}")
+    for chunk in chunks:
+        yield coerce_types(table, chunk.reindex(columns=columns))
+
+
+def write_table_file(table, df, path):
+    """Write a frame as CSV, Parquet or Arrow, chosen by the path's extension"""
+    ext = os.path.splitext(path)[1]
+    if ext == ".csv":
+        df.to_csv(path, index=False)
+        return
+    if ext == ".gz":
+        df.to_csv(path, index=False, date_format="%Y-%m-%d",
+                  compression={"method": "gzip", "compresslevel": 6})
+        return
+    pa = _require_pyarrow()
+    df = coerce_types(table, df.reindex(columns=table_columns(table)).copy())
+    arrow_table = pa.Table.from_pandas(df, preserve_index=False)
+    if ext == ".parquet":
+        pa.parquet.write_table(arrow_table, path)
+    elif ext == ".arrow":
+        # Uncompressed so readers can memory-map it without decoding
+        pa.feather.write_feather(arrow_table, path, compression="uncompressed")
+    else:
+        raise ValueError(f"Unknown table file type: {path}")
+
+
+def convert_table_file(table, source, target):
+    """Convert a table between CSV, Parquet and Arrow files"""
+    write_table_file(table, read_table_file(table, source), target)
+
+
+def make_record(table, operation):
+    """The stored form of an insert/update/delete operation: values
+    cleaned, inserts padded to every column, `expected` dropped"""
+    op = operation["op"]
+    if op == "insert":
+        row = operation["row"]
+        return {"op": op, "row": {c: _clean_value(row.get(c)) for c in table_columns(table)}}
+    record = {"op": op, "key": _clean_value(operation["key"])}
+    if op == "update":
+        changes = operation["changes"]
+        unknown = set(changes) - set(TABLES[table]["columns"])
+        if unknown:
+            raise ValueError(f"Unknown {table} columns {sorted(unknown)}")
+        record["changes"] = {c: _clean_value(v) for c, v in changes.items()}
+    return record
+
+
+def _replayable(table, record):
+    """A logged record as apply_records() can take it, or None if it is
+    malformed; changes to columns the table lacks are dropped, so one bad
+    entry (from before make_record checked them) never makes the whole
+    table unreadable"""
+    if not isinstance(record, dict):
+        return None
+    op = record.get("op")
+    if op == "insert":
+        return record if isinstance(record.get("row"), dict) else None
+    if op not in ("update", "delete") or "key" not in record:
+        return None
+    if op == "update":
+        changes = record.get("changes")
+        if not isinstance(changes, dict):
+            return None
+        columns = TABLES[table]["columns"]
+        if set(changes) - set(columns):
+            record = {**record, "changes": {c: v for c, v in changes.items() if c in columns}}
+    return record
+
+
+class CsvBackend:
+    """Stores each table as data/<table>.csv plus an operation log.
+
+    Inserts, updates and deletes are appended as one JSON record each to
+    data/<table>.log; the CSV is only rewritten when the log is compacted
+    into it, which happens in a background thread once the log passes
+    COMPACT_BYTES and on startup to recover from a crash. Compacted
+    records are appended to data/<table>.audit.jsonl.
+
+    Writers hold data/.<table>.lock exclusively; reads take it shared so
+    they never see a freshly compacted CSV together with the old log.
+    """
+
+    name = "csv"
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._compacting = set()
+
+    def path(self, table, fmt=None):
+        fmt = fmt or TABLE_FORMATS.get(table, "csv")
+        return os.path.join(self.data_dir, table + FORMAT_EXTENSIONS[fmt])
+
+    def log_path(self, table):
+        return os.path.join(self.data_dir, f"{table}.log")
+
+    def audit_path(self, table):
+        return os.path.join(self.data_dir, f"{table}.audit.jsonl")
+
+    def lock(self, table):
+        with self._locks_guard:
+            if table not in self._locks:
+                path = os.path.join(self.data_dir, f".{table}.lock")
+                self._locks[table] = FileLock(path)
+            return self._locks[table]
+
+    def initialize(self):
+        """Convert tables to their configured format and replay any
+        operation log left behind by a previous run"""
+        for table in TABLES:
+            target = self.path(table)
+            if not os.path.exists(target):
+                with self.lock(table):
+                    for fmt in FORMAT_EXTENSIONS:
+                        source = self.path(table, fmt)
+                        if os.path.exists(target):
+                            break
+                        if os.path.exists(source):
+                            convert_table_file(table, source, target)
+                            os.remove(source)
+                            break
+            log_path = self.log_path(table)
+            if os.path.exists(log_path) and os.path.getsize(log_path):
+                self.compact(table)
+
+    def version(self, table):
+        """Cheap change token: mtime and size of the CSV and of its log"""
+        tokens = []
+        for path in (self.path(table), self.log_path(table)):
+            try:
+                tokens.append(_stat_token(os.stat(path)))
+            except FileNotFoundError:
+                tokens.append(None)
+        return tuple(tokens)
+
+    def _read_base(self, table):
+        path = self.path(table)
+        if not os.path.exists(path):
+            return coerce_types(table, pd.DataFrame(columns=table_columns(table)))
+        return read_table_file(table, path)
+
+    def _read_log(self, table, offset=0):
+        """Parse log records starting at a byte offset"""
+        try:
+            with open(self.log_path(table), "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        metrics.count("bytes_read", len(data), table=table)
+        records = []
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn final record from a crash mid-append
+                break
+            replayable = _replayable(table, record)
+            if replayable is not record:
+                metrics.count("bad_log_records", table=table)
+            if replayable is not None:
+                records.append(replayable)
+        return records
+
+    @metrics.timed
+    def read(self, table, ranges=None):
+        """The whole table, or the rows inside the ranges (column -> (low,
+        high), inclusive and optional bounds)"""
+        with self.lock(table).shared():
+            df = self._read_base(table)
+            df = apply_records(table, df, self._read_log(table))
+        if ranges:
+            df = df[filter_mask(table, df, {}, ranges=ranges)].reset_index(drop=True)
+        return df
+
+    @metrics.timed
+    def scan(self, table, criteria=None, ranges=None, columns=None, chunk_size=SCAN_ROWS):
+        """Yield the rows matching the filters (see TableCache.find) as
+        frames of at most chunk_size rows, holding one chunk at a time.
+
+        The file and log are opened under the shared lock and then read
+        without it; the open handle keeps reading the same snapshot even
+        if the table is compacted meanwhile.
+        """
+        criteria = criteria or {}
+        ranges = ranges or {}
+        columns = list(columns or table_columns(table))
+        key = TABLES[table]["key"]
+        needed = columns + [
+            c for c in [key, *criteria, *ranges] if c not in columns
+        ]
+        path = self.path(table)
+        with self.lock(table).shared():
+            f = open(path, "rb") if os.path.exists(path) else None
+            records = self._read_log(table)
+        # Updates and deletes may hit any base chunk; logged inserts come last
+        changes = [
+            _project_record(r, needed) for r in records if r["op"] != "insert"
+        ]
+        chunks = iter_table_file(table, path, f, needed, chunk_size) if f else iter(())
+        try:
+            for chunk in chunks:
+                chunk = apply_records(table, chunk, changes)
+                chunk = chunk[filter_mask(table, chunk, criteria, ranges=ranges)]
+                if len(chunk):
+                    yield chunk[columns]
+        finally:
+            if f is not None:
+                f.close()
+        if records:
+            empty = coerce_types(table, pd.DataFrame(columns=needed))
+            tail = apply_records(
+                table, empty, [_project_record(r, needed) for r in records]
+            )
+            tail = tail[filter_mask(table, tail, criteria, ranges=ranges)]
+            for start in range(0, len(tail), chunk_size):
+                yield tail[columns].iloc[start:start + chunk_size]
+
+    @metrics.timed
+    def changes(self, table, since):
+        """Log records written after version `since`, or None if the table was
+        compacted or rewritten in between and must be re-read"""
+        with self.lock(table).shared():
+            current = self.version(table)
+            if since is None or since[0] != current[0]:
+                return None
+            start = since[1][1] if since[1] else 0
+            end = current[1][1] if current[1] else 0
+            if end < start:
+                return None
+            return current, self._read_log(table, start)
+
+    def _write(self, table, df):
+        """Write the whole table to a temp file, then os.replace it into place"""
+        path = self.path(table)
+        fd, tmp = tempfile.mkstemp(
+            dir=self.data_dir, prefix=f".{table}.", suffix=os.path.splitext(path)[1]
+        )
+        os.close(fd)
+        try:
+            os.chmod(tmp, 0o644)
+            write_table_file(table, df, tmp)
+            if FSYNC_POLICY != "never":
+                with open(tmp, "rb") as f:
+                    os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def select(self, table, criteria):
+        df = self.read(table)
+        mask = pd.Series(True, index=df.index)
+        for column, value in criteria.items():
+            mask &= df[column] == value
+        return df[mask]
+
+    def _append(self, table, records):
+        """Append records to the log; caller holds the table lock.
+
+        Returns the (before, after) version tokens when the append is known
+        to be the only change between them, else None.
+        """
+        data = b"".join(
+            json.dumps(record, default=str).encode("utf-8") + b"\n"
+            for record in records
+        )
+        before = self.version(table)
+        with open(self.log_path(table), "ab") as f:
+            f.write(data)
+            f.flush()
+            if FSYNC_POLICY == "always":
+                os.fsync(f.fileno())
+            size = os.fstat(f.fileno()).st_size
+        after = self.version(table)
+        if size > COMPACT_BYTES:
+            self._compact_in_background(table)
+        old_size = before[1][1] if before[1] else 0
+        if after[0] != before[0] or after[1][1] != old_size + len(data):
+            return None
+        return before, after
+
+    def insert(self, table, row, current=None):
+        """Log one new row without reading or rewriting the table (unless
+        there is no `current` to check a unique key against)"""
+        record = make_record(table, {"op": "insert", "row": row})
+        with self.lock(table):
+            if TABLES[table]["unique"]:
+                key = record["row"][TABLES[table]["key"]]
+                if not self._matching(table, key, current).empty:
+                    raise DuplicateKeyError(table, key)
+            return self._append(table, [record])
+
+    def _matching(self, table, key, current):
+        if current is not None:
+            return current(key)
+        df = self.read(table)
+        return df[df[TABLES[table]["key"]] == key]
+
+    def update(self, table, key, changes, expected=None, current=None):
+        """Log an update; `current(key)` returns the row as it stands now
+        (e.g. from the cache's index) so the existence and `expected`
+        checks don't re-read the table"""
+        record = make_record(table, {"op": "update", "key": key, "changes": changes})
+        with self.lock(table):
+            rows = self._matching(table, key, current)
+            if rows.empty:
+                return 0, None
+            _check_expected(table, key, rows, expected)
+            return len(rows), self._append(table, [record])
+
+    def delete(self, table, key, expected=None, current=None):
+        record = make_record(table, {"op": "delete", "key": key})
+        with self.lock(table):
+            rows = self._matching(table, key, current)
+            if rows.empty:
+                return 0, None
+            _check_expected(table, key, rows, expected)
+            return len(rows), self._append(table, [record])
+
+    @metrics.timed
+    def bulk_insert(self, table, chunks):
+        """Add every row of an iterable of row-dict lists as one atomic
+        change; returns the number of rows.
+
+        CSV tables are copied to a temp file with the rows appended and
+        swapped in with os.replace, which keeps a large import out of the
+        operation log (and out of memory on the next read). Parquet and
+        Arrow tables get the rows through the log instead.
+        """
+        count = 0
+        path = self.path(table)
+        with self.lock(table):
+            if not path.endswith(".csv"):
+                for rows in chunks:
+                    self._append(table, [make_record(table, {"op": "insert", "row": r}) for r in rows])
+                    count += len(rows)
+                return count
+            columns = table_columns(table)
+            fd, tmp = tempfile.mkstemp(dir=self.data_dir, prefix=f".{table}.", suffix=".csv")
+            try:
+                os.chmod(tmp, 0o644)
+                with os.fdopen(fd, "w", newline="", encoding="utf-8") as out:
+                    if os.path.exists(path) and _csv_header(path) == columns:
+                        with open(path, newline="", encoding="utf-8") as base:
+                            shutil.copyfileobj(base, out)
+                        if out.tell() and not _ends_with_newline(path):
+                            out.write("\n")
+                    elif os.path.exists(path):
+                        # Older file missing some columns: rewrite it in full first
+                        read_table_file(table, path).to_csv(out, index=False)
+                    else:
+                        out.write(",".join(columns) + "\n")
+                    for rows in chunks:
+                        pd.DataFrame(rows, columns=columns).to_csv(out, header=False, index=False)
+                        count += len(rows)
+                    out.flush()
+                    if FSYNC_POLICY != "never":
+                        os.fsync(out.fileno())
+                os.replace(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        return count
+
+    @metrics.timed
+    def purge(self, table, ranges):
+        """Delete every row inside the ranges (see TableCache.find) by
+        rewriting the table; returns the number of rows deleted"""
+        with self.lock(table):
+            self.compact(table)
+            df = self._read_base(table)
+            mask = filter_mask(table, df, {}, ranges=ranges)
+            if mask.any():
+                self._write(table, df[~mask])
+            return int(mask.sum())
+
+    @metrics.timed
+    def write_batch(self, table, operations, current=None):
+        """Check every operation's `expected` values, then log them all in
+        one append; returns (rows affected, (before, after) versions)"""
+        records = [make_record(table, operation) for operation in operations]
+        unique = TABLES[table]["unique"]
+        with self.lock(table):
+            count = 0
+            # Keys the batch itself inserts or deletes, in order, for the
+            # unique-key check as SQLite makes it row by row
+            added, removed = set(), set()
+            for operation, record in zip(operations, records):
+                if operation["op"] == "insert":
+                    key = record["row"][TABLES[table]["key"]]
+                    if unique and (key in added or (
+                        key not in removed and not self._matching(table, key, current).empty
+                    )):
+                        raise DuplicateKeyError(table, key)
+                    added.add(key)
+                    count += 1
+                    continue
+                if operation["op"] == "delete":
+                    added.discard(record["key"])
+                    removed.add(record["key"])
+                rows = self._matching(table, operation["key"], current)
+                _check_expected(table, operation["key"], rows, operation.get("expected"))
+                count += len(rows)
+            if not count:
+                return 0, None
+            return count, self._append(table, records)
+
+    @metrics.timed
+    def compact(self, table):
+        """Fold the operation log into the CSV and archive it for auditing"""
+        with self.lock(table):
+            log_path = self.log_path(table)
+            if not os.path.exists(log_path) or not os.path.getsize(log_path):
+                return
+            records = self._read_log(table)
+            base = self._read_base(table)
+            df = apply_records(table, base, records)
+            # A crash between replacing the CSV and truncating the log means
+            # the log is replayed twice on recovery; updates and deletes are
+            # idempotent, and inserted rows get a second copy. Drop a row
+            # inserted from the log when the file already holds that key
+            # with the same values; rows that were in the file are kept as
+            # they are, duplicates included.
+            start = int(base.index[-1]) + 1 if len(base) else 0
+            key = TABLES[table]["key"]
+            kept_keys = df.loc[df.index < start, key]
+            replayed = (df.index >= start) & df[key].isin(kept_keys)
+            self._write(table, df[~(replayed & df.duplicated(keep="first"))])
+            with open(self.audit_path(table), "a", encoding="utf-8") as audit:
+                for record in records:
+                    audit.write(json.dumps(record, default=str) + "\n")
+            os.truncate(log_path, 0)
+
+    def _compact_in_background(self, table):
+        with self._locks_guard:
+            if table in self._compacting:
+                return
+            self._compacting.add(table)
+
+        def run():
+            try:
+                self.compact(table)
+            finally:
+                with self._locks_guard:
+                    self._compacting.discard(table)
+
+        threading.Thread(target=run, name=f"compact-{table}", daemon=True).start()
+
+
+class SqliteBackend:
+    """Embedded SQLite storage with indexed tables and per-row writes.
+
+    Every row-level write also stores its records in _changes, tagged
+    with the table version it produced, so another process's cache can
+    catch up by replaying them like the CSV operation log. Bulk imports
+    and purges are not logged; they make readers reload.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, data_dir=DATA_DIR, filename=SQLITE_FILE):
+        self.data_dir = data_dir
+        self.path = os.path.join(data_dir, filename)
+        self._local = threading.local()
+
+    def connection(self):
+        """Return the calling thread's connection, opening it on first use"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            synchronous = {"always": "FULL", "never": "OFF"}.get(FSYNC_POLICY, "NORMAL")
+            conn.execute(f"PRAGMA synchronous={synchronous}")
+            self._local.conn = conn
+        return conn
+
+    def initialize(self):
+        """Create tables and indexes, then import the CSV files once"""
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS _migrations (name TEXT PRIMARY KEY)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS _versions "
+                "(name TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS _changes (seq INTEGER PRIMARY KEY, "
+                "name TEXT NOT NULL, version INTEGER NOT NULL, record TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix__changes_name_version ON _changes (name, version)"
+            )
+            for table, spec in TABLES.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO _versions (name, version) VALUES (?, 0)",
+                    (table,),
+                )
+                columns = ", ".join(
+                    f'"{c}" {t}' for c, t in spec["columns"].items()
+                )
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({columns})')
+                unique = "UNIQUE " if spec["unique"] else ""
+                conn.execute(
+                    f'CREATE {unique}INDEX IF NOT EXISTS "ix_{table}_key" '
+                    f'ON "{table}" ("{spec["key"]}")'
+                )
+                for index in spec["indexes"]:
+                    name = f"ix_{table}_" + "_".join(index)
+                    cols = ", ".join(f'"{c}"' for c in index)
+                    conn.execute(
+                        f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({cols})'
+                    )
+        self.migrate_from_csv()
+
+    def migrate_from_csv(self):
+        """Copy data/<table>.csv into SQLite the first time the table is seen"""
+        conn = self.connection()
+        csv = CsvBackend(self.data_dir)
+        for table in TABLES:
+            name = f"csv:{table}"
+            with conn:
+                # Take the write lock first so concurrent workers import once
+                conn.execute("BEGIN IMMEDIATE")
+                done = conn.execute(
+                    "SELECT 1 FROM _migrations WHERE name = ?", (name,)
+                ).fetchone()
+                if done:
+                    continue
+                rows = []
+                if os.path.exists(csv.path(table)):
+                    df = csv.read(table)
+                    rows = [
+                        tuple(_clean_value(v) for v in record)
+                        for record in df.itertuples(index=False, name=None)
+                    ]
+                # An old CSV may repeat a key; its last copy is kept
+                self._insert_rows(conn, table, rows, replace=TABLES[table]["unique"])
+                self._bump(conn, table)
+                conn.execute("INSERT INTO _migrations (name) VALUES (?)", (name,))
+
+    def _bump(self, conn, table):
+        conn.execute(
+            "UPDATE _versions SET version = version + 1 WHERE name = ?", (table,)
+        )
+
+    def version(self, table):
+        """Change counter for a table, bumped in every write transaction"""
+        row = self.connection().execute(
+            "SELECT version FROM _versions WHERE name = ?", (table,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _insert_rows(self, conn, table, rows, replace=False):
+        """Insert row tuples; a key a unique table already holds raises
+        DuplicateKeyError, or with `replace` overwrites that row"""
+        columns = table_columns(table)
+        placeholders = ", ".join("?" for _ in columns)
+        names = ", ".join(f'"{c}"' for c in columns)
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        try:
+            conn.executemany(
+                f'{verb} INTO "{table}" ({names}) VALUES ({placeholders})', rows
+            )
+        except sqlite3.IntegrityError:
+            # The unique key index is the only constraint on the tables
+            key = rows[0][columns.index(TABLES[table]["key"])] if len(rows) == 1 else None
+            raise DuplicateKeyError(table, key) from None
+
+    def _frame(self, table, sql, params=()):
+        df = pd.read_sql_query(sql, self.connection(), params=params)
+        return coerce_types(table, df.reindex(columns=table_columns(table)))
+
+    @metrics.timed
+    def read(self, table, ranges=None):
+        where, params = _where({}, ranges=ranges)
+        return self._frame(
+            table, f'SELECT * FROM "{table}" WHERE {where} ORDER BY rowid', params
+        )
+
+    @metrics.timed
+    def select(self, table, criteria):
+        where = " AND ".join(f'"{c}" = ?' for c in criteria) or "1"
+        params = [_clean_value(v) for v in criteria.values()]
+        return self._frame(
+            table, f'SELECT * FROM "{table}" WHERE {where} ORDER BY rowid', params
+        )
+
+    @metrics.timed
+    def page(self, table, criteria, offset=0, limit=None, order_by=None,
+             descending=False, exclude=None, ranges=None, any_of=None):
+        """One sorted slice of the matching rows plus the number of matches,
+        filtered, sorted and sliced by SQLite (see TableCache.find for the
+        filter arguments)"""
+        where, params = _where(criteria, exclude, ranges, any_of)
+        total = self.connection().execute(
+            f'SELECT COUNT(*) FROM "{table}" WHERE {where}', params
+        ).fetchone()[0]
+
+        order = "rowid"
+        if order_by:
+            column = f'"{order_by}"'
+            dtype = TABLES[table]["dtypes"].get(order_by)
+            if isinstance(dtype, pd.CategoricalDtype):
+                # Sort enums in declared order, like the categorical columns
+                whens = " ".join(
+                    f"WHEN '{c}' THEN {i}" for i, c in enumerate(dtype.categories)
+                )
+                column = f"CASE {column} {whens} ELSE {len(dtype.categories)} END"
+            direction = "DESC" if descending else "ASC"
+            order = f'"{order_by}" IS NULL, {column} {direction}, rowid'
+        rows = self._frame(
+            table,
+            f'SELECT * FROM "{table}" WHERE {where} ORDER BY {order} '
+            "LIMIT ? OFFSET ?",
+            params + [-1 if limit is None else limit, offset],
+        )
+        return rows, total
+
+    @metrics.timed
+    def scan(self, table, criteria=None, ranges=None, columns=None, chunk_size=SCAN_ROWS):
+        """Yield the rows matching the filters as frames of at most
+        chunk_size rows; filtering and column selection happen in SQLite"""
+        columns = list(columns or table_columns(table))
+        where, params = _where(criteria or {}, ranges=ranges)
+        names = ", ".join(f'"{c}"' for c in columns)
+        cursor = self.connection().execute(
+            f'SELECT {names} FROM "{table}" WHERE {where} ORDER BY rowid', params
+        )
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                yield coerce_types(table, pd.DataFrame(rows, columns=columns))
+        finally:
+            cursor.close()
+
+    def insert(self, table, row, current=None):
+        """Insert one row; returns the (before, after) table versions"""
+        record = make_record(table, {"op": "insert", "row": row})
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._insert_rows(conn, table, [tuple(record["row"].values())])
+            return self._versions_around(conn, table, [record])
+
+    def _check_row(self, conn, table, key, expected):
+        if not expected:
+            return
+        columns = ", ".join(f'"{c}"' for c in expected)
+        rows = conn.execute(
+            f'SELECT {columns} FROM "{table}" WHERE "{TABLES[table]["key"]}" = ?',
+            (key,),
+        ).fetchall()
+        current = coerce_types(table, pd.DataFrame(rows, columns=list(expected)))
+        _check_expected(table, key, current, expected)
+
+    def _versions_around(self, conn, table, records):
+        """Bump the table version and log the records under the new one;
+        returns the (before, after) versions"""
+        before = conn.execute(
+            "SELECT version FROM _versions WHERE name = ?", (table,)
+        ).fetchone()[0]
+        self._bump(conn, table)
+        conn.executemany(
+            "INSERT INTO _changes (name, version, record) VALUES (?, ?, ?)",
+            [(table, before + 1, json.dumps(record, default=str)) for record in records],
+        )
+        conn.execute(
+            "DELETE FROM _changes WHERE name = ? AND version <= ?",
+            (table, before + 1 - SQLITE_CHANGE_VERSIONS),
+        )
+        return before, before + 1
+
+    @metrics.timed
+    def changes(self, table, since):
+        """Records written after version `since` as (version, records), or
+        None if some write in between was not logged (or has been pruned)
+        and the table must be re-read"""
+        if since is None:
+            return None
+        conn = self.connection()
+        with conn:
+            # One read transaction, so the version and the log agree
+            conn.execute("BEGIN")
+            current = conn.execute(
+                "SELECT version FROM _versions WHERE name = ?", (table,)
+            ).fetchone()[0]
+            rows = conn.execute(
+                "SELECT version, record FROM _changes WHERE name = ? AND version > ? "
+                "ORDER BY seq",
+                (table, since),
+            ).fetchall()
+        if current < since or {v for v, _ in rows} != set(range(since + 1, current + 1)):
+            return None
+        return current, [json.loads(record) for _, record in rows]
+
+    def update(self, table, key, changes, expected=None, current=None):
+        """Update rows by key; returns (rowcount, (before, after) versions)"""
+        record = make_record(table, {"op": "update", "key": key, "changes": changes})
+        conn = self.connection()
+        assignments = ", ".join(f'"{c}" = ?' for c in record["changes"])
+        params = list(record["changes"].values()) + [record["key"]]
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._check_row(conn, table, key, expected)
+            cursor = conn.execute(
+                f'UPDATE "{table}" SET {assignments} '
+                f'WHERE "{TABLES[table]["key"]}" = ?',
+                params,
+            )
+            versions = self._versions_around(conn, table, [record])
+        return cursor.rowcount, versions
+
+    def delete(self, table, key, expected=None, current=None):
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._check_row(conn, table, key, expected)
+            cursor = conn.execute(
+                f'DELETE FROM "{table}" WHERE "{TABLES[table]["key"]}" = ?', (key,)
+            )
+            versions = self._versions_around(
+                conn, table, [make_record(table, {"op": "delete", "key": key})]
+            )
+        return cursor.rowcount, versions
+
+    @metrics.timed
+    def bulk_insert(self, table, chunks):
+        """Insert every row of an iterable of row-dict lists in a single
+        transaction; returns the number of rows"""
+        conn = self.connection()
+        columns = table_columns(table)
+        count = 0
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for rows in chunks:
+                self._insert_rows(conn, table, [
+                    tuple(_clean_value(row.get(c)) for c in columns) for row in rows
+                ])
+                count += len(rows)
+            self._bump(conn, table)
+        return count
+
+    @metrics.timed
+    def purge(self, table, ranges):
+        """Delete every row inside the ranges; returns the number of rows"""
+        where, params = _where({}, ranges=ranges)
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.execute(f'DELETE FROM "{table}" WHERE {where}', params)
+            self._bump(conn, table)
+        return cursor.rowcount
+
+    @metrics.timed
+    def write_batch(self, table, operations, current=None):
+        """Run every operation in one transaction; a failed `expected`
+        check rolls back the lot. Returns (rows affected, versions)"""
+        conn = self.connection()
+        key_column = TABLES[table]["key"]
+        count = 0
+        records = []
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for operation in operations:
+                record = make_record(table, operation)
+                records.append(record)
+                if record["op"] == "insert":
+                    self._insert_rows(conn, table, [tuple(record["row"].values())])
+                    count += 1
+                    continue
+                self._check_row(conn, table, record["key"], operation.get("expected"))
+                if record["op"] == "update":
+                    changes = record["changes"]
+                    assignments = ", ".join(f'"{c}" = ?' for c in changes)
+                    cursor = conn.execute(
+                        f'UPDATE "{table}" SET {assignments} WHERE "{key_column}" = ?',
+                        list(changes.values()) + [record["key"]],
+                    )
+                else:
+                    cursor = conn.execute(
+                        f'DELETE FROM "{table}" WHERE "{key_column}" = ?',
+                        (record["key"],),
+                    )
+                count += cursor.rowcount
+            versions = self._versions_around(conn, table, records)
+        return count, versions
+
+
+BACKENDS = {"csv": CsvBackend, "sqlite": SqliteBackend}
+
+
+class _CacheEntry:
+    __slots__ = ("version", "df", "pending", "indexes", "applied")
+
+    def __init__(self, version, df):
+        self.version = version
+        self.df = df
+        self.pending = []
+        # Batches of records folded into df, to tell when it has moved on
+        self.applied = 0
+        # column tuple -> {value tuple: set of row labels}, built on demand
+        self.indexes = {}
+
+
+class TableCache:
+    """Parsed tables shared by every session in the process.
+
+    Each entry remembers the backend version it was read at; a lookup
+    only re-reads the table when backend.version() has moved on, so
+    writes from other processes are picked up too. Backends that can
+    list the records written since a version (the CSV operation log,
+    SQLite's _changes table) are caught up incrementally instead. Cached frames are shared and
+    must be treated as read-only.
+
+    Entries also carry hash indexes on the columns from index_specs(),
+    kept in step with every insert/update/delete applied to the entry,
+    so find() on an indexed column costs O(matches) rather than a scan.
+
+    Listeners registered with subscribe() see the same stream: reset()
+    whenever a table is (re)loaded and apply() with every batch of
+    records folded into a cached frame.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._entries = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._listeners = []
+
+    def subscribe(self, listener):
+        """Register an object with reset(table, df) and apply(table, records)
+        methods, for the tables named in listener.tables"""
+        with self._lock:
+            self._listeners.append(listener)
+            tables = [t for t in listener.tables if t in self._entries]
+            for table in tables:
+                self._fold_pending(table, self._entries[table])
+                listener.reset(table, self._entries[table].df)
+
+    def _apply(self, table, entry, records):
+        entry.df = apply_records(table, entry.df, records, entry.indexes)
+        entry.applied += 1
+        for listener in self._listeners:
+            if table in listener.tables:
+                listener.apply(table, records)
+
+    def _fold_pending(self, table, entry):
+        if entry.pending:
+            # Fold writes made since the last read into the frame
+            self._apply(table, entry, entry.pending)
+            entry.pending = []
+
+    @metrics.timed
+    def get(self, table):
+        version = self.backend.version(table)
+        with self._lock:
+            entry = self._entries.get(table)
+            if entry is not None and entry.version == version:
+                self.hits += 1
+                self._fold_pending(table, entry)
+                return entry.df
+            self.misses += 1
+        changes = getattr(self.backend, "changes", None)
+        if entry is not None and changes is not None:
+            caught_up = changes(table, entry.version)
+            if caught_up is not None:
+                version, records = caught_up
+                with self._lock:
+                    if self._entries.get(table) is entry:
+                        self._fold_pending(table, entry)
+                        self._apply(table, entry, records)
+                        entry.version = version
+                        return entry.df
+        # Read outside the lock; the version taken above may be older than
+        # the data, which only costs one extra reload later.
+        df = self.backend.read(table, open_ranges(table))
+        with self._lock:
+            self._entries[table] = _CacheEntry(version, df)
+        self._reset_listeners(table)
+        return df
+
+    def _reset_listeners(self, table):
+        """Hand the freshly loaded table to the listeners. Rebuilding search
+        indexes and views happens outside the lock, so readers of every
+        table carry on meanwhile. Records folded in (or a newer load) during
+        a rebuild may reach a listener before its reset does, so it is
+        repeated until one saw the cache's latest frame."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(table)
+                if entry is None:
+                    return
+                self._fold_pending(table, entry)
+                df, applied = entry.df, entry.applied
+                listeners = [l for l in self._listeners if table in l.tables]
+            for listener in listeners:
+                listener.reset(table, df)
+            with self._lock:
+                if self._entries.get(table) is entry and entry.applied == applied:
+                    return
+
+    @metrics.timed
+    def find(self, table, criteria, exclude=None, ranges=None, any_of=None):
+        """Rows matching column == value criteria, via a hash index if one
+        covers some of the columns.
+
+        A criteria value may be a list (any of those values). exclude maps
+        column -> value to leave out, ranges column -> (low, high) with
+        inclusive, optional bounds, and any_of column -> value pairs of
+        which at least one must match.
+        """
+        df = self.get(table)
+        scalar = {c: v for c, v in criteria.items() if not _is_list(v)}
+        columns = None
+        for spec in index_specs(table):
+            if set(spec) <= set(scalar) and (columns is None or len(spec) > len(columns)):
+                columns = spec
+        if columns is not None:
+            with self._lock:
+                entry = self._entries.get(table)
+                if entry is not None:
+                    self._fold_pending(table, entry)
+                    df = entry.df
+                    index = _ensure_index(df, entry.indexes, columns)
+                    labels = index.get(_index_key([criteria[c] for c in columns]), ())
+                    df = df.loc[sorted(labels)]
+                    criteria = {c: v for c, v in criteria.items() if c not in columns}
+        if not (criteria or exclude or ranges or any_of):
+            return df
+        return df[filter_mask(table, df, criteria, exclude, ranges, any_of)]
+
+    @metrics.timed
+    def page(self, table, criteria, offset=0, limit=None, order_by=None,
+             descending=False, exclude=None, ranges=None, any_of=None):
+        """One sorted slice of find()'s rows plus the number of matches"""
+        rows = self.find(table, criteria, exclude, ranges, any_of)
+        labels = rows.index
+        if order_by:
+            labels = rows[order_by].sort_values(
+                ascending=not descending, kind="stable", na_position="last"
+            ).index
+        end = None if limit is None else offset + limit
+        return rows.loc[labels[offset:end]], len(rows)
+
+    def apply(self, table, record, versions):
+        """Queue a write this process just made against the cached frame.
+
+        versions is the (before, after) pair returned by the backend; the
+        entry is only patched if it was current at `before`, otherwise it is
+        dropped and re-read on next access.
+        """
+        self.apply_many(table, [record], versions)
+
+    def apply_many(self, table, records, versions):
+        """apply() for a batch written under a single version bump"""
+        with self._lock:
+            entry = self._entries.get(table)
+            if entry is None:
+                return
+            if versions is None or entry.version != versions[0]:
+                self._entries.pop(table)
+                self.invalidations += 1
+                return
+            entry.version = versions[1]
+            entry.pending.extend(records)
+
+    def invalidate(self, table=None):
+        with self._lock:
+            if table is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(table, None)
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": self.hits / total if total else 0.0,
+                "tables": sorted(self._entries),
+            }
+
+
+def _month_bounds(month):
+    """First and last day of a "YYYY-MM" month"""
+    first = pd.Timestamp(f"{month}-01")
+    return first, first + pd.offsets.MonthEnd(0)
+
+
+class PartitionArchive:
+    """Closed months of a partitioned table, one compressed file each.
+
+    data/archive/<table>/<YYYY-MM>.csv.gz (or .parquet) holds the rows of
+    a month that archive_closed_months() moved out of the live table.
+    manifest.json lists every archived month with its row count and the
+    rows and summed value per group (e.g. hours per employee), so readers
+    skip months they do not need without opening them. Archived months
+    are read-only; rows written for a closed month later stay live until
+    the next archive run merges them in.
+    """
+
+    def __init__(self, table, data_dir=DATA_DIR):
+        self.table = table
+        self.spec = TABLES[table]["partition"]
+        self.dir = os.path.join(data_dir, "archive", table)
+        self.lock = FileLock(os.path.join(data_dir, f".{table}.archive.lock"))
+        self._guard = threading.Lock()
+        self._manifest = ({}, None)
+        # (month, file stat) -> parsed frame, least recently used evicted
+        self._frames = OrderedDict()
+
+    def manifest_path(self):
+        return os.path.join(self.dir, "manifest.json")
+
+    def manifest(self):
+        """month -> {"file", "rows", "groups": {group: [rows, sum]}}"""
+        try:
+            token = _stat_token(os.stat(self.manifest_path()))
+        except FileNotFoundError:
+            return {}
+        with self._guard:
+            if self._manifest[1] == token:
+                return self._manifest[0]
+        with open(self.manifest_path(), encoding="utf-8") as f:
+            manifest = json.load(f)
+        with self._guard:
+            self._manifest = (manifest, token)
+        return manifest
+
+    def months(self, low=None, high=None, groups=None):
+        """Archived months, oldest first, overlapping the inclusive date
+        range and holding rows for any of `groups`"""
+        months = []
+        for month, info in sorted(self.manifest().items()):
+            first, last = _month_bounds(month)
+            if low is not None and last < pd.Timestamp(low):
+                continue
+            if high is not None and first > pd.Timestamp(high):
+                continue
+            if groups is not None and not set(groups) & set(info["groups"]):
+                continue
+            months.append(month)
+        return months
+
+    def totals(self):
+        """group -> [rows, sum] over every archived month"""
+        totals = {}
+        for info in self.manifest().values():
+            for group, (rows, value) in info["groups"].items():
+                counts = totals.setdefault(group, [0, 0.0])
+                counts[0] += rows
+                counts[1] += value
+        return totals
+
+    @metrics.timed
+    def read(self, month):
+        """All rows of an archived month (cached, read-only)"""
+        path = os.path.join(self.dir, self.manifest()[month]["file"])
+        key = (month, _stat_token(os.stat(path)))
+        with self._guard:
+            df = self._frames.get(key)
+            if df is not None:
+                self._frames.move_to_end(key)
+                return df
+        df = read_table_file(self.table, path)
+        with self._guard:
+            self._frames[key] = df
+            while len(self._frames) > ARCHIVE_CACHE_MONTHS:
+                self._frames.popitem(last=False)
+        return df
+
+    def find(self, month, criteria=None, ranges=None):
+        df = self.read(month)
+        if not (criteria or ranges):
+            return df
+        return df[filter_mask(self.table, df, criteria or {}, ranges=ranges)]
+
+    @metrics.timed
+    def scan(self, criteria=None, ranges=None, columns=None, chunk_size=SCAN_ROWS):
+        """Store.scan() over the archived months the filters can match"""
+        criteria = criteria or {}
+        low, high = (ranges or {}).get(self.spec["by"], (None, None))
+        groups = criteria.get(self.spec["group"])
+        if groups is not None and not _is_list(groups):
+            groups = [groups]
+        columns = list(columns or table_columns(self.table))
+        for month in self.months(low, high, groups):
+            rows = self.find(month, criteria, ranges)
+            for start in range(0, len(rows), chunk_size):
+                yield rows[columns].iloc[start:start + chunk_size]
+
+    def add(self, month, df):
+        """Merge rows into a month's file and record it in the manifest"""
+        with self.lock:
+            os.makedirs(self.dir, exist_ok=True)
+            manifest = dict(self.manifest())
+            old = manifest.get(month)
+            if old is not None:
+                df = pd.concat([self.read(month), df], ignore_index=True)
+            # Re-running after a crash before the purge archives rows twice
+            df = df.drop_duplicates(ignore_index=True)
+            name = month + ARCHIVE_EXTENSIONS[ARCHIVE_FORMAT]
+            self._write_atomic(name, lambda tmp: write_table_file(self.table, df, tmp))
+            group, value = self.spec["group"], self.spec["sum"]
+            stats = df.groupby(group, observed=True)[value].agg(["size", "sum"])
+            manifest[month] = {
+                "file": name,
+                "rows": len(df),
+                "groups": {
+                    g: [int(n), float(total)]
+                    for g, n, total in zip(stats.index, stats["size"], stats["sum"])
+                },
+            }
+            def write_manifest(tmp):
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(manifest, f, indent=1)
+
+            self._write_atomic("manifest.json", write_manifest)
+            if old is not None and old["file"] != name:
+                os.remove(os.path.join(self.dir, old["file"]))
+
+    def _write_atomic(self, name, write):
+        ext = ".csv.gz" if name.endswith(".csv.gz") else os.path.splitext(name)[1]
+        fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=".tmp.", suffix=ext)
+        os.close(fd)
+        try:
+            os.chmod(tmp, 0o644)
+            write(tmp)
+            if FSYNC_POLICY != "never":
+                with open(tmp, "rb") as f:
+                    os.fsync(f.fileno())
+            os.replace(tmp, os.path.join(self.dir, name))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+class Store:
+    """Row-level access to one table through the configured backend"""
+
+    table = None
+
+    def __init__(self, backend, cache, tenant=DEFAULT_TENANT):
+        self.backend = backend
+        self.cache = cache
+        self.tenant = tenant
+
+    @property
+    def key(self):
+        return TABLES[self.table]["key"]
+
+    def all(self):
+        """Return the whole table from the shared cache (read-only)"""
+        return self.cache.get(self.table)
+
+    def find(self, **criteria):
+        """Rows where each column equals the given value (indexed columns
+        are looked up by hash)"""
+        return self.cache.find(self.table, criteria)
+
+    def get(self, key):
+        """Return the row with the given primary key as a dict, or None"""
+        rows = self.find(**{self.key: key})
+        if rows.empty:
+            return None
+        return rows.iloc[0].to_dict()
+
+    def query(self, offset=0, limit=None, order_by=None, descending=False,
+              exclude=None, ranges=None, any_of=None, **criteria):
+        """Return (rows, total): one page of the rows matching the filters,
+        sorted by order_by, and the number of rows matching overall.
+
+        Filtering, sorting and slicing happen in the backend when it can
+        do so (SQLite), otherwise against the cached, indexed frame. Like
+        the cache, pages of a partitioned table only cover its open months.
+        """
+        for column, (cutoff, _) in (open_ranges(self.table) or {}).items():
+            low, high = (ranges or {}).get(column, (None, None))
+            if low is None or pd.Timestamp(low) < cutoff:
+                ranges = {**(ranges or {}), column: (cutoff, high)}
+        page = getattr(self.backend, "page", self.cache.page)
+        return page(
+            self.table, criteria, offset, limit, order_by, descending,
+            exclude, ranges, any_of,
+        )
+
+    def scan(self, columns=None, chunk_size=SCAN_ROWS, ranges=None, **criteria):
+        """Stream the matching rows from storage in frames of at most
+        chunk_size rows, bypassing the cache; for reports over tables
+        too big to hold in memory. Only `columns` are loaded.
+
+        Partitioned tables yield the archived months the filters can
+        match first, then the live rows."""
+        live = self.backend.scan(self.table, criteria, ranges, columns, chunk_size)
+        if "partition" not in TABLES[self.table]:
+            return live
+        archived = get_archive(self.table, self.tenant).scan(criteria, ranges, columns, chunk_size)
+        return itertools.chain(archived, live)
+
+    def purge(self, ranges):
+        """Delete every row inside the ranges in one go; returns the count"""
+        try:
+            return self.backend.purge(self.table, ranges)
+        finally:
+            self.cache.invalidate(self.table)
+            self._publish_reload()
+
+    @metrics.timed
+    def write_batch(self, operations):
+        """Apply several writes as one transaction and one version bump.
+
+        operations are dicts like {"op": "update", "key": ..., "changes":
+        {...}, "expected": {...}}, {"op": "delete", "key": ...} or
+        {"op": "insert", "row": {...}}. If any `expected` check fails a
+        StaleWriteError is raised and nothing is written. Returns the
+        number of rows affected.
+        """
+        if not operations:
+            return 0
+        count, versions = self.backend.write_batch(
+            self.table, operations, self._current
+        )
+        if count or versions is not None:
+            records = [make_record(self.table, operation) for operation in operations]
+            self.cache.apply_many(self.table, records, versions)
+            if count:
+                self._publish(records, versions)
+        return count
+
+    @metrics.timed
+    def bulk_insert(self, chunks):
+        """Insert rows from an iterable of row-dict lists as one commit,
+        without holding them all in memory; returns the number of rows.
+
+        The cached table is dropped rather than patched row by row.
+        """
+        try:
+            return self.backend.bulk_insert(self.table, chunks)
+        finally:
+            self.cache.invalidate(self.table)
+            self._publish_reload()
+
+    def update_many(self, keys, expected=None, **changes):
+        """Apply the same changes to several rows in one batch"""
+        return self.write_batch([
+            {"op": "update", "key": key, "changes": changes, "expected": expected}
+            for key in keys
+        ])
+
+    def delete_many(self, keys, expected=None):
+        """Delete several rows in one batch"""
+        return self.write_batch([
+            {"op": "delete", "key": key, "expected": expected} for key in keys
+        ])
+
+    def _current(self, key):
+        return self.find(**{self.key: key})
+
+    def _publish(self, records, versions):
+        """Announce written records on the change feed (utils/changes.py)"""
+        version = versions[1] if versions is not None else self.backend.version(self.table)
+        get_feed(self.tenant).publish(self.table, [
+            (record["row"][self.key] if record["op"] == "insert" else record["key"], record["op"])
+            for record in records
+        ], version)
+
+    def _publish_reload(self):
+        get_feed(self.tenant).publish(self.table, [(None, "reload")], self.backend.version(self.table))
+
+    @metrics.timed
+    def insert(self, row):
+        """Append a single row; the cached table is patched, not re-read.
+        Raises DuplicateKeyError if a table with unique keys has the key"""
+        row = {c: _clean_value(row.get(c)) for c in table_columns(self.table)}
+        versions = self.backend.insert(self.table, row, self._current)
+        record = {"op": "insert", "row": row}
+        self.cache.apply(self.table, record, versions)
+        self._publish([record], versions)
+
+    @metrics.timed
+    def update(self, key, expected=None, **changes):
+        """Update a row; raises StaleWriteError if `expected` values changed"""
+        count, versions = self.backend.update(
+            self.table, key, changes, expected, self._current
+        )
+        if count or versions is not None:
+            record = {"op": "update", "key": key, "changes": changes}
+            self.cache.apply(self.table, record, versions)
+            if count:
+                self._publish([record], versions)
+        return count > 0
+
+    @metrics.timed
+    def delete(self, key, expected=None):
+        """Delete a row; raises StaleWriteError if `expected` values changed"""
+        count, versions = self.backend.delete(
+            self.table, key, expected, self._current
+        )
+        if count or versions is not None:
+            record = {"op": "delete", "key": key}
+            self.cache.apply(self.table, record, versions)
+            if count:
+                self._publish([record], versions)
+        return count > 0
+
+
+class UserStore(Store):
+    table = "users"
+
+    def usernames(self, role):
+        return self.find(role=role)["username"].tolist()
+
+
+class TaskStore(Store):
+    table = "tasks"
+
+    def for_user(self, username):
+        """Tasks assigned to or created by a user"""
+        df = self.all()
+        return df[(df["assigned_to"] == username) | (df["created_by"] == username)]
+
+    def pending_approvals(self):
+        df = self.find(approved=False)
+        return df[df["created_by"] != "admin"]
+
+
+class LeaveStore(Store):
+    table = "leaves"
+
+
+class TimesheetStore(Store):
+    table = "timesheets"
+
+    def get_entry(self, employee, date):
+        """Return an employee's timesheet row for a date, or None"""
+        rows = self.find(employee=employee, date=date)
+        if rows.empty:
+            return None
+        return rows.iloc[0].to_dict()
+
+    def update_entry(self, employee, date, expected=None, **changes):
+        entry = self.get_entry(employee, date)
+        if entry is None:
+            return False
+        return self.update(entry["timesheet_id"], expected, **changes)
+
+
+class AlertStore(Store):
+    table = "alerts"
+
+
+STORES = {
+    "users": UserStore,
+    "tasks": TaskStore,
+    "leaves": LeaveStore,
+    "timesheets": TimesheetStore,
+    "alerts": AlertStore,
+}
+
+
+class _Shard:
+    """One tenant's storage: backend, table cache, stores and archives,
+    all reading and writing only that tenant's directory"""
+
+    __slots__ = ("tenant", "data_dir", "backend", "cache", "stores", "archives", "retained")
+
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.data_dir = tenant_dir(tenant)
+        self.backend = None
+        self.cache = None
+        self.stores = {}
+        self.archives = {}
+        self.retained = set()
+
+
+_shards = {}
+_lock = threading.Lock()
+
+
+def tenant_dir(tenant=None):
+    """Directory holding a tenant's shard (by default the current tenant's)"""
+    tenant = current_tenant() if tenant is None else tenant
+    if tenant == DEFAULT_TENANT:
+        return DATA_DIR
+    return os.path.join(DATA_DIR, TENANTS_DIR, tenant)
+
+
+def list_tenants():
+    """Names of the tenants with a shard, besides the default one"""
+    try:
+        names = os.listdir(os.path.join(DATA_DIR, TENANTS_DIR))
+    except FileNotFoundError:
+        return []
+    return sorted(
+        name for name in names
+        if valid_tenant(name) and os.path.isdir(os.path.join(DATA_DIR, TENANTS_DIR, name))
+    )
+
+
+def _shard(tenant=None):
+    tenant = current_tenant() if tenant is None else tenant
+    shard = _shards.get(tenant)
+    if shard is None:
+        shard = _shards[tenant] = _Shard(tenant)
+    return shard
+
+
+def get_backend(tenant=None):
+    """Return the storage backend selected by TASKTRACKER_STORAGE for a
+    tenant's shard (by default the current tenant's)"""
+    with _lock:
+        shard = _shard(tenant)
+        if shard.backend is None:
+            backend = BACKENDS[STORAGE_BACKEND](shard.data_dir)
+            backend.initialize()
+            shard.backend = backend
+        return shard.backend
+
+
+def get_cache(tenant=None):
+    """Return the table cache of a tenant's shard"""
+    backend = get_backend(tenant)
+    with _lock:
+        shard = _shard(tenant)
+        if shard.cache is None:
+            shard.cache = TableCache(backend)
+        return shard.cache
+
+
+def cache_stats():
+    """Hit/miss counters of the current tenant's table cache"""
+    return get_cache().stats()
+
+
+metrics.register_stats("table_cache", cache_stats)
+
+
+def get_archive(table, tenant=None):
+    """Return the archive of closed months for a partitioned table"""
+    with _lock:
+        shard = _shard(tenant)
+        if table not in shard.archives:
+            shard.archives[table] = PartitionArchive(table, shard.data_dir)
+        return shard.archives[table]
+
+
+@metrics.timed
+def open_cutoff(open_months=OPEN_MONTHS):
+    """First day of the oldest open month, or None if every month is open"""
+    if open_months <= 0:
+        return None
+    this_month = pd.Timestamp.today().normalize().replace(day=1)
+    return this_month - pd.DateOffset(months=open_months - 1)
+
+
+def open_ranges(table):
+    """The ranges filter selecting a table's open months: None for a
+    table that is not partitioned, or when every month is open"""
+    cutoff = open_cutoff()
+    if "partition" not in TABLES[table] or cutoff is None:
+        return None
+    return {TABLES[table]["partition"]["by"]: (cutoff, None)}
+
+
+def _closed_live(table, criteria=None, columns=None):
+    """Live rows of a partitioned table dated before its open months"""
+    cutoff = open_cutoff()
+    if cutoff is None:
+        return iter(())
+    closed = {TABLES[table]["partition"]["by"]: (None, cutoff - pd.Timedelta(days=1))}
+    return get_store(table).backend.scan(table, criteria, closed, columns)
+
+
+def closed_totals(table):
+    """group -> [rows, sum] over the rows of a partitioned table outside
+    its open months: the archived months plus the closed ones nobody has
+    archived yet"""
+    spec = TABLES[table]["partition"]
+    totals = get_archive(table).totals()
+    for chunk in _closed_live(table, columns=[spec["group"], spec["sum"]]):
+        values = pd.to_numeric(chunk[spec["sum"]], errors="coerce").fillna(0.0)
+        stats = values.groupby(plain_column(chunk[spec["group"]])).agg(["size", "sum"])
+        for group, (rows, value) in stats.iterrows():
+            counts = totals.setdefault(group, [0, 0.0])
+            counts[0] += int(rows)
+            counts[1] += float(value)
+    return totals
+
+
+def closed_months(table, groups=None):
+    """Months of a partitioned table outside its open ones, oldest first,
+    holding rows for any of `groups`: archived, or still live"""
+    spec = TABLES[table]["partition"]
+    months = set(get_archive(table).months(groups=groups))
+    criteria = None if groups is None else {spec["group"]: list(groups)}
+    for chunk in _closed_live(table, criteria, [spec["by"]]):
+        months.update(chunk[spec["by"]].dropna().dt.strftime("%Y-%m"))
+    return sorted(months)
+
+
+def read_month(table, month, criteria=None):
+    """The rows of one "YYYY-MM" month matching criteria, wherever they are
+    kept"""
+    column = TABLES[table]["partition"]["by"]
+    chunks = list(get_store(table).scan(ranges={column: _month_bounds(month)}, **(criteria or {})))
+    if not chunks:
+        return coerce_types(table, pd.DataFrame(columns=table_columns(table)))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def archive_closed_months(table="timesheets", open_months=OPEN_MONTHS):
+    """Move the rows of months before the last `open_months` out of the
+    live table into the archive; returns the number of rows moved.
+
+    The live rows are streamed once and spilled to disk by month, so
+    memory stays at a chunk plus one month. Each month is
+    merged into the archive before the live rows are purged; a crash in
+    between only means the next run merges the same rows again.
+    """
+    cutoff = open_cutoff(open_months)
+    if cutoff is None:
+        return 0
+    column = TABLES[table]["partition"]["by"]
+    closed = {column: (None, cutoff - pd.Timedelta(days=1))}
+    store = get_store(table)
+    archive = get_archive(table)
+    with archive.lock:
+        spill_dir = tempfile.mkdtemp(dir=store.backend.data_dir, prefix=f".{table}.archive.")
+        try:
+            spills = {}
+            for chunk in store.backend.scan(table, ranges=closed):
+                chunk = chunk.dropna(subset=[column])
+                dates = chunk[column].dt
+                for month, rows in chunk.groupby(dates.year * 100 + dates.month):
+                    name = f"{month // 100:04d}-{month % 100:02d}"
+                    path = os.path.join(spill_dir, f"{name}.{len(spills.get(name, []))}.pkl")
+                    rows.to_pickle(path)
+                    spills.setdefault(name, []).append(path)
+            for month, paths in sorted(spills.items()):
+                archive.add(month, pd.concat([pd.read_pickle(p) for p in paths]))
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+        if not spills:
+            return 0
+        return store.purge(closed)
+
+
+def get_store(table, tenant=None):
+    """Return the store for a table, e.g. get_store("tasks"), of a
+    tenant's shard (by default the current tenant's)"""
+    cache = get_cache(tenant)
+    with _lock:
+        shard = _shard(tenant)
+        if table not in shard.stores:
+            shard.stores[table] = STORES[table](cache.backend, cache, shard.tenant)
+        return shard.stores[table]
+
+
+def _table_file_exists(data_dir, table):
+    return any(
+        os.path.exists(os.path.join(data_dir, table + ext))
+        for ext in FORMAT_EXTENSIONS.values()
+    )
+
+
+def initialize_database(tenant=None):
+    """Initialize CSV files if they don't exist, in a tenant's shard (by
+    default the current tenant's; a new tenant's shard is created)"""
+    tenant = current_tenant() if tenant is None else tenant
+    data_dir = tenant_dir(tenant)
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
 
-def initialize_database():
-    """Initialize CSV files if they don't exist"""
-    if not os.path.exists("data"):
-        os.makedirs("data")
-    
     # Users database
-    if not os.path.exists("data/users.csv"):
+    if not _table_file_exists(data_dir, "users"):
         users_df = pd.DataFrame({
             'username': ['admin'],
             'password': ['8c6976e5b5410415bde908bd4dee15dfb167a9c873fc4bb8a81f6f2ab448a918'],  # admin
             'role': ['admin']
         })
-        users_df.to_csv("data/users.csv", index=False)
-    
+        users_df.to_csv(os.path.join(data_dir, "users.csv"), index=False)
+
     # Tasks database
-    if not os.path.exists("data/tasks.csv"):
+    if not _table_file_exists(data_dir, "tasks"):
         tasks_df = pd.DataFrame({
             'task_id': [],
             'title': [],
@@ -28,10 +2212,10 @@ def initialize_database():
             'created_by': [],
             'approved': []
         })
-        tasks_df.to_csv("data/tasks.csv", index=False)
-    
+        tasks_df.to_csv(os.path.join(data_dir, "tasks.csv"), index=False)
+
     # Leaves database
-    if not os.path.exists("data/leaves.csv"):
+    if not _table_file_exists(data_dir, "leaves"):
         leaves_df = pd.DataFrame({
             'leave_id': [],
             'employee': [],
@@ -41,10 +2225,10 @@ def initialize_database():
             'status': [],
             'reason': []
         })
-        leaves_df.to_csv("data/leaves.csv", index=False)
-    
+        leaves_df.to_csv(os.path.join(data_dir, "leaves.csv"), index=False)
+
     # Timesheets database
-    if not os.path.exists("data/timesheets.csv"):
+    if not _table_file_exists(data_dir, "timesheets"):
         timesheets_df = pd.DataFrame({
             'timesheet_id': [],
             'employee': [],
@@ -53,4 +2237,28 @@ def initialize_database():
             'task_id': [],
             'description': []
         })
-        timesheets_df.to_csv("data/timesheets.csv", index=False)
+        timesheets_df.to_csv(os.path.join(data_dir, "timesheets.csv"), index=False)
+
+    # Alerts database
+    if not _table_file_exists(data_dir, "alerts"):
+        pd.DataFrame(columns=table_columns("alerts")).to_csv(
+            os.path.join(data_dir, "alerts.csv"), index=False
+        )
+
+    # Create the backend schema, run the one-shot CSV import and replay
+    # any leftover operation log; get_backend does this once per process
+    # and shard, not on every rerun
+    get_backend(tenant)
+
+    # Retention, if TASKTRACKER_ARCHIVE_ON_START is set: move closed months
+    # of partitioned tables to the archive, once per process and shard
+    # (this also runs on every Streamlit rerun)
+    if not ARCHIVE_ON_START:
+        return
+    with _lock:
+        retained = _shard(tenant).retained
+    with use_tenant(tenant):
+        for table, spec in TABLES.items():
+            if "partition" in spec and table not in retained:
+                archive_closed_months(table)
+                retained.add(table)
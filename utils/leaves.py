@@ -0,0 +1,263 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from utils import metrics
+from utils.database import DATA_DIR, LEAVE_TYPES, _stat_token, get_store
+from utils.tenants import current_tenant
+
+# Working days a year each leave type allows; None means it is not
+# counted against a balance. Override with e.g.
+# TASKTRACKER_LEAVE_ALLOWANCES="Vacation=25,Sick Leave=12".
+ALLOWANCES = {"Vacation": 20, "Sick Leave": 10, "Work from Home": None}
+ALLOWANCES.update(
+    (name.strip(), int(days))
+    for name, days in (
+        item.split("=", 1)
+        for item in os.environ.get("TASKTRACKER_LEAVE_ALLOWANCES", "").split(",")
+        if "=" in item
+    )
+)
+# Public holidays, one "YYYY-MM-DD[,name]" line each, in the data directory
+HOLIDAYS_FILE = "holidays.csv"
+# Share of employees that may be on leave the same day before a request
+# is flagged as leaving the team short
+MAX_OUT_SHARE = float(os.environ.get("TASKTRACKER_MAX_OUT_SHARE", 0.3))
+# Statuses whose days count as taken (or about to be) in the calendar
+BOOKED = ("Approved", "Pending")
+
+# Day numbers fit in 32 bits, so (employee code, day) packs into one int64
+_SPAN = np.int64(1) << 32
+_ONE_DAY = np.timedelta64(1, "D")
+
+
+def _day(value):
+    return np.datetime64(pd.Timestamp(value).date(), "D")
+
+
+def load_holidays(data_dir=DATA_DIR):
+    """Holiday dates from data/holidays.csv, empty if there is no file"""
+    path = os.path.join(data_dir, HOLIDAYS_FILE)
+    if not os.path.exists(path):
+        return np.array([], dtype="datetime64[D]")
+    df = pd.read_csv(path, header=None, usecols=[0], names=["date"], comment="#")
+    dates = pd.to_datetime(df["date"], errors="coerce").dropna()
+    return np.unique(dates.values.astype("datetime64[D]"))
+
+
+class LeaveCalendar:
+    """Leave requests as day-number arrays, for whole-table questions.
+
+    A frame of the leaves table is parsed once into parallel numpy
+    arrays (employee code, first and last day, status, type);
+    get_calendar() builds a new calendar only when the cached table
+    changes. Calendar questions - who is out, headcount per
+    day, overlapping requests, working days, balances - are then array
+    operations over every leave at once, not a loop over rows.
+    """
+
+    def __init__(self, df, holidays=()):
+        self.source = df
+        self.holidays = np.asarray(holidays, dtype="datetime64[D]")
+        self.busdays = np.busdaycalendar(holidays=self.holidays)
+        df = df.dropna(subset=["employee", "start_date", "end_date"])
+        df = df[df["end_date"] >= df["start_date"]]
+        codes, names = pd.factorize(df["employee"])
+        self.ids = df["leave_id"].to_numpy(dtype=object)
+        self.employee = codes.astype(np.int64)
+        self.names = np.asarray(names, dtype=object)
+        self.start = df["start_date"].to_numpy(dtype="datetime64[D]")
+        self.end = df["end_date"].to_numpy(dtype="datetime64[D]")
+        self.status = df["status"].astype(object).to_numpy()
+        self.type = df["leave_type"].astype(object).to_numpy()
+
+    def _select(self, start=None, end=None, statuses=BOOKED, employees=None):
+        """Mask of the leaves with a status in `statuses` touching [start, end]"""
+        mask = np.isin(self.status, list(statuses))
+        if start is not None:
+            mask &= self.end >= _day(start)
+        if end is not None:
+            mask &= self.start <= _day(end)
+        if employees is not None:
+            mask &= np.isin(self.names[self.employee], list(employees))
+        return mask
+
+    def working_days(self, start, end):
+        """Working days (weekdays that are not holidays) in each inclusive
+        [start, end] pair of day arrays"""
+        return np.busday_count(start, end + _ONE_DAY, busdaycal=self.busdays)
+
+    def out(self, start, end, statuses=("Approved",)):
+        """Leaves overlapping the period, one row each, ordered by start"""
+        mask = self._select(start, end, statuses)
+        df = pd.DataFrame({
+            "employee": self.names[self.employee[mask]],
+            "leave_id": self.ids[mask],
+            "start_date": self.start[mask].astype("datetime64[ns]"),
+            "end_date": self.end[mask].astype("datetime64[ns]"),
+            "leave_type": self.type[mask],
+            "status": self.status[mask],
+        })
+        return df.sort_values(["start_date", "employee"], ignore_index=True)
+
+    def _blocks(self, mask):
+        """Each employee's selected leaves merged into disjoint day blocks:
+        (employee codes, first days, last days)"""
+        order = np.lexsort((self.start[mask], self.employee[mask]))
+        emp = self.employee[mask][order]
+        first = self.start[mask][order]
+        last = self.end[mask][order]
+        if not len(emp):
+            return emp, first, last
+        # Running max of each employee's last day, per employee
+        reach = np.maximum.accumulate(emp * _SPAN + last.astype(np.int64))
+        prev = np.r_[np.int64(-1), reach[:-1]]
+        new = (prev // _SPAN != emp) | (first.astype(np.int64) > prev % _SPAN)
+        heads = np.flatnonzero(new)
+        return emp[heads], first[heads], np.maximum.reduceat(last, heads)
+
+    def headcount(self, start, end, statuses=("Approved",), employees=None):
+        """Number of employees on leave on each day of [start, end]"""
+        first, last = _day(start), _day(end)
+        days = pd.date_range(first, last, freq="D", name="date")
+        _, block_first, block_last = self._blocks(self._select(first, last, statuses, employees))
+        size = len(days)
+        lo = (np.maximum(block_first, first) - first).astype(np.int64)
+        hi = (np.minimum(block_last, last) - first).astype(np.int64) + 1
+        counts = np.cumsum(np.bincount(lo, minlength=size + 1) - np.bincount(hi, minlength=size + 1))
+        return pd.Series(counts[:size], index=days, name="on_leave")
+
+    def days_off(self, start, end, employees=None, statuses=("Approved",)):
+        """(employee, date) pairs of every day on leave in [start, end]"""
+        first, last = _day(start), _day(end)
+        emp, block_first, block_last = self._blocks(self._select(first, last, statuses, employees))
+        block_first = np.maximum(block_first, first)
+        block_last = np.minimum(block_last, last)
+        lengths = (block_last - block_first).astype(np.int64) + 1
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        dates = np.repeat(block_first, lengths) + offsets.astype("timedelta64[D]")
+        return pd.MultiIndex.from_arrays(
+            [self.names[np.repeat(emp, lengths)], pd.DatetimeIndex(dates.astype("datetime64[ns]"))],
+            names=["employee", "date"],
+        )
+
+    def overlaps(self, statuses=BOOKED):
+        """Requests overlapping an earlier request of the same employee,
+        with the id of the request they run into"""
+        mask = np.flatnonzero(self._select(statuses=statuses))
+        order = mask[np.lexsort((self.start[mask], self.employee[mask]))]
+        emp, first = self.employee[order], self.start[order].astype(np.int64)
+        key = emp * _SPAN + self.end[order].astype(np.int64)
+        reach = np.maximum.accumulate(key) if len(key) else key
+        prev = np.r_[np.int64(-1), reach[:-1]]
+        clash = (prev // _SPAN == emp) & (first <= prev % _SPAN)
+        # Position of the leave holding the running max, to name the other side
+        raised = np.r_[True, key[1:] > reach[:-1]] if len(key) else np.array([], bool)
+        holder = np.maximum.accumulate(np.where(raised, np.arange(len(key)), 0))
+        rows = order[clash]
+        other = order[holder[np.flatnonzero(clash) - 1]]
+        return pd.DataFrame({
+            "employee": self.names[self.employee[rows]],
+            "leave_id": self.ids[rows],
+            "start_date": self.start[rows].astype("datetime64[ns]"),
+            "end_date": self.end[rows].astype("datetime64[ns]"),
+            "status": self.status[rows],
+            "overlaps": self.ids[other],
+        })
+
+    def balances(self, year, employees=None):
+        """Working days taken and pending per employee and leave type in a
+        year, against the yearly allowance"""
+        first, last = _day(f"{year}-01-01"), _day(f"{year}-12-31")
+        mask = self._select(first, last, BOOKED, employees)
+        days = self.working_days(np.maximum(self.start[mask], first),
+                                 np.minimum(self.end[mask], last))
+        booked = pd.DataFrame({
+            "employee": self.names[self.employee[mask]],
+            "leave_type": self.type[mask],
+            "approved": np.where(self.status[mask] == "Approved", days, 0),
+            "pending": np.where(self.status[mask] == "Pending", days, 0),
+        }).groupby(["employee", "leave_type"]).sum()
+        if employees is None:
+            employees = sorted(set(self.names[self.employee]))
+        grid = pd.MultiIndex.from_product([sorted(employees), LEAVE_TYPES],
+                                          names=["employee", "leave_type"])
+        df = booked.reindex(grid, fill_value=0).reset_index()
+        df["allowance"] = df["leave_type"].map(ALLOWANCES).astype(float)
+        df["remaining"] = df["allowance"] - df["approved"]
+        return df
+
+    def review(self, leave_id, team_size):
+        """What approving one request would mean: its working days, the
+        balance left afterwards, the employee's other requests it
+        overlaps, and the largest share of the team out on any of its days"""
+        positions = np.flatnonzero(self.ids == leave_id)
+        if not len(positions):
+            return None
+        i = positions[0]
+        name, first, last = self.names[self.employee[i]], self.start[i], self.end[i]
+        days = int(self.working_days(first, last))
+        others = self._select(first, last, BOOKED, [name])
+        others[i] = False
+        allowance = ALLOWANCES.get(self.type[i])
+        remaining = None
+        if allowance is not None:
+            taken = self.balances(pd.Timestamp(first).year, [name])
+            taken = taken[taken["leave_type"] == self.type[i]]["approved"].sum()
+            remaining = int(allowance - taken - (0 if self.status[i] == "Approved" else days))
+        out = self.headcount(first, last)
+        if self.status[i] != "Approved":
+            out = out + 1
+        peak = int(out.max()) if len(out) else 0
+        share = peak / team_size if team_size else 0.0
+        return {
+            "working_days": days,
+            "remaining": remaining,
+            "overlaps": self.ids[others].tolist(),
+            "peak_out": peak,
+            "peak_share": share,
+            "short_staffed": share > MAX_OUT_SHARE,
+        }
+
+
+# tenant -> (its calendar, the holidays it was built with); the holiday
+# list is shared by every tenant
+_calendars = {}
+_holidays = (None, np.array([], dtype="datetime64[D]"))
+_lock = threading.Lock()
+
+
+def holidays_version():
+    """Change token of data/holidays.csv, None while there is none"""
+    try:
+        return _stat_token(os.stat(os.path.join(DATA_DIR, HOLIDAYS_FILE)))
+    except FileNotFoundError:
+        return None
+
+
+@metrics.timed
+def get_calendar():
+    """Return the current tenant's leave calendar, up to date with its
+    leaves table and data/holidays.csv"""
+    global _holidays
+    tenant = current_tenant()
+    df = get_store("leaves").all()
+    token = holidays_version()
+    with _lock:
+        calendar, built_with = _calendars.get(tenant, (None, None))
+        holidays = _holidays
+    if token != holidays[0]:
+        holidays = (token, load_holidays())
+    if calendar is None or calendar.source is not df or holidays is not built_with:
+        calendar = LeaveCalendar(df, holidays[1])
+        with _lock:
+            _calendars[tenant] = (calendar, holidays)
+            _holidays = holidays
+    return calendar
+
+
+def team_size():
+    """Number of employees, the base for coverage shares"""
+    return len(get_store("users").usernames("employee"))
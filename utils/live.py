@@ -0,0 +1,104 @@
+import functools
+import os
+from collections import Counter
+
+import streamlit as st
+from streamlit.errors import StreamlitAPIException
+
+from utils.auth import activate_session_tenant
+from utils.changes import get_feed
+from utils.database import get_backend
+
+# Seconds between the refreshes of a live page section; 0 leaves them to
+# the user's own interactions
+POLL_SECONDS = float(os.environ.get("TASKTRACKER_POLL_SECONDS", 10))
+# Session state key of what this session has seen: {table: (seq, version)}
+SEEN_KEY = "_live_seen"
+NOUNS = {
+    "users": ("employee", "employees"),
+    "tasks": ("task", "tasks"),
+    "leaves": ("leave request", "leave requests"),
+    "timesheets": ("timesheet entry", "timesheet entries"),
+    "alerts": ("alert", "alerts"),
+}
+VERBS = {"insert": "added", "update": "updated", "delete": "removed", "reload": "reloaded"}
+
+
+def live(fn):
+    """Decorator for a page section that keeps itself current.
+
+    The section runs as a fragment: its own buttons and refresh() rerun
+    only the section, and it re-renders every POLL_SECONDS to pick up
+    other users' writes - from the table cache, so an unchanged table
+    costs one version check.
+    """
+    @functools.wraps(fn)
+    def section(*args, **kwargs):
+        # A rerun of the section alone may come on a fresh thread, which
+        # does not know the session's tenant yet
+        activate_session_tenant()
+        return fn(*args, **kwargs)
+    return st.fragment(section, run_every=POLL_SECONDS or None)
+
+
+def _now(tables):
+    backend = get_backend()
+    latest = get_feed().latest()
+    return {table: (latest, backend.version(table)) for table in tables}
+
+
+def seen(tables=NOUNS):
+    """Mark the tables as seen by this session as they are now"""
+    st.session_state[SEEN_KEY] = {**st.session_state.get(SEEN_KEY, {}), **_now(tables)}
+
+
+def refresh():
+    """After this session's own write: rerun the live section it was made
+    in (the whole page outside one), without announcing the write back"""
+    seen()
+    rerun()
+
+
+def rerun():
+    """Rerun the live section this is called from, or else the page"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+def changes_since_seen(tables, keys=None):
+    """Changes other sessions made to the tables since this one last
+    looked, as {(table, op): count}. op "reload" stands for changes
+    known only by a moved version (another process wrote, or this
+    session fell too far behind). With `keys`, only changes to those
+    rows count."""
+    previous = st.session_state.get(SEEN_KEY, {})
+    now = _now(tables)
+    st.session_state[SEEN_KEY] = {**previous, **now}
+    feed = get_feed()
+    counts = Counter()
+    for table in tables:
+        if table not in previous or previous[table][1] == now[table][1]:
+            continue
+        seq, version = previous[table]
+        events = feed.since(seq, [table])
+        ours = [e for e in events or () if e.seq <= now[table][0]]
+        if keys is None:
+            counts.update((e.table, e.op) for e in ours)
+            if events is None or not ours or ours[-1].version != now[table][1]:
+                counts[(table, "reload")] += 1
+        else:
+            counts.update((e.table, e.op) for e in ours if e.key in keys)
+    return counts
+
+
+def notify_changes(tables, keys=None):
+    """Toast what other sessions changed in the tables since this one
+    last looked, e.g. "2 tasks updated" """
+    for (table, op), count in sorted(changes_since_seen(tables, keys).items()):
+        singular, plural = NOUNS[table]
+        if op == "reload":
+            st.toast(f"{plural.capitalize()} changed")
+        else:
+            st.toast(f"{count} {singular if count == 1 else plural} {VERBS[op]}")
@@ -0,0 +1,285 @@
+import bisect
+import cProfile
+import functools
+import inspect
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import nullcontext
+
+import pandas as pd
+import streamlit as st
+
+# Opt-in: with TASKTRACKER_METRICS unset, timed() hands functions back
+# unwrapped and span()/count() return at once, so instrumented code runs
+# as if it were not instrumented
+ENABLED = os.environ.get("TASKTRACKER_METRICS", "") not in ("", "0")
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+PREFIX = "tasktracker"
+# Session state keys of the per-session profile capture
+PROFILE_KEY = "_profile_next_run"
+PROFILE_RESULT = "_profile_result"
+PROFILE_LINES = 40
+
+
+class Metrics:
+    """Latency histograms per instrumented function or span, and counters.
+
+    A timing keeps [calls, errors, total seconds, max seconds, rows,
+    per-bucket counts]; rows adds up the length of every DataFrame the
+    function returned (or yielded). Counters are keyed by name and
+    label pairs, e.g. ("bytes_read", (("table", "tasks"),)).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counters = {}
+
+    def observe(self, name, seconds, rows=0, error=False):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = [0, 0, 0.0, 0.0, 0, [0] * (len(BUCKETS) + 1)]
+            timing[0] += 1
+            timing[1] += error
+            timing[2] += seconds
+            timing[3] = max(timing[3], seconds)
+            timing[4] += rows
+            timing[5][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def add(self, name, amount, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def timings(self):
+        """One row per timed name, slowest in total first"""
+        with self._lock:
+            items = [(name, t[:5]) for name, t in self._timings.items()]
+        rows = [
+            {
+                "name": name,
+                "calls": calls,
+                "errors": errors,
+                "total_ms": total * 1000,
+                "mean_ms": total * 1000 / calls,
+                "max_ms": peak * 1000,
+                "rows": rows,
+            }
+            for name, (calls, errors, total, peak, rows) in items
+        ]
+        columns = ["name", "calls", "errors", "total_ms", "mean_ms", "max_ms", "rows"]
+        return pd.DataFrame(rows, columns=columns).sort_values("total_ms", ascending=False,
+                                                               ignore_index=True)
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def histograms(self):
+        with self._lock:
+            return {name: (t[0], t[2], list(t[5])) for name, t in self._timings.items()}
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+
+
+_metrics = Metrics()
+_sources = {}
+
+
+def get_metrics():
+    return _metrics
+
+
+def _rows(value):
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series)) else 0
+
+
+def timed(fn):
+    """Decorator recording a function's latency, errors and returned rows
+    under "<module>.<qualname>" (a page's file name stands in for
+    __main__). Generator functions are timed across
+    their whole iteration, counting only the time spent inside them."""
+    if not ENABLED:
+        return fn
+    module = fn.__module__
+    if module == "__main__":
+        # Streamlit runs each page as __main__: name it after its file
+        module = os.path.splitext(os.path.basename(fn.__code__.co_filename))[0]
+    name = f"{module}.{fn.__qualname__}"
+    perf_counter = time.perf_counter
+
+    if inspect.isgeneratorfunction(fn):
+        @functools.wraps(fn)
+        def generator(*args, **kwargs):
+            elapsed, rows, error = 0.0, 0, False
+            items = fn(*args, **kwargs)
+            try:
+                while True:
+                    start = perf_counter()
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    except BaseException:
+                        error = True
+                        raise
+                    finally:
+                        elapsed += perf_counter() - start
+                    rows += _rows(item)
+                    yield item
+            finally:
+                # Also when the caller stops early: what was read still counts
+                items.close()
+                _metrics.observe(name, elapsed, rows, error)
+        return generator
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException:
+            _metrics.observe(name, perf_counter() - start, error=True)
+            raise
+        _metrics.observe(name, perf_counter() - start, _rows(result))
+        return result
+    return wrapper
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _metrics.observe(self.name, time.perf_counter() - self.start, error=exc_type is not None)
+
+
+_NOT_TIMED = nullcontext()
+
+
+def span(name):
+    """Context manager timing a block under `name`, e.g. a page section"""
+    return _Span(name) if ENABLED else _NOT_TIMED
+
+
+def count(name, amount=1, **labels):
+    """Add to a counter, e.g. count("bytes_read", size, table="tasks")"""
+    if ENABLED:
+        _metrics.add(name, amount, labels)
+
+
+def register_stats(name, stats):
+    """Publish a stats() function (a dict of numbers, or of such dicts by
+    name) on the diagnostics page and /metrics, whether or not timing is on"""
+    _sources[name] = stats
+
+
+def stats():
+    """Every registered stats() result by source name"""
+    return {name: source() for name, source in sorted(_sources.items())}
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _number(value):
+    return isinstance(value, (int, float))
+
+
+def prometheus_text():
+    """Timings, counters and registered stats in the Prometheus text format"""
+    lines = []
+    histograms = _metrics.histograms()
+    if histograms:
+        metric = f"{PREFIX}_call_seconds"
+        lines += [f"# HELP {metric} Time spent in instrumented functions and spans",
+                  f"# TYPE {metric} histogram"]
+        for name, (calls, total, buckets) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, hits in zip(BUCKETS + ("+Inf",), buckets):
+                cumulative += hits
+                labels = _label_text((("name", name), ("le", bound)))
+                lines.append(f"{metric}_bucket{labels} {cumulative}")
+            labels = _label_text((("name", name),))
+            lines.append(f"{metric}_sum{labels} {total:.6f}")
+            lines.append(f"{metric}_count{labels} {calls}")
+        timings = _metrics.timings()
+        for column, help_text in (("errors", "Calls that raised"),
+                                  ("rows", "DataFrame rows returned")):
+            metric = f"{PREFIX}_call_{column}_total"
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            for name, value in zip(timings["name"], timings[column]):
+                lines.append(f"{metric}{_label_text((('name', name),))} {value}")
+    counters = {}
+    for (name, labels), value in _metrics.counters().items():
+        counters.setdefault(name, []).append((labels, value))
+    for name, series in sorted(counters.items()):
+        metric = f"{PREFIX}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines += [f"{metric}{_label_text(labels)} {value}" for labels, value in sorted(series)]
+    for source, values in stats().items():
+        gauges = {}
+        for field, value in values.items():
+            if isinstance(value, dict):
+                # Nested stats, e.g. one dict per rate limiter
+                for inner, number in value.items():
+                    if _number(number):
+                        gauges.setdefault(inner, []).append(((("name", field),), number))
+            elif _number(value):
+                gauges.setdefault(field, []).append(((), value))
+        for field, series in sorted(gauges.items()):
+            metric = f"{PREFIX}_{source}_{field}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines += [f"{metric}{_label_text(labels)} {float(value):g}" for labels, value in series]
+    return "\n".join(lines) + "\n"
+
+
+def profile_next_run():
+    """Ask for the current session's next page run to be profiled"""
+    st.session_state[PROFILE_KEY] = True
+
+
+def page(fn):
+    """Decorator for a page's entry point: timed when metrics are on, and
+    run under cProfile when profile_next_run() was called in this session.
+    The report is kept in st.session_state[PROFILE_RESULT]."""
+    fn = timed(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not st.session_state.get(PROFILE_KEY):
+            return fn(*args, **kwargs)
+        st.session_state[PROFILE_KEY] = False
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(fn, *args, **kwargs)
+        finally:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            st.session_state[PROFILE_RESULT] = {
+                "page": fn.__qualname__,
+                "when": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "report": out.getvalue(),
+            }
+    return wrapper
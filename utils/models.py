@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from utils.database import TABLES, table_columns
+
+
+class Model:
+    """One table row as a slotted object: task.title rather than
+    task['title'] on a pandas Series.
+
+    from_frame() converts a frame column by column in vectorized passes
+    and then only zips the values into objects, so a page of rows costs
+    no Series per row. Values are the frame's own (Timestamps for dates,
+    the shared category string for status, severity, leave type...)
+    with None for missing.
+    """
+
+    __slots__ = ()
+    table = None
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_frame(cls, df):
+        """The rows of a frame (the table's columns, extra ones ignored)"""
+        if df.empty:
+            return []
+        columns = []
+        for name in cls.__slots__:
+            # Object columns come back uncopied; never write into them
+            values = df[name].to_numpy(dtype=object)
+            missing = pd.isna(values)
+            if missing.any():
+                values = np.where(missing, None, values)
+            columns.append(values.tolist())
+        return [cls(*values) for values in zip(*columns)]
+
+    @property
+    def key(self):
+        return getattr(self, TABLES[self.table]["key"])
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.key!r})"
+
+
+class User(Model):
+    table = "users"
+    __slots__ = tuple(table_columns(table))
+
+
+class Task(Model):
+    table = "tasks"
+    __slots__ = tuple(table_columns(table))
+
+
+class Leave(Model):
+    table = "leaves"
+    __slots__ = tuple(table_columns(table))
+
+
+class TimesheetEntry(Model):
+    table = "timesheets"
+    __slots__ = tuple(table_columns(table))
+
+
+class Alert(Model):
+    table = "alerts"
+    __slots__ = tuple(table_columns(table))
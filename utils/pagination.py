@@ -0,0 +1,89 @@
+import math
+import streamlit as st
+
+from utils.database import SEVERITIES, TASK_STATUSES
+from utils.live import rerun
+
+PAGE_SIZE = 20
+
+
+def paginate(store, key, page_size=PAGE_SIZE, **query):
+    """Render pager controls for store.query(**query) and return the rows
+    of the current page; only that page is loaded and rendered.
+
+    The page number lives in st.session_state under `key` and goes back
+    to the first page whenever the filters change.
+    """
+    page_key = f"{key}_page"
+    filters_key = f"{key}_filters"
+    if st.session_state.get(filters_key) != repr(query):
+        st.session_state[filters_key] = repr(query)
+        st.session_state[page_key] = 0
+    page = st.session_state.get(page_key, 0)
+
+    rows, total = store.query(offset=page * page_size, limit=page_size, **query)
+    pages = max(1, math.ceil(total / page_size))
+    if page >= pages:
+        # Rows were removed since the last rerun
+        page = st.session_state[page_key] = pages - 1
+        rows, total = store.query(offset=page * page_size, limit=page_size, **query)
+
+    if pages > 1:
+        col1, col2, col3 = st.columns([1, 3, 1])
+        with col1:
+            if st.button("Previous", key=f"{key}_prev", disabled=page == 0):
+                st.session_state[page_key] = page - 1
+                rerun()
+        with col2:
+            st.caption(f"Page {page + 1} of {pages} ({total} items)")
+        with col3:
+            if st.button("Next", key=f"{key}_next", disabled=page >= pages - 1):
+                st.session_state[page_key] = page + 1
+                rerun()
+    return rows
+
+
+def task_filters(key, assignees=None):
+    """Filter and sort widgets for task lists; returns store.query() arguments"""
+    query = {}
+    with st.expander("Filter and sort", expanded=False):
+        col1, col2 = st.columns(2)
+        with col1:
+            statuses = st.multiselect("Status", TASK_STATUSES, key=f"{key}_status")
+            severities = st.multiselect("Severity", SEVERITIES, key=f"{key}_severity")
+        with col2:
+            if assignees is not None:
+                assignee = st.selectbox("Assigned to", ["All"] + list(assignees), key=f"{key}_assignee")
+                if assignee != "All":
+                    query["assigned_to"] = assignee
+            deadlines = st.date_input("Deadline between", value=[], key=f"{key}_deadline")
+        col1, col2 = st.columns(2)
+        with col1:
+            order_by = st.selectbox(
+                "Sort by", ["deadline", "severity", "status", "title"], key=f"{key}_sort"
+            )
+        with col2:
+            descending = st.checkbox("Descending", key=f"{key}_desc")
+    if statuses:
+        query["status"] = statuses
+    if severities:
+        query["severity"] = severities
+    if len(deadlines) == 2:
+        query["ranges"] = {"deadline": (deadlines[0], deadlines[1])}
+    query["order_by"] = order_by
+    query["descending"] = descending
+    return query
+
+
+def bulk_select(items, label, key):
+    """Multiselect over the rows (model objects, see utils/models.py) of
+    the current page; returns the chosen keys"""
+    labels = {item.key: label(item) for item in items}
+    select_all = st.checkbox("Select all on this page", key=f"{key}_all")
+    return st.multiselect(
+        "Selected",
+        list(labels),
+        default=list(labels) if select_all else [],
+        format_func=labels.get,
+        key=f"{key}_selected_{select_all}",
+    )
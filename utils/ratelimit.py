@@ -0,0 +1,210 @@
+import ipaddress
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import streamlit as st
+
+from utils import metrics
+from utils.database import DATA_DIR
+
+# Burst of attempts allowed per key, and how fast that allowance comes back
+LOGIN_BURST = int(os.environ.get("TASKTRACKER_LOGIN_BURST", 5))
+LOGIN_PER_MINUTE = float(os.environ.get("TASKTRACKER_LOGIN_PER_MINUTE", 5))
+# Failures tolerated before backoff starts, and the backoff bounds in seconds
+BACKOFF_AFTER = 3
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 15 * 60
+MAX_KEYS = int(os.environ.get("TASKTRACKER_RATELIMIT_KEYS", 10000))
+# Set to keep failure counts across restarts (data/<name>.ratelimit.json)
+PERSIST = os.environ.get("TASKTRACKER_RATELIMIT_PERSIST", "") not in ("", "0")
+# Reverse proxies (addresses or networks, comma-separated) whose
+# X-Forwarded-For is believed; without any the header is ignored
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in os.environ.get("TASKTRACKER_TRUSTED_PROXIES", "").split(",")
+    if item.strip()
+]
+
+
+class RateLimitError(Exception):
+    """Raised when a key has to wait before its next attempt"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Too many attempts, try again in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token buckets with exponential backoff on failures, per key.
+
+    Each key gets `burst` attempts that refill at `per_minute`; after
+    BACKOFF_AFTER consecutive failures the key is also blocked for
+    BACKOFF_BASE * 2**n seconds (capped at BACKOFF_MAX). At most
+    `max_keys` keys are tracked, least recently used evicted first.
+    """
+
+    def __init__(self, name, burst=LOGIN_BURST, per_minute=LOGIN_PER_MINUTE,
+                 max_keys=MAX_KEYS, persist=PERSIST, data_dir=DATA_DIR):
+        self.name = name
+        self.burst = burst
+        self.rate = per_minute / 60.0
+        self.max_keys = max_keys
+        self.path = os.path.join(data_dir, f"{name}.ratelimit.json") if persist else None
+        self._lock = threading.Lock()
+        # key -> [tokens, last refill time, consecutive failures, blocked until]
+        self._keys = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+        self._load()
+
+    def _state(self, key, now):
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = [float(self.burst), now, 0, 0.0]
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._keys.move_to_end(key)
+            state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            state[1] = now
+            if state[3] and now - state[3] > BACKOFF_MAX:
+                # Quiet since its last block ended: start over
+                state[2] = 0
+                state[3] = 0.0
+        return state
+
+    def acquire(self, key):
+        """Take one attempt for key; raises RateLimitError if none is left"""
+        now = time.time()
+        with self._lock:
+            state = self._state(key, now)
+            wait = state[3] - now
+            if wait <= 0 and state[0] < 1:
+                wait = (1 - state[0]) / self.rate if self.rate else BACKOFF_MAX
+            if wait > 0:
+                self.rejected += 1
+                raise RateLimitError(wait)
+            state[0] -= 1
+            self.allowed += 1
+
+    def failure(self, key):
+        """Record a failed attempt, blocking the key once failures pile up"""
+        now = time.time()
+        with self._lock:
+            state = self._state(key, now)
+            state[2] += 1
+            if state[2] >= BACKOFF_AFTER:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (state[2] - BACKOFF_AFTER))
+                state[3] = now + delay
+        self._save()
+
+    def success(self, key):
+        """Clear a key's failures after a successful attempt"""
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None or not state[2]:
+                return
+            state[2] = 0
+            state[3] = 0.0
+        self._save()
+
+    def stats(self):
+        with self._lock:
+            blocked = sum(1 for s in self._keys.values() if s[3] > time.time())
+            return {
+                "allowed": self.allowed,
+                "rejected": self.rejected,
+                "tracked": len(self._keys),
+                "blocked": blocked,
+                "evicted": self.evicted,
+            }
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, (failures, blocked_until) in saved.items():
+            self._keys[key] = [float(self.burst), now, failures, blocked_until]
+
+    def _save(self):
+        """Write the keys with failures on record; best effort"""
+        if self.path is None:
+            return
+        with self._lock:
+            saved = {k: [s[2], s[3]] for k, s in self._keys.items() if s[2]}
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".ratelimit.", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(saved, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """Return the process-wide limiter for a name, e.g. "login_user" """
+    with _lock:
+        if name not in _limiters:
+            _limiters[name] = RateLimiter(name)
+        return _limiters[name]
+
+
+def limiter_stats():
+    """Counters of every limiter created so far, by name"""
+    with _lock:
+        limiters = dict(_limiters)
+    return {name: limiter.stats() for name, limiter in limiters.items()}
+
+
+metrics.register_stats("limiter", limiter_stats)
+
+
+def _trusted(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def client_address(peer, forwarded=None):
+    """Client address of a connection from `peer` with this X-Forwarded-For.
+
+    The header is only read when the peer is a trusted proxy, and then
+    from the right: each trusted hop is skipped and the first address
+    no trusted proxy vouches for is the client (anything left of it may
+    be forged by that client).
+    """
+    if not forwarded or not _trusted(peer):
+        return peer
+    hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _trusted(hop):
+            return hop
+    return hops[0] if hops else peer
+
+
+def client_id():
+    """Remote address of the current Streamlit session (st.context.ip_address,
+    streamlit 1.45+), None if unknown"""
+    try:
+        return client_address(
+            st.context.ip_address, st.context.headers.get("X-Forwarded-For")
+        )
+    except Exception:
+        return None
@@ -0,0 +1,219 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from utils import metrics
+from utils.database import SCAN_ROWS, get_backend, get_store
+from utils.leaves import get_calendar
+from utils.tenants import current_tenant
+
+# Hours above which a day or a week counts as overtime
+DAILY_HOURS = float(os.environ.get("TASKTRACKER_DAILY_HOURS", 8))
+WEEKLY_HOURS = float(os.environ.get("TASKTRACKER_WEEKLY_HOURS", 40))
+REPORT_CACHE_SIZE = 32
+# Partial aggregates held before they are folded together while streaming
+MAX_PARTIALS = 8
+
+SECTIONS = {
+    "by_employee": "Hours by employee",
+    "by_task": "Hours by task",
+    "by_week": "Hours by week",
+    "by_month": "Hours by month",
+    "overtime": "Overtime",
+    "missing_days": "Missing days",
+}
+DAILY_COLUMNS = ["employee", "date", "task_id"]
+
+
+def _combine(partials):
+    if not partials:
+        empty = pd.DataFrame(columns=DAILY_COLUMNS + ["hours", "entries"])
+        return empty.set_index(DAILY_COLUMNS)
+    combined = pd.concat(partials)
+    if len(partials) == 1:
+        return combined
+    return combined.groupby(level=DAILY_COLUMNS, dropna=False, sort=False).sum()
+
+
+@metrics.timed
+def daily_hours(start=None, end=None, employees=None, chunk_size=SCAN_ROWS):
+    """Hours and entry counts per employee, date and task between start and
+    end (inclusive, either may be None), streamed from storage.
+
+    Only four columns are read, a chunk at a time, and each chunk is
+    reduced before the next is read, so memory follows the number of
+    employee-days rather than the size of the timesheet history.
+    """
+    criteria = {"employee": list(employees)} if employees else {}
+    scan = get_store("timesheets").scan(
+        columns=DAILY_COLUMNS + ["hours_worked"], chunk_size=chunk_size,
+        ranges={"date": (start, end)}, **criteria,
+    )
+    partials = []
+    for chunk in scan:
+        chunk = chunk.assign(task_id=chunk["task_id"].fillna(""))
+        partials.append(
+            chunk.groupby(DAILY_COLUMNS, dropna=False, sort=False)["hours_worked"]
+            .agg(hours="sum", entries="size")
+        )
+        if len(partials) > MAX_PARTIALS:
+            partials = [_combine(partials)]
+    daily = _combine(partials).reset_index()
+    daily["date"] = pd.to_datetime(daily["date"])
+    daily["hours"] = daily["hours"].astype(float)
+    daily["entries"] = daily["entries"].astype(int)
+    return daily.sort_values(["employee", "date", "task_id"], ignore_index=True)
+
+
+def missing_days(daily, start, end, employees):
+    """Working days up to today on which an employee logged nothing and
+    was not on approved leave"""
+    calendar = get_calendar()
+    end = min(end, pd.Timestamp.today().normalize())
+    if start <= end:
+        workdays = pd.bdate_range(start, end, freq="C", holidays=calendar.holidays)
+    else:
+        workdays = pd.DatetimeIndex([])
+    if not len(employees) or not len(workdays):
+        return pd.DataFrame(columns=["employee", "date"])
+    expected = pd.MultiIndex.from_product([sorted(employees), workdays], names=["employee", "date"])
+    worked = pd.MultiIndex.from_frame(daily[["employee", "date"]])
+    missing = expected.difference(worked).difference(calendar.days_off(start, end, employees))
+    return missing.to_frame(index=False)
+
+
+class Report:
+    """Payroll totals for one period; each section is a DataFrame"""
+
+    def __init__(self, start, end, sections):
+        self.start = start
+        self.end = end
+        self.sections = sections
+
+    def __getitem__(self, section):
+        return self.sections[section]
+
+    def to_csv(self, section):
+        """One section as CSV text"""
+        return self.sections[section].to_csv(index=False, date_format="%Y-%m-%d")
+
+    def to_excel(self):
+        """The whole report as .xlsx bytes, one sheet per section"""
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer, engine=excel_engine()) as writer:
+            for section, df in self.sections.items():
+                df.to_excel(writer, sheet_name=SECTIONS[section], index=False)
+        return buffer.getvalue()
+
+
+def excel_engine():
+    """Name of an installed Excel writer, or None if there is none"""
+    for engine in ("openpyxl", "xlsxwriter"):
+        try:
+            __import__(engine)
+            return engine
+        except ImportError:
+            pass
+    return None
+
+
+@metrics.timed
+def build_report(start, end, employees=None):
+    """Compute a Report for the days from start to end inclusive"""
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+    daily = daily_hours(start, end, employees)
+    if not employees:
+        employees = sorted(set(get_store("users").usernames("employee")) | set(daily["employee"]))
+
+    days = daily.groupby(["employee", "date"], sort=False)["hours"].sum().reset_index()
+    days["week"] = days["date"] - pd.to_timedelta(days["date"].dt.weekday, unit="D")
+    days["month"] = days["date"].dt.strftime("%Y-%m")
+    days["long_day"] = days["hours"] > DAILY_HOURS
+
+    by_week = days.groupby(["employee", "week"]).agg(
+        hours=("hours", "sum"), days=("date", "size"), long_days=("long_day", "sum")
+    ).reset_index()
+    by_week["overtime"] = (by_week["hours"] - WEEKLY_HOURS).clip(lower=0.0)
+
+    by_employee = days.groupby("employee").agg(
+        hours=("hours", "sum"), days=("date", "size"), long_days=("long_day", "sum")
+    ).join(by_week.groupby("employee")["overtime"].sum()).reset_index()
+
+    by_task = daily.groupby("task_id").agg(
+        hours=("hours", "sum"), entries=("entries", "sum"), employees=("employee", "nunique")
+    ).reset_index().sort_values("hours", ascending=False, ignore_index=True)
+
+    by_month = days.groupby(["employee", "month"]).agg(
+        hours=("hours", "sum"), days=("date", "size")
+    ).reset_index()
+
+    overtime = by_week[(by_week["overtime"] > 0) | (by_week["long_days"] > 0)]
+    sections = {
+        "by_employee": by_employee,
+        "by_task": by_task,
+        "by_week": by_week,
+        "by_month": by_month,
+        "overtime": overtime.reset_index(drop=True),
+        "missing_days": missing_days(daily, start, end, employees),
+    }
+    return Report(start, end, {
+        name: df.round({c: 2 for c in ("hours", "overtime") if c in df})
+        for name, df in sections.items()
+    })
+
+
+class ReportCache:
+    """Reports by tenant and period, least recently used evicted.
+
+    Keys include the versions of the tables a report reads, so a cached
+    report is only reused while none of them has been written to.
+    """
+
+    def __init__(self, size=REPORT_CACHE_SIZE):
+        self.size = size
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, start, end, employees=None):
+        backend = get_backend()
+        versions = tuple(backend.version(t) for t in ("timesheets", "leaves", "users"))
+        employees = tuple(sorted(employees)) if employees else None
+        key = (current_tenant(), str(start), str(end), employees, versions)
+        with self._lock:
+            report = self._reports.get(key)
+            if report is not None:
+                self._reports.move_to_end(key)
+                self.hits += 1
+                return report
+            self.misses += 1
+        report = build_report(start, end, employees)
+        with self._lock:
+            self._reports[key] = report
+            while len(self._reports) > self.size:
+                self._reports.popitem(last=False)
+        return report
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "reports": len(self._reports)}
+
+
+_reports = ReportCache()
+
+
+def get_report(start, end, employees=None):
+    """Payroll report for a period, served from the report cache when the
+    underlying tables have not changed"""
+    return _reports.get(start, end, employees)
+
+
+def report_stats():
+    return _reports.stats()
+
+
+metrics.register_stats("report_cache", report_stats)
@@ -0,0 +1,358 @@
+import functools
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import pandas as pd
+
+from utils import metrics
+from utils.database import DATA_DIR, StaleWriteError, date_str, get_store, list_tenants
+from utils.tenants import DEFAULT_TENANT, use_tenant
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process runs the jobs
+    fcntl = None
+
+# "0" keeps this process from running scheduled jobs at all
+ENABLED = os.environ.get("TASKTRACKER_SCHEDULER", "1") != "0"
+# Seconds between runs of each job. Override with e.g.
+# TASKTRACKER_JOB_INTERVALS="flag_overdue_tasks=60,close_open_sessions=900".
+INTERVALS = {
+    "close_open_sessions": 3600,
+    "flag_overdue_tasks": 600,
+    "escalate_pending_leaves": 600,
+}
+INTERVALS.update(
+    (name.strip(), float(seconds))
+    for name, seconds in (
+        item.split("=", 1)
+        for item in os.environ.get("TASKTRACKER_JOB_INTERVALS", "").split(",")
+        if "=" in item
+    )
+)
+# Workers of every process share the data directory; the one holding
+# this lock runs the jobs, the others retry every LEADER_RETRY seconds
+LOCK_FILE = ".scheduler.lock"
+LEADER_RETRY = 30
+# Seconds after start before the first runs, to stay out of startup
+FIRST_RUN_DELAY = 10
+# Logout time written into sessions left open on a past day (never
+# earlier than the login itself)
+AUTO_LOGOUT = os.environ.get("TASKTRACKER_AUTO_LOGOUT", "18:00:00")
+# Pending leaves starting within this many days are escalated to admins
+ESCALATE_DAYS = int(os.environ.get("TASKTRACKER_ESCALATE_DAYS", 3))
+# Days a closed-session notice stays up
+NOTICE_DAYS = 7
+
+
+class Job:
+    __slots__ = ("name", "interval", "fn", "runs", "errors", "last_ms", "last_result",
+                 "last_error", "due")
+
+    def __init__(self, name, interval, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.runs = 0
+        self.errors = 0
+        self.last_ms = None
+        self.last_result = None
+        self.last_error = None
+        self.due = None
+
+
+class Scheduler:
+    """Periodic jobs run from one thread, the next due first.
+
+    Jobs wait in a heap ordered by due time; the thread sleeps until the
+    head is due (or a job is added), runs every due job and puts each
+    back one interval later. Missed runs are not made up: a job late by
+    several intervals runs once. Only the process holding LOCK_FILE
+    runs jobs, so several Streamlit or API workers do the work once;
+    when the leader exits its lock is released and another takes over.
+    """
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.jobs = {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock_fd = None
+
+    def add(self, name, interval, fn, delay=0):
+        """Run fn() every `interval` seconds, the first time after `delay`"""
+        job = Job(name, interval, fn)
+        with self._cond:
+            self.jobs[name] = job
+            self._push(job, time.monotonic() + delay)
+            self._cond.notify()
+        return job
+
+    def _push(self, job, due):
+        job.due = due
+        heapq.heappush(self._queue, (due, next(self._seq), job))
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    @property
+    def leader(self):
+        return self._lock_fd is not None
+
+    def _lead(self):
+        """Take the leader lock if no other process holds it"""
+        if fcntl is None:
+            # Windows: no cross-process lock, every process leads
+            self._lock_fd = -1
+            return True
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def run_job(self, job):
+        """Run a job now and record the outcome; returns its result"""
+        start = time.perf_counter()
+        try:
+            with metrics.span(f"utils.scheduler.{job.name}"):
+                result = job.fn()
+        except Exception as e:
+            job.errors += 1
+            job.last_error = f"{type(e).__name__}: {e}"
+            result = None
+        else:
+            job.last_error = None
+        job.runs += 1
+        job.last_ms = (time.perf_counter() - start) * 1000
+        job.last_result = result
+        return result
+
+    def run_due(self, now=None):
+        """Run every job due by `now`; returns how many ran"""
+        now = time.monotonic() if now is None else now
+        ran = 0
+        while True:
+            with self._cond:
+                if not self._queue or self._queue[0][0] > now:
+                    return ran
+                due, _, job = heapq.heappop(self._queue)
+            self.run_job(job)
+            ran += 1
+            with self._cond:
+                self._push(job, max(due + job.interval, time.monotonic()))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self.leader and not self._lead():
+                self._stopped.wait(LEADER_RETRY)
+                continue
+            self.run_due()
+            with self._cond:
+                wait = self._queue[0][0] - time.monotonic() if self._queue else None
+                if wait is None or wait > 0:
+                    self._cond.wait(wait)
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if self._lock_fd not in (None, -1):
+            os.close(self._lock_fd)
+        self._lock_fd = None
+
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            jobs = list(self.jobs.values())
+        return {
+            job.name: {
+                "runs": job.runs,
+                "errors": job.errors,
+                "last_ms": job.last_ms,
+                "last_result": job.last_result,
+                "due_in_s": max(0.0, job.due - now),
+                "last_error": job.last_error or "",
+            }
+            for job in jobs
+        }
+
+
+def _today():
+    return pd.Timestamp.today().normalize()
+
+
+def _write(store, operations):
+    """Apply operations in one batch; if one row changed meanwhile, apply
+    the others one by one. Returns the number of rows written."""
+    try:
+        return store.write_batch(operations)
+    except StaleWriteError:
+        pass
+    count = 0
+    for operation in operations:
+        try:
+            count += store.write_batch([operation])
+        except StaleWriteError:
+            pass
+    return count
+
+
+def sync_alerts(kind, found):
+    """Make the `kind` alerts match `found` (ref, employee, message rows):
+    new ones raised, changed ones reworded, resolved ones removed"""
+    store = get_store("alerts")
+    today = date_str(_today())
+    current = store.find(kind=kind)
+    have = dict(zip(current["alert_id"], current["message"]))
+    operations = []
+    wanted = set()
+    for ref, employee, message in zip(found["ref"], found["employee"], found["message"]):
+        alert_id = f"{kind}:{ref}"
+        wanted.add(alert_id)
+        if alert_id not in have:
+            operations.append({"op": "insert", "row": {
+                "alert_id": alert_id, "kind": kind, "ref": ref, "employee": employee,
+                "message": message, "created": today,
+            }})
+        elif have[alert_id] != message:
+            operations.append({"op": "update", "key": alert_id, "changes": {"message": message}})
+    operations += [{"op": "delete", "key": alert_id} for alert_id in have if alert_id not in wanted]
+    return _write(store, operations)
+
+
+def close_open_sessions():
+    """Log out timesheet sessions left open on a past day at AUTO_LOGOUT
+    and tell their employees; returns the number closed"""
+    today = _today()
+    store = get_store("timesheets")
+    ts = store.all()
+    forgotten = ts[(ts["date"] < today) & ts["login_time"].notna() & ts["logout_time"].isna()]
+    login = pd.to_timedelta(forgotten["login_time"], errors="coerce")
+    forgotten, login = forgotten[login.notna()], login[login.notna()]
+    logout = login.clip(lower=pd.Timedelta(AUTO_LOGOUT))
+    hours = ((logout - login).dt.total_seconds() / 3600).round(2)
+    logout = (pd.Timestamp(0) + logout).dt.strftime("%H:%M:%S")
+    closed = _write(store, [
+        {"op": "update", "key": key, "expected": {"logout_time": None},
+         "changes": {"logout_time": out, "hours_worked": worked}}
+        for key, out, worked in zip(forgotten["timesheet_id"], logout, hours)
+    ])
+
+    alerts = get_store("alerts")
+    notices = alerts.find(kind="closed_session")
+    old = notices["alert_id"][notices["created"] < today - pd.Timedelta(days=NOTICE_DAYS)]
+    operations = [{"op": "delete", "key": alert_id} for alert_id in old]
+    have = set(notices["alert_id"])
+    for key, employee, day, out in zip(forgotten["timesheet_id"], forgotten["employee"],
+                                       forgotten["date"], logout):
+        alert_id = f"closed_session:{key}"
+        if alert_id not in have:
+            operations.append({"op": "insert", "row": {
+                "alert_id": alert_id, "kind": "closed_session", "ref": key, "employee": employee,
+                "message": f"No logout on {date_str(day)}: the session was closed at {out}",
+                "created": date_str(today),
+            }})
+    _write(alerts, operations)
+    return closed
+
+
+def flag_overdue_tasks():
+    """Raise an alert per unfinished task past its deadline; returns the count"""
+    tasks = get_store("tasks").all()
+    overdue = tasks[(tasks["deadline"] < _today()) & (tasks["status"] != "Completed")]
+    sync_alerts("overdue_task", pd.DataFrame({
+        "ref": overdue["task_id"],
+        "employee": overdue["assigned_to"],
+        "message": "'" + overdue["title"].astype(str) + "' was due "
+                   + overdue["deadline"].dt.strftime("%Y-%m-%d"),
+    }))
+    return len(overdue)
+
+
+def escalate_pending_leaves():
+    """Raise an alert per leave request still Pending within ESCALATE_DAYS
+    of its start (or already started); returns the count"""
+    leaves = get_store("leaves").all()
+    soon = _today() + pd.Timedelta(days=ESCALATE_DAYS)
+    pending = leaves[(leaves["status"] == "Pending") & (leaves["start_date"] <= soon)]
+    sync_alerts("pending_leave", pd.DataFrame({
+        "ref": pending["leave_id"],
+        "employee": pending["employee"],
+        "message": pending["leave_type"].astype(str) + " from "
+                   + pending["start_date"].dt.strftime("%Y-%m-%d") + " to "
+                   + pending["end_date"].dt.strftime("%Y-%m-%d") + " is still pending",
+    }))
+    return len(pending)
+
+
+def for_every_tenant(fn):
+    """A job running fn() on each tenant's shard in turn, returning the
+    summed results; one tenant failing does not keep the others' turn
+    from coming, its error is raised afterwards"""
+    @functools.wraps(fn)
+    def job():
+        total = 0
+        error = None
+        for tenant in [DEFAULT_TENANT] + list_tenants():
+            try:
+                with use_tenant(tenant):
+                    total += fn()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return total
+    return job
+
+
+JOBS = {
+    "close_open_sessions": close_open_sessions,
+    "flag_overdue_tasks": flag_overdue_tasks,
+    "escalate_pending_leaves": escalate_pending_leaves,
+}
+
+_scheduler = None
+_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process's scheduler with the JOBS added (not started)"""
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(os.path.join(DATA_DIR, LOCK_FILE))
+            for name, fn in JOBS.items():
+                _scheduler.add(name, INTERVALS[name], for_every_tenant(fn), delay=FIRST_RUN_DELAY)
+        return _scheduler
+
+
+def start_scheduler():
+    """Start running the jobs in the background, once per process"""
+    if ENABLED:
+        get_scheduler().start()
+
+
+def scheduler_stats():
+    return _scheduler.stats() if _scheduler is not None else {}
+
+
+metrics.register_stats("scheduler", scheduler_stats)
@@ -0,0 +1,276 @@
+import bisect
+import math
+import os
+import re
+import threading
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from utils import metrics
+from utils.database import TABLES, _clean_value, get_cache, get_store, plain_column
+from utils.tenants import current_tenant
+
+# table -> {searchable column: weight of a term found in it}
+FIELDS = {
+    "tasks": {"title": 2.0, "description": 1.0},
+    "leaves": {"reason": 1.0},
+    "timesheets": {"description": 1.0, "task_notes": 1.0},
+}
+SEARCH_LIMIT = int(os.environ.get("TASKTRACKER_SEARCH_LIMIT", 20))
+# Index terms a query word may stand for as a prefix, shortest first
+MAX_EXPANSIONS = 50
+# A term only matched as a prefix of the typed word scores this much less
+PREFIX_WEIGHT = 0.7
+# BM25 term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Lower-cased words of a text"""
+    return TOKEN.findall(text.lower()) if isinstance(text, str) else []
+
+
+class _TableIndex:
+    __slots__ = ("postings", "terms", "lengths", "total", "texts")
+
+    def __init__(self):
+        # term -> {row key: weighted term frequency}
+        self.postings = {}
+        # sorted terms, for prefix lookups
+        self.terms = []
+        # row key -> weighted number of terms
+        self.lengths = {}
+        self.total = 0.0
+        # row key -> [tuple of field texts per row]; keys may repeat in
+        # legacy timesheets, whose rows then make up one document
+        self.texts = {}
+
+
+class SearchIndex:
+    """Inverted index over the text columns in FIELDS, kept in step with
+    the table cache.
+
+    It is built once when a table is loaded into the cache; after that
+    every insert/update/delete the cache folds in only re-indexes the
+    rows it touches, and updates that leave the text columns alone cost
+    nothing. Words are matched as prefixes, so results come while the
+    user is typing, and ranked by BM25 with title words weighted up.
+    Closed timesheet months are not in the cache and so not searched.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.tables = sorted(fields)
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    @metrics.timed
+    def reset(self, table, df):
+        fields = list(self.fields[table])
+        weights = self.fields[table]
+        keys = df[TABLES[table]["key"]].to_numpy(dtype=object)
+        columns = [plain_column(df[f]) for f in fields]
+        frames = []
+        for field, column in zip(fields, columns):
+            # Many rows share a text; tokenize each distinct one once
+            distinct = column.dropna().unique()
+            tokens = column.map(dict(zip(distinct, map(tokenize, distinct))))
+            frame = pd.DataFrame({"key": keys, "term": tokens.to_numpy()}).explode("term")
+            frames.append(frame.dropna().assign(tf=weights[field]))
+        index = _TableIndex()
+        counts = pd.concat(frames).groupby(["term", "key"], sort=True)["tf"].sum()
+        if len(counts):
+            terms = counts.index.get_level_values(0).to_numpy()
+            doc_keys = counts.index.get_level_values(1).to_numpy()
+            tfs = counts.to_numpy().tolist()
+            starts = np.flatnonzero(np.r_[True, terms[1:] != terms[:-1]]).tolist()
+            ends = starts[1:] + [len(terms)]
+            for start, end in zip(starts, ends):
+                index.postings[terms[start]] = dict(zip(doc_keys[start:end], tfs[start:end]))
+            index.terms = list(index.postings)
+            lengths = counts.groupby(level=1).sum()
+            index.lengths = dict(zip(lengths.index, lengths.to_numpy().tolist()))
+            index.total = float(lengths.sum())
+        texts = defaultdict(list)
+        for key, *values in zip(keys, *columns):
+            if any(v is not None for v in values):
+                texts[key].append(tuple(values))
+        index.texts = dict(texts)
+        with self._lock:
+            self._tables[table] = index
+
+    def _counts(self, table, rows):
+        counts = defaultdict(float)
+        for values in rows:
+            for (field, weight), text in zip(self.fields[table].items(), values):
+                for term in tokenize(text):
+                    counts[term] += weight
+        return counts
+
+    def _remove(self, index, key, counts):
+        for term in counts:
+            posting = index.postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(key, None)
+            if not posting:
+                del index.postings[term]
+                del index.terms[bisect.bisect_left(index.terms, term)]
+        index.total -= index.lengths.pop(key, 0.0)
+
+    def _add(self, index, key, counts):
+        for term, tf in counts.items():
+            posting = index.postings.get(term)
+            if posting is None:
+                posting = index.postings[term] = {}
+                bisect.insort(index.terms, term)
+            posting[key] = tf
+        if counts:
+            length = sum(counts.values())
+            index.lengths[key] = length
+            index.total += length
+
+    def apply(self, table, records):
+        fields = list(self.fields[table])
+        key_column = TABLES[table]["key"]
+        with self._lock:
+            index = self._tables.get(table)
+            if index is None:
+                return
+            for record in records:
+                op = record["op"]
+                if op == "insert":
+                    key = _clean_value(record["row"].get(key_column))
+                    values = tuple(_clean_value(record["row"].get(f)) for f in fields)
+                    if all(v is None for v in values):
+                        continue
+                    old = index.texts.get(key, [])
+                    new = old + [values]
+                elif op == "update":
+                    key = record["key"]
+                    changes = record["changes"]
+                    if not any(f in changes for f in fields) or key not in index.texts:
+                        continue
+                    old = index.texts[key]
+                    new = [
+                        tuple(_clean_value(changes[f]) if f in changes else v
+                              for f, v in zip(fields, values))
+                        for values in old
+                    ]
+                else:
+                    key = record["key"]
+                    old = index.texts.get(key)
+                    if old is None:
+                        continue
+                    new = []
+                self._remove(index, key, self._counts(table, old))
+                self._add(index, key, self._counts(table, new))
+                if new:
+                    index.texts[key] = new
+                else:
+                    index.texts.pop(key, None)
+
+    def _expand(self, index, word):
+        """Index terms starting with word, the word itself first"""
+        terms = index.terms
+        matches = []
+        for i in range(bisect.bisect_left(terms, word), len(terms)):
+            if not terms[i].startswith(word):
+                break
+            matches.append(terms[i])
+        matches.sort(key=len)
+        return matches[:MAX_EXPANSIONS]
+
+    @metrics.timed
+    def scores(self, table, text):
+        """BM25 scores of the row keys matching every word of text, as a
+        Series indexed by key"""
+        words = list(dict.fromkeys(tokenize(text)))
+        empty = pd.Series(dtype=float)
+        with self._lock:
+            index = self._tables.get(table)
+            if index is None or not words or not index.lengths:
+                return empty
+            expansions = [self._expand(index, word) for word in words]
+            if not all(expansions):
+                return empty
+            docs = len(index.lengths)
+            average = index.total / docs
+            result = None
+            for word, terms in zip(words, expansions):
+                parts = []
+                for term in terms:
+                    posting = index.postings[term]
+                    n = len(posting)
+                    idf = math.log(1 + (docs - n + 0.5) / (n + 0.5))
+                    if term != word:
+                        idf *= PREFIX_WEIGHT
+                    tf = np.fromiter(posting.values(), float, n)
+                    lengths = np.fromiter(map(index.lengths.__getitem__, posting), float, n)
+                    norm = K1 * (1 - B + B * lengths / average)
+                    parts.append(pd.Series(idf * tf * (K1 + 1) / (tf + norm),
+                                           index=list(posting)))
+                best = parts[0] if len(parts) == 1 else pd.concat(parts).groupby(level=0).max()
+                result = best if result is None else result.add(best).dropna()
+                if result.empty:
+                    return empty
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                table: {"documents": len(index.lengths), "terms": len(index.postings)}
+                for table, index in self._tables.items()
+            }
+
+
+# tenant -> its index, subscribed to that tenant's cache
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index():
+    """Return the current tenant's search index, brought up to date with
+    its tables"""
+    tenant = current_tenant()
+    cache = get_cache()
+    with _lock:
+        index = _indexes.get(tenant)
+        if index is None:
+            index = _indexes[tenant] = SearchIndex(FIELDS)
+            cache.subscribe(index)
+    for table in index.tables:
+        # A no-op on a cache hit; otherwise catches the index up as well
+        get_store(table).all()
+    return index
+
+
+def search(table, text, limit=SEARCH_LIMIT, exclude=None, ranges=None, any_of=None,
+           **criteria):
+    """The best `limit` rows of table matching every word of text, with a
+    "score" column, best first. The filters are those of Store.query()
+    and narrow the matches before they are ranked."""
+    scores = get_index().scores(table, text)
+    key = TABLES[table]["key"]
+    if len(scores) and (criteria or exclude or ranges or any_of):
+        allowed = get_cache().find(table, criteria, exclude, ranges, any_of)[key]
+        scores = scores[scores.index.isin(allowed)]
+    if scores.empty:
+        return get_store(table).all().iloc[:0].assign(score=pd.Series(dtype=float))
+    best = scores.nlargest(limit)
+    rows = get_store(table).find(**{key: list(best.index)})
+    rows = rows.assign(score=rows[key].map(best).to_numpy())
+    return rows.sort_values("score", ascending=False, kind="stable")
+
+
+def search_stats():
+    index = _indexes.get(current_tenant())
+    return index.stats() if index is not None else {}
+
+
+metrics.register_stats("search_index", search_stats)
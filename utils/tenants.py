@@ -0,0 +1,45 @@
+import contextvars
+import re
+from contextlib import contextmanager
+
+# The tenant whose shard is the data directory itself; every other tenant
+# (department, business unit) has its own under data/tenants/<name>
+DEFAULT_TENANT = ""
+TENANT_NAME = re.compile(r"[a-z0-9][a-z0-9_-]{0,63}")
+
+# Tenant the data layer works on in this thread or task. Each entry point
+# sets it: a Streamlit run from its session, an API request from its
+# token, the scheduler for each tenant in turn.
+_current = contextvars.ContextVar("tenant", default=DEFAULT_TENANT)
+
+
+def valid_tenant(name):
+    return name == DEFAULT_TENANT or TENANT_NAME.fullmatch(name or "") is not None
+
+
+def check_tenant(name):
+    """Return a tenant name, or raise ValueError for one that cannot be a
+    shard directory"""
+    name = DEFAULT_TENANT if name is None else name
+    if not valid_tenant(name):
+        raise ValueError(f"Invalid tenant name {name!r}: use lower-case letters, digits, - and _")
+    return name
+
+
+def current_tenant():
+    return _current.get()
+
+
+def set_tenant(name):
+    """Make the data layer work on this tenant's shard from now on"""
+    _current.set(check_tenant(name))
+
+
+@contextmanager
+def use_tenant(name):
+    """Work on this tenant's shard inside the block"""
+    token = _current.set(check_tenant(name))
+    try:
+        yield
+    finally:
+        _current.reset(token)